@@ -7,25 +7,57 @@ from .authchain import Chain as AuthChain                             # noqa
 from .keystore import keystore, KeyNotFoundError                      # noqa
 from .chainstore import chainstore, ChainNotFoundError                # noqa
 from .identitychain import Chain as IdentityChain                     # noqa
+from .context import CliqueContext                                    # noqa
+from .blockdag import BlockDag                                        # noqa
 from . import blockchain, identitychain, authchain                    # noqa
 
 log = getLogger(__package__)
 
 
-def chainFactory(godblock, serialization):
+def chainType(godblock):
+    """Returns the ``BlockChain`` subclass for the chain type (``tid``) of
+    ``godblock``, or ``None``."""
     chain_types = {"identity_XXX": IdentityChain,
                    "auth_XXX": AuthChain,
                   }
     if "tid" in godblock.payload and godblock.payload["tid"] in chain_types:
-        return chain_types[godblock.payload["tid"]].deserialize(serialization)
+        return chain_types[godblock.payload["tid"]]
+    return None
 
 
-def useCliqueServer(url, KeyStoreClass=None, ChainStoreClass=None):
-    from .keystore import setKeyStore, RemoteKeyStore
-    from .chainstore import setChainStore, RemoteChainStore
+def chainFactory(godblock, serialization, **kwargs):
+    ChainClass = chainType(godblock)
+    if ChainClass:
+        return ChainClass.deserialize(serialization, **kwargs)
+
+
+def remoteStores(url, KeyStoreClass=None, ChainStoreClass=None, **kwargs):
+    """Returns a (key store, chain store) for the clique server at ``url``.
+
+    The stores share one pooled HTTP session unless a ``session`` is given,
+    ``kwargs`` are passed to both store constructors.
+    """
+    from .common import httpSession
+    from .keystore import RemoteKeyStore
+    from .chainstore import RemoteChainStore
 
     KeyStoreClass = KeyStoreClass or RemoteKeyStore
     ChainStoreClass = ChainStoreClass or RemoteChainStore
+    if "session" not in kwargs:
+        kwargs["session"] = httpSession(kwargs.pop("pool_size", 10))
+
+    return (KeyStoreClass(url + "/keys", **kwargs),
+            ChainStoreClass(url, **kwargs))
+
+
+def useCliqueServer(url, KeyStoreClass=None, ChainStoreClass=None, **kwargs):
+    """Sets the global stores to remote stores for the clique server at
+    ``url``, see ``remoteStores``. Use ``CliqueContext.forServer`` for stores
+    local to a thread or task.
+    """
+    from .keystore import setKeyStore
+    from .chainstore import setChainStore
 
-    setChainStore(ChainStoreClass(url))
-    setKeyStore(KeyStoreClass(url + "/keys"))
+    ks, cs = remoteStores(url, KeyStoreClass, ChainStoreClass, **kwargs)
+    setChainStore(cs)
+    setKeyStore(ks)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""asyncio key and chain stores, and chain deserialization and validation that
+do not block the event loop.
+
+The adapters run the blocking calls of the (sync) stores in an executor, so
+fetches from remote stores are awaited concurrently.
+"""
+import json
+import asyncio
+import functools
+from abc import ABCMeta, abstractmethod
+from collections import OrderedDict
+
+from .common import OrderedKeySet
+from .context import bindContext
+from .keystore import keystore, KeyNotFoundError
+from .chainstore import chainstore, ChainNotFoundError
+from .blockchain import BlockChain, _kids
+
+
+async def _run(executor, func, *args, **kwargs):
+    # In the active CliqueContext of the calling task.
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+            executor, bindContext(functools.partial(func, *args, **kwargs)))
+
+
+class AsyncKeyStoreABC(metaclass=ABCMeta):
+    """Abstract base for asyncio JWK key stores, see ``KeyStoreABC``."""
+    @abstractmethod
+    async def add(self, jwk):
+        pass                                                 # pragma: no cover
+
+    @abstractmethod
+    async def __getitem__(self, tp):
+        pass                                                 # pragma: no cover
+
+    async def upload(self, jwk):
+        await self.add(jwk)
+
+    async def _getOrNone(self, tp):
+        try:
+            return await self[tp]
+        except KeyNotFoundError:
+            return None
+
+    async def getMany(self, thumbprints):
+        """Returns an ``OrderedKeySet`` of the keys ``thumbprints`` that are
+        found, looked up concurrently."""
+        keys = await asyncio.gather(*[self._getOrNone(tp) for tp in
+                                      OrderedDict.fromkeys(thumbprints)])
+        return OrderedKeySet(k for k in keys if k is not None)
+
+    async def prefetch(self, thumbprints):
+        """Returns the thumbprints of the keys that were not found, see
+        ``KeyStoreABC.prefetch``."""
+        keys = await self.getMany(thumbprints)
+        return [tp for tp in OrderedDict.fromkeys(thumbprints)
+                if tp not in keys]
+
+
+class AsyncChainStoreABC(metaclass=ABCMeta):
+    """Abstract base for asyncio BlockChain stores, see ``ChainStoreABC``."""
+    @abstractmethod
+    async def add(self, blockchain):
+        pass                                                 # pragma: no cover
+
+    @abstractmethod
+    async def __getitem__(self, subject):
+        pass                                                 # pragma: no cover
+
+    async def upload(self, chain):
+        await self.add(chain)
+
+    async def _getOrNone(self, subject):
+        try:
+            return await self[subject]
+        except ChainNotFoundError:
+            return None
+
+    async def prefetch(self, subjects):
+        """Looks up the chains ``subjects`` concurrently, returns the subjects
+        that were not found."""
+        subjects = list(OrderedDict.fromkeys(subjects))
+        chains = await asyncio.gather(*[self._getOrNone(s) for s in subjects])
+        return [s for s, c in zip(subjects, chains) if c is None]
+
+
+class AsyncKeyStore(AsyncKeyStoreABC):
+    """Adapts a ``KeyStoreABC``, its calls run in ``executor``."""
+    def __init__(self, keystore=None, executor=None):
+        """
+        Args:
+            keystore (KeyStoreABC): The store, by default the ``keystore()``
+                current when called.
+            executor (concurrent.futures.Executor): By default the event loop
+                default executor.
+        """
+        self._keystore = keystore
+        self._executor = executor
+
+    @property
+    def keystore(self):
+        return self._keystore or keystore()
+
+    async def add(self, jwk):
+        return await _run(self._executor, self.keystore.add, jwk)
+
+    async def __getitem__(self, tp):
+        return await _run(self._executor, self.keystore.__getitem__, tp)
+
+    async def upload(self, jwk):
+        return await _run(self._executor, self.keystore.upload, jwk)
+
+    async def getMany(self, thumbprints):
+        # Remote stores fetch in bulk, or concurrently in their own threads.
+        return await _run(self._executor, self.keystore.getMany,
+                          list(thumbprints))
+
+
+class AsyncChainStore(AsyncChainStoreABC):
+    """Adapts a ``ChainStoreABC``, its calls run in ``executor``."""
+    def __init__(self, chainstore=None, executor=None):
+        """
+        Args:
+            chainstore (ChainStoreABC): The store, by default the
+                ``chainstore()`` current when called.
+            executor (concurrent.futures.Executor): By default the event loop
+                default executor.
+        """
+        self._chainstore = chainstore
+        self._executor = executor
+
+    @property
+    def chainstore(self):
+        return self._chainstore or chainstore()
+
+    async def add(self, blockchain):
+        return await _run(self._executor, self.chainstore.add, blockchain)
+
+    async def __getitem__(self, subject):
+        return await _run(self._executor, self.chainstore.__getitem__,
+                          subject)
+
+    async def upload(self, chain):
+        return await _run(self._executor, self.chainstore.upload, chain)
+
+
+async def deserialize(serialization, factory=None, lazy=False,
+                      ChainClass=BlockChain, keystore=None, executor=None):
+    """``BlockChain.deserialize`` with the signing keys of all blocks fetched
+    concurrently beforehand, and decoding in ``executor``.
+
+    Args:
+        serialization (str): The chain, see ``BlockChain.serialize``.
+        factory (callable): See ``BlockChain.deserialize``, defaults to
+            ``clique.chainFactory``.
+        lazy (bool): See ``BlockChain.deserialize``.
+        ChainClass: The ``BlockChain`` class to deserialize with.
+        keystore (AsyncKeyStoreABC): Where keys are fetched, it should store
+            them in the ``keystore()`` blocks are decoded with. By default an
+            ``AsyncKeyStore`` of it.
+        executor (concurrent.futures.Executor): By default the event loop
+            default executor.
+    """
+    from . import chainFactory
+
+    keystore = keystore or AsyncKeyStore(executor=executor)
+    await keystore.prefetch(_kids(json.loads(serialization)))
+    return await _run(executor, ChainClass.deserialize, serialization,
+                      factory=factory or chainFactory, lazy=lazy)
+
+
+def _dependencies(chain):
+    """Returns the kids of the blocks of ``chain`` and the subjects of the
+    chains its validation looks up."""
+    from .authchain import Chain as AuthChain
+
+    kids = _kids(chain._serializationAt(i) for i in range(len(chain)))
+    subjects = []
+    if isinstance(chain, AuthChain):
+        # Blocks are validated against the identity chain of their creator
+        subjects = list(OrderedDict.fromkeys(b.creator for b in chain))
+    return kids, subjects
+
+
+async def validate(chain, genesis_block_hash, keystore=None, chainstore=None,
+                   executor=None, **kwargs):
+    """``chain.validate(genesis_block_hash, **kwargs)`` with the keys and
+    chains it looks up fetched concurrently beforehand, and validation in
+    ``executor``.
+
+    Args:
+        keystore (AsyncKeyStoreABC): See ``deserialize``.
+        chainstore (AsyncChainStoreABC): Where chains are fetched, it should
+            store them in the ``chainstore()`` used by validation. By default
+            an ``AsyncChainStore`` of it.
+        executor (concurrent.futures.Executor): By default the event loop
+            default executor.
+    """
+    keystore = keystore or AsyncKeyStore(executor=executor)
+    chainstore = chainstore or AsyncChainStore(executor=executor)
+    kids, subjects = await _run(executor, _dependencies, chain)
+    await asyncio.gather(keystore.prefetch(kids),
+                         chainstore.prefetch(subjects))
+    return await _run(executor, chain.validate, genesis_block_hash, **kwargs)
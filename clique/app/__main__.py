@@ -4,6 +4,7 @@ from argparse import RawDescriptionHelpFormatter
 
 from ..__about__ import __version__
 from .. import useCliqueServer
+from ..common import CLIQUE_CACHE_D
 from . import keygen   # noqa
 from . import identity  # noqa
 from . import blockchain  # noqa
@@ -16,7 +17,8 @@ def main(args):
     log.debug("Args: {}".format(args))
 
     if args.server:
-        useCliqueServer(args.server)
+        # Keys and chains are cached on disk for later runs.
+        useCliqueServer(args.server, cache_dir=CLIQUE_CACHE_D)
 
     if args.command_func:
         return args.command_func(args)
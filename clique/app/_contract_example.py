@@ -3,6 +3,7 @@ from uuid import uuid4
 import requests
 from clique.blockchain import BlockChain, Block, Identity
 from clique import keystore
+from clique.blockdag import BlockDag
 
 
 def contract_example(args):
@@ -61,9 +62,9 @@ def contract_example(args):
     melvins_crew += Block(ipecac, None, ack=True,
                           ptk="FIXME: get fprint from block being acked")
     print(melvins_crew)
-    CONTRACT_BLOCK_CHAIN = melvins_crew.serialize()
 
-    master = BlockChain.deserialize(CONTRACT_BLOCK_CHAIN)
+    # Branches share the blocks, nothing is re-parsed
+    master = melvins_crew.fork()
     master.addBlock(ipecac, thing="contract:offer", new_signing="Unsane",
                     blahblah="....")
     master.addBlock(ipecac, thing="contract:offer", new_signing="Faith No More",
@@ -71,31 +72,30 @@ def contract_example(args):
     CONTRACT_BLOCK_CHAIN = master.serialize()
 
     ######################################################
-    download = CONTRACT_BLOCK_CHAIN
-    fnm_offer = BlockChain.deserialize(download)
+    fnm_offer = master.fork()
     print(fnm_offer)
     fnm_offer.validate(GHASH)
     fnm_offer.addBlock(fnm, ack=False)
-    deny_upload = fnm_offer.serialize()
 
     #####################################################
-    download = CONTRACT_BLOCK_CHAIN
-    unsane_offer = BlockChain.deserialize(download)
+    unsane_offer = master.fork()
     print(unsane_offer)
     unsane_offer.validate(GHASH)
     unsane_offer.addBlock(unsane, ack=True)
-    accept_upload = unsane_offer.serialize()
 
     ######################################################
 
-    yes_from_unsane = BlockChain.deserialize(accept_upload)
-    yes_from_unsane.validate(GHASH)
-    no_from_ftm = BlockChain.deserialize(deny_upload)
+    yes_from_unsane = unsane_offer.fork()
     yes_from_unsane.validate(GHASH)
+    no_from_ftm = fnm_offer.fork()
+    no_from_ftm.validate(GHASH)
 
-    # XXX: at this point there is a merge op
     print(yes_from_unsane)
     print(no_from_ftm)
+    # The replicas diverge after the offers, the longest (or ours) is kept
+    merged = BlockDag().merge(yes_from_unsane, no_from_ftm)
+    merged.validate(GHASH)
+    print(merged)
 
     with open("sample.json", "w") as fp:
         fp.write(CONTRACT_BLOCK_CHAIN)
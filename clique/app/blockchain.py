@@ -1,6 +1,6 @@
 import nicfit
 from argparse import FileType
-from .. import BlockChain, chainFactory
+from .. import BlockChain, chainType
 
 
 @nicfit.command.register
@@ -12,6 +12,7 @@ class blockchain(nicfit.Command):
                             help="File containing serialized block chain.")
 
     def _run(self):
-        chain_data = self.args.chainfile.read()
-        chain = BlockChain.deserialize(chain_data, factory=chainFactory)
-        print(chain)
+        blocks = BlockChain.iterload(self.args.chainfile, chain_type=chainType)
+        for i, block in enumerate(blocks):
+            print("Block #{i:d}:\n{block}".format(**locals()))
+        print()
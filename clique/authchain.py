@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
+import weakref
+import threading
 from enum import Enum
-from collections import OrderedDict
-
-from jwcrypto.jws import JWS
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
 
 from .keystore import keystore
 from .chainstore import chainstore
@@ -11,6 +12,9 @@ from .blockchain import Block as BaseBlock
 from .blockchain import BlockChain, ChainValidationError
 from .blockchain import _ChainValidationState as _ChainValidationStateBase
 
+from . import getLogger
+log = getLogger(__name__)
+
 CHAIN_TYPEID = "auth_XXX"
 
 
@@ -56,20 +60,36 @@ class Block(BaseBlock):
         self._grants = []
         self._payload["grants"] = []
 
+        # The grant indexes of the chains the block is in, to the height of
+        # the block in them. A block is shared by forks of a chain.
+        self._indexes = weakref.WeakKeyDictionary()
+        self._grants_lock = threading.Lock()
+
     @property
     def grants(self):
         for grant in self._grants:
             yield grant
 
     def addGrant(self, grant):
-        self._grants.append(grant)
+        with self._grants_lock:
+            self._grants.append(grant)
+            i = len(self._grants) - 1
+            indexes = list(self._indexes.items())
+        for index, height in indexes:
+            index.grantAdded(self, height, i, grant)
+
+    def _addToIndex(self, index, height):
+        """Registers ``index`` for the grants added from now on, and returns
+        the grants added so far."""
+        with self._grants_lock:
+            self._indexes[index] = height
+            return list(self._grants)
 
     def toJson(self):
-        self._payload["grants"] = []
-        for grant in self._grants:
-            self._payload["grants"].append(grant.toJson())
-
-        return super().toJson(omit=("pkt",))
+        # The grants are set in the copy, readers may serialize concurrently.
+        d = super().toJson(omit=("pkt",))
+        d["grants"] = [grant.toJson() for grant in self._grants]
+        return d
 
     @classmethod
     def deserialize(Cls, data, thumbprint, chain):
@@ -94,17 +114,15 @@ class Block(BaseBlock):
             # Special cased to bootstrap data structures
             cvs.ratchet(self)
 
-        jws = JWS()
-        jws.deserialize(self.serialize())
-        tprint = jws.jose_header["kid"]
+        tprint = self.jws.kid
         idchain = chainstore()[self.creator]
         if self.creator not in cvs._recent_thumbprints:
             raise ChainValidationError("No grants for creator: " + self.creator)
         creator_print = cvs._recent_thumbprints[self.creator]
 
         if idchain.isSameOrSubsequent(tprint, creator_print):
-            key = keystore()[tprint]
-            jws.verify(key)
+            # The key of tprint, unless the block is already verified.
+            cvs.verify(self)
         else:
             raise ChainValidationError("Out of date key.")
 
@@ -140,47 +158,241 @@ class GenesisBlock(Block):
         return True
 
 
+# A grant in a Chain index. ``pos`` orders the grants the same way the
+# reverse block scan finds them.
+_IndexedGrant = namedtuple("_IndexedGrant", "pos, block, grant")
+
+
+class _GrantIndex(object):
+    """The grant lookups of a ``Chain``, shared with its forks until one of
+    them is appended to. The blocks indexed notify every index they are in of
+    the grants added to them.
+    """
+    def __init__(self):
+        # (grantee, privilege) -> _IndexedGrant, and grantee -> _IndexedGrant
+        self.privileges = {}
+        self.grantees = {}
+        # Built on demand by Chain.grantHistory
+        self.history = None
+        self.lock = threading.RLock()
+
+    def addBlock(self, block, height):
+        with self.lock:
+            for i, grant in enumerate(block._addToIndex(self, height)):
+                self._addGrant(block, height, i, grant)
+
+    def grantAdded(self, block, height, i, grant):
+        with self.lock:
+            self._addGrant(block, height, i, grant)
+
+            history = self.history
+            if history is not None and height <= history.height:
+                if height == history.height:
+                    history._setGrant(grant)
+                else:
+                    # An already replayed block changed, start over.
+                    self.history = None
+
+    def _addGrant(self, block, height, i, grant):
+        # Within a block the last matching grant wins, as with the
+        # validation ratchet.
+        entry = _IndexedGrant((height, i), block, grant)
+        for index, key in ((self.privileges,
+                            (grant.grantee, grant.privilege)),
+                           (self.grantees, grant.grantee)):
+            if key not in index or index[key].pos < entry.pos:
+                index[key] = entry
+
+
 class Chain(BlockChain):
     BlockType = Block
     GodBlockType = GenesisBlock
 
     def __init__(self, identity, resource_uri):
         super().__init__()
+        self._grant_index = _GrantIndex()
+
         if identity and resource_uri:
             self.addBlock(identity, resource_uri)
 
-    def hasPrivilege(self, acct, privilege):
-        for block in reversed(self):
-            for grant in block.grants:
-                if grant.grantee == acct and grant.privilege == privilege:
-                    return grant.type != Grant.Type.REVOKE
-        return False
+    def _newBlock(self, block):
+        self._grant_index.addBlock(block, self._hooked)
+
+    def _unshare(self):
+        super()._unshare()
+        # Rebuilt rather than copied, so the blocks notify the new index of
+        # their grants too.
+        self._grant_index = self._buildIndex(self._hooked)
+
+    def _buildIndex(self, length):
+        index = _GrantIndex()
+        for height in range(length):
+            index.addBlock(self._block(height), height)
+        return index
+
+    def _reindex(self):
+        # Built aside and swapped in, concurrent lookups never see a partial
+        # index.
+        self._grant_index = self._buildIndex(len(self))
+
+    def _isStale(self, entry):
+        height = entry.pos[0]
+        return height >= len(self) or self[height] is not entry.block
+
+    def _lookupGrant(self, index_name, key):
+        self._runHooks()
+        entry = getattr(self._grant_index, index_name).get(key)
+        if entry is not None and self._isStale(entry):
+            # Either a block is being appended, or the blocks were changed
+            # without _newBlock (e.g. removed).
+            with self._lock:
+                entry = getattr(self._grant_index, index_name).get(key)
+                if entry is not None and self._isStale(entry):
+                    log.debug("Stale grant index, rebuilding")
+                    self._reindex()
+                    entry = getattr(self._grant_index, index_name).get(key)
+        return entry.grant if entry else None
+
+    def hasPrivilege(self, acct, privilege, scan=False):
+        """Returns ``True`` if the latest grant of ``privilege`` to ``acct``
+        is not a revoke.
+
+        The indexed lookup is O(1), ``scan=True`` searches the blocks instead,
+        e.g. to verify the index.
+        """
+        if scan:
+            for block in reversed(self):
+                for grant in reversed(list(block.grants)):
+                    if grant.grantee == acct and grant.privilege == privilege:
+                        return grant.type != Grant.Type.REVOKE
+            return False
+
+        grant = self._lookupGrant("privileges", (acct, privilege))
+        return grant is not None and grant.type != Grant.Type.REVOKE
+
+    def getGrantIdentity(self, acct, scan=False):
+        """Returns an ``Identity`` for ``acct`` with the key of its latest
+        grant, or ``None``. See ``hasPrivilege`` for ``scan``."""
+        if scan:
+            for block in reversed(self):
+                for g in reversed(list(block.grants)):
+                    if g.grantee == acct:
+                        key = keystore()[g.thumbprint]
+                        return Identity(acct, key)
+            return None
+
+        grant = self._lookupGrant("grantees", acct)
+        if grant is None:
+            return None
+        return Identity(acct, keystore()[grant.thumbprint])
+
+    def grantHistory(self):
+        """Returns the ``GrantHistory`` of the chain, replaying the blocks
+        appended since the last call."""
+        self._runHooks()
+        with self._lock, self._grant_index.lock:
+            index = self._grant_index
+            history = index.history
+            if (history is None or history.height >= len(self) or
+                    (history.height >= 0 and
+                     self[history.height] is not history.antecedent)):
+                history = GrantHistory(self)
+
+            for i in range(history.height + 1, len(self)):
+                history.ratchet(self[i])
+            index.history = history
+        return history
+
+    def hasPrivilegeAt(self, acct, privilege, height):
+        """Returns ``True`` if ``acct`` held ``privilege`` as of the block at
+        ``height``, in O(log n)."""
+        grant = self.grantHistory().grantAt(acct, privilege, height)
+        return grant is not None and grant.type != Grant.Type.REVOKE
+
+    def grantsAt(self, height):
+        """Returns the grants in effect as of the block at ``height``, as a
+        dict of grantee to a dict of privilege to ``Grant``."""
+        return self.grantHistory().grantsAt(height)
+
+    def validate(self, genesis_block_hash, workers=None, context=None):
+        return super().validate(genesis_block_hash,
+                                ChainValidationClass=_ChainValidationState,
+                                workers=workers, context=context)
 
-    def getGrantIdentity(self, acct):
-        for block in reversed(self):
-            for g in block.grants:
-                if g.grantee == acct:
-                    key = keystore()[g.thumbprint]
-                    return Identity(acct, key)
-        return None
 
-    def validate(self, genesis_block_hash):
-        class _ChainValidationState(_ChainValidationStateBase):
-            def __init__(self, chain):
-                super().__init__(chain)
+class _ChainValidationState(_ChainValidationStateBase):
+    def __init__(self, chain):
+        super().__init__(chain)
 
-                self._recent_thumbprints = {}
-                self._current_grants = {}
+        self._recent_thumbprints = {}
+        self._current_grants = {}
 
-            def ratchet(self, block):
-                for grant in block.grants:
-                    if grant.grantee not in self._current_grants:
-                        self._current_grants[grant.grantee] = {}
+    def ratchet(self, block):
+        for grant in block.grants:
+            self._setGrant(grant)
 
-                    self._current_grants[grant.grantee][grant.privilege] = grant
-                    self._recent_thumbprints[grant.grantee] = grant.thumbprint
+        super().ratchet(block)
 
-                super().ratchet(block)
+    def _setGrant(self, grant):
+        if grant.grantee not in self._current_grants:
+            self._current_grants[grant.grantee] = {}
 
-        return super().validate(genesis_block_hash,
-                                ChainValidationClass=_ChainValidationState)
+        self._current_grants[grant.grantee][grant.privilege] = grant
+        self._recent_thumbprints[grant.grantee] = grant.thumbprint
+
+    def copy(self):
+        cvs = super().copy()
+        cvs._recent_thumbprints = dict(self._recent_thumbprints)
+        cvs._current_grants = {grantee: dict(grants)
+                               for grantee, grants in
+                                   self._current_grants.items()}
+        return cvs
+
+
+class GrantHistory(_ChainValidationState):
+    """A versioned index of the grants of a ``Chain`` by block height.
+
+    The blocks are replayed with the validation ``ratchet``, and each
+    (grantee, privilege) keeps the heights its grant changed at so lookups
+    at a height are a binary search.
+    """
+    def __init__(self, chain):
+        super().__init__(chain)
+        # Height of the last replayed block
+        self.height = -1
+        # (grantee, privilege) -> ([heights], [grants])
+        self._history = {}
+
+    def ratchet(self, block):
+        self.height += 1
+        super().ratchet(block)
+
+    def _setGrant(self, grant):
+        super()._setGrant(grant)
+
+        heights, grants = self._history.setdefault(
+                (grant.grantee, grant.privilege), ([], []))
+        if heights and heights[-1] == self.height:
+            grants[-1] = grant
+        else:
+            # Grant first, concurrent lookups index grants by heights.
+            grants.append(grant)
+            heights.append(self.height)
+
+    def grantAt(self, acct, privilege, height):
+        """Returns the ``Grant`` of ``privilege`` to ``acct`` in effect at
+        ``height``, or ``None``."""
+        if (acct, privilege) not in self._history:
+            return None
+
+        heights, grants = self._history[(acct, privilege)]
+        i = bisect_right(heights, height)
+        return grants[i - 1] if i else None
+
+    def grantsAt(self, height):
+        grants = {}
+        for (grantee, privilege), (heights, gs) in list(self._history.items()):
+            i = bisect_right(heights, height)
+            if i:
+                grants.setdefault(grantee, {})[privilege] = gs[i - 1]
+        return grants
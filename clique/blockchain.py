@@ -1,24 +1,53 @@
 # -*- coding: utf-8 -*-
+import copy
 import json
+import threading
+import itertools
+from contextlib import ExitStack
 from hashlib import sha256
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
-from jwcrypto.jwt import JWT
+from jwcrypto.jwk import JWK
 
 from .keystore import keystore
-from .common import JsonType, Identity, thumbprint
+from .signing import Es256Backend
+from .merkle import MerkleTree, verifyInclusion
+from jwcrypto.common import base64url_decode, json_decode
+
+from .common import JsonType, Identity, CompactJws, LruCache, thumbprint
 
 from . import getLogger
 log = getLogger(__name__)
 
 
+VERIFIED_CACHE_SIZE = 2 ** 16
+
+# Counts the blocks re-signed with ``serialize(update=True)``, a validation
+# checkpoint taken before a block was re-signed no longer holds.
+_resignings = itertools.count(1)
+
+
 class Block(JsonType):
+    # Signs and verifies the block JWS, see ``signing.JwcryptoBackend`` for
+    # the reference implementation.
+    jws_backend = Es256Backend()
+    # The (block hash, key thumbprint) pairs that verified, shared by all
+    # chains. The hash covers the signature so a pair always verifies.
+    verified_signatures = LruCache(capacity=VERIFIED_CACHE_SIZE)
+    # Bumped from ``_resignings`` whenever a signed block is re-signed.
+    _generation = 0
+
     def __init__(self, identity, antecedent, **payload):
         self._identity = identity
         # Set the active key, it could change before the block is signed.
         self._key = identity.key
 
         self._serialization = None
+        self._jws = None
+        # Signing is randomized, the block is signed once by one thread.
+        self._lock = threading.Lock()
 
         self._payload = OrderedDict()
         self._payload["iss"] = self.creator
@@ -79,14 +108,11 @@ class Block(JsonType):
 
     @classmethod
     def _fromSerialization(BlockClass, serialized, chain):
-        jwt = JWT()
-        jwt.deserialize(serialized)
-
-        jws = jwt.token
-        block_json = json.loads(str(jws.objects["payload"], "utf8"))
-        block = BlockClass.deserialize(block_json, jws.jose_header["kid"],
-                                       chain)
+        jws = CompactJws(serialized)
+        block_json = json.loads(str(jws.payload, "utf8"))
+        block = BlockClass.deserialize(block_json, jws.kid, chain)
         block._serialization = serialized
+        block._jws = jws
 
         return block
 
@@ -97,23 +123,31 @@ class Block(JsonType):
         h = {"alg": "ES256",
              "kid": thumbprint(self._key),
             }
-        jwt = JWT(header=h, claims=self.toJson())
-        jwt.make_signed_token(self._key)
+        serialization = self.jws_backend.sign(self._key, h, self.toJson())
         log.debug("Block signed with key thumbprint: {}".format(h["kid"]))
-        return jwt.serialize()
+        return serialization
 
     def serialize(self, update=False):
         if self._serialization is None or update:
-            self._serialization = self._serialize()
+            with self._lock:
+                if self._serialization is None or update:
+                    if self._serialization is not None:
+                        Block._generation = next(_resignings)
+                    self._serialization = self._serialize()
         return self._serialization
 
+    @property
+    def jws(self):
+        """common.CompactJws: The parsed serialization of the block."""
+        serialization = self.serialize()
+        if self._jws is None or self._jws.serialization is not serialization:
+            self._jws = CompactJws(serialization)
+        return self._jws
+
     @property
     def hash(self):
         # FIXME: can't pass update arg since @property
-        s = self.serialize(update=False)
-        hfunc = sha256()
-        hfunc.update(s.encode("utf8"))
-        return hfunc.hexdigest()
+        return _hash(self.serialize(update=False))
 
     def validate(self, cvs):
         self._validateAntecedent(cvs)
@@ -131,52 +165,246 @@ class Block(JsonType):
         if cvs.antecedent is None:
             # Special cased to bootstrap data structures
             cvs.ratchet(self)
-        self.verify()
+        cvs.verify(self)
 
     def verify(self, key=None):
-        jwt = JWT()
-        jwt.deserialize(self.serialize())
-        jws = jwt.token
+        """Verify the block signature with ``key``, by default the key of its
+        ``kid`` which is not looked up if the block was already verified.
 
+        Raises:
+            InvalidJWSSignature: If the signature does not verify.
+        """
+        jws = self.jws
+        verified = (self.hash, thumbprint(key) if key else jws.kid)
+        if verified in self.verified_signatures:
+            return
         if not key:
-            tprint = jws.jose_header["kid"]
-            key = keystore()[tprint]
-        jws.verify(key)
+            key = keystore()[jws.kid]
+        self.jws_backend.verify(key, jws)
+        self.verified_signatures[verified] = True
 
     def __str__(self):
         return json.dumps(self.toJson(), indent=2, sort_keys=True)
 
 
+def _hash(serialization):
+    """Returns the block hash of a serialized block."""
+    hfunc = sha256()
+    hfunc.update(serialization.encode("utf8"))
+    return hfunc.hexdigest()
+
+
+class _SharedBlocks(object):
+    """The block list of a fork, the first ``length`` blocks of the list of
+    the chain it was forked from (which may be appended to meanwhile). Read
+    only, but for lazily decoded blocks. See ``BlockChain.fork``."""
+    __slots__ = ("base", "length")
+
+    def __init__(self, blocks):
+        if isinstance(blocks, _SharedBlocks):
+            self.base, self.length = blocks.base, blocks.length
+        else:
+            self.base, self.length = blocks, len(blocks)
+
+    @property
+    def diverged(self):
+        """bool: ``True`` once the other chain was appended to."""
+        return len(self.base) != self.length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return self.base[range(self.length)[i]]
+
+    def __setitem__(self, i, block):
+        self.base[range(self.length)[i]] = block
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self.base[i]
+
+
 class BlockChain(JsonType):
+    """A base class for all types of block chains.
+
+    Chains can be read by many threads while one appends. Blocks are only
+    ever appended, and the state derived from them (lazily decoded blocks,
+    ``_newBlock`` indexes) is updated under the chain lock.
+    """
     BlockType = Block
     GodBlockType = Block
 
-    """A base class for all types of block chains."""
     def __init__(self, *_):
+        # Blocks, or None for blocks of a lazy chain that are not decoded yet.
         self._blocks = []
+        # The serialized blocks of a lazy chain, see ``_block``.
+        self._raw = None
+        # The number of leading blocks passed to ``_newBlock``.
+        self._hooked = 0
+        self._checkpoint = None
+        # The CliqueContext lazily deserialized blocks are decoded in.
+        self._context = None
+        # Held by writers, readers only take it to update derived state.
+        self._lock = threading.RLock()
+        # Set when the block list is shared with a fork, see ``fork``.
+        self._shared = False
+        # Over the block hashes, extended on demand, see ``root``.
+        self._merkle = None
 
     def _newBlock(self, block):
-        """Invoked before ``block`` is added to the chain."""
+        """Invoked before ``block`` is added to the chain.
+
+        For lazily deserialized chains this is deferred until ``_runHooks``.
+        """
         pass
 
     def _appendBlock(self, block):
-        self._newBlock(block)
-        self._blocks.append(block)
+        with self._lock:
+            self._runHooks()
+            if self._shared:
+                self._unshare()
+            self._newBlock(block)
+            self._blocks.append(block)
+            self._hooked = len(self._blocks)
+
+    def _runHooks(self):
+        """Invokes ``_newBlock``, in order, for the lazily loaded blocks that
+        have not been passed to it. Chains that maintain state in
+        ``_newBlock`` call this before using it."""
+        if self._shared and self._blocks.diverged:
+            # The chain this was forked from was appended to, and so its
+            # state shared with this fork.
+            with self._lock:
+                if self._shared and self._blocks.diverged:
+                    self._unshare()
+        if self._hooked == len(self._blocks):
+            return
+        with self._lock:
+            if (self._hooked < len(self._blocks) and
+                    getattr(self._newBlock, "__func__", None) is not
+                        BlockChain._newBlock):
+                if self._shared:
+                    self._unshare()
+                for i in range(self._hooked, len(self._blocks)):
+                    self._hooked = i
+                    self._newBlock(self._block(i))
+            self._hooked = len(self._blocks)
+
+    def fork(self):
+        """Returns a chain of the same blocks, in O(1), that is appended to
+        independently of this one.
+
+        The blocks, and the state subclasses keep in ``_newBlock``, are
+        shared. This chain is still appended to in place, the fork copies the
+        blocks of its own and rebuilds that state in O(n) when it is appended
+        to, or first used once this chain was. Grants added to a shared block
+        are indexed by every chain it is in.
+        """
+        with self._lock:
+            fork = copy.copy(self)
+            fork._lock = threading.RLock()
+            fork._blocks = _SharedBlocks(self._blocks)
+            fork._shared = True
+        return fork
+
+    def _unshare(self):
+        """Copies the blocks shared with the chain this was forked from,
+        before the fork is appended to. Subclasses that keep state in
+        ``_newBlock`` extend this to rebuild it from ``range(self._hooked)``
+        blocks, the shared state can have the other chain's newer blocks."""
+        self._blocks = list(self._blocks)
+        tree = self._merkle.copy() if self._merkle is not None else None
+        if tree is not None and len(tree) > len(self):
+            # Extended by the other chain, rebuilt on demand.
+            tree = None
+        self._merkle = tree
+        self._shared = False
+
+    def _merkleTree(self):
+        """Returns the Merkle tree of the block hashes, extended with the
+        blocks appended since the last call."""
+        tree = self._merkle
+        if tree is not None and len(tree) == len(self):
+            return tree
+
+        with self._lock:
+            tree = self._merkle
+            if tree is None or len(tree) > len(self):
+                # Or the blocks were removed
+                tree = MerkleTree()
+            # The tree is shared with forks until either is appended to.
+            for i in range(len(tree), len(self)):
+                tree.append(self._hashAt(i), i)
+            self._merkle = tree
+        return tree
+
+    def root(self):
+        """Returns the Merkle tree root hash of the block hashes (RFC 6962).
+        It is updated incrementally as blocks are appended."""
+        size = len(self)
+        # A tree shared with a fork can be extended by the other chain.
+        return self._merkleTree().root(size)
+
+    def proveInclusion(self, i):
+        """Returns the ``merkle.InclusionProof`` that block ``i`` is in the
+        chain, for ``verifyInclusion`` with the current ``root``.
+
+        Raises:
+            IndexError: If there is no block ``i``.
+        """
+        size = len(self)
+        return self._merkleTree().proveInclusion(range(size)[i], size)
+
+    @staticmethod
+    def verifyInclusion(proof, root):
+        """Returns ``True`` if ``proof`` (see ``proveInclusion``) shows the
+        block ``proof.leaf`` (hash) is in the chain with Merkle root ``root``.
+        In O(log n), the chain is not needed."""
+        return verifyInclusion(proof, root)
+
+    def _block(self, i):
+        """Returns the block at index ``i``, decoding it from the serialized
+        chain if it was lazily deserialized."""
+        block = self._blocks[i]
+        if block is None:
+            with self._lock:
+                i = range(len(self._blocks))[i]
+                block = self._blocks[i]
+                if block is None:
+                    BlockType = (self.GodBlockType if i == 0 else
+                                 self.BlockType)
+                    with self._context or ExitStack():
+                        block = BlockType._fromSerialization(self._raw[i],
+                                                             self)
+                    self._blocks[i] = block
+        return block
+
+    def _serializationAt(self, i):
+        """Returns the serialization of block ``i`` without decoding it."""
+        block = self._blocks[i]
+        return block.serialize() if block is not None else self._raw[i]
+
+    def _hashAt(self, i):
+        """Returns the hash of block ``i`` without decoding it."""
+        block = self._blocks[i]
+        return block.hash if block is not None else _hash(self._raw[i])
 
     def addBlock(self, identity, *args, **kwargs):
-        antecedent = self._blocks[-1] if self._blocks else None
-        if antecedent:
-            block = self.BlockType(identity, antecedent.hash, *args, **kwargs)
-        else:
-            if self.GodBlockType is self.BlockType:
-                # antecedent hash arg required base Block types
-                args = (None, ) + args
-            block = self.GodBlockType(identity, *args, **kwargs)
-        self._appendBlock(block)
+        with self._lock:
+            if self._blocks:
+                block = self.BlockType(identity, self._hashAt(-1), *args,
+                                       **kwargs)
+            else:
+                if self.GodBlockType is self.BlockType:
+                    # antecedent hash arg required base Block types
+                    args = (None, ) + args
+                block = self.GodBlockType(identity, *args, **kwargs)
+            self._appendBlock(block)
         return block
 
     def toJson(self):
-        return [b.toJson() for b in self._blocks]
+        return [b.toJson() for b in self]
 
     @property
     def genesis_block(self):
@@ -185,67 +413,308 @@ class BlockChain(JsonType):
         Raises:
             IndexError: If there are no blocks in the chain.
         """
-        return self._blocks[0]
+        return self._block(0)
     god_block = genesis_block
 
     def __getitem__(self, i):
-        return self._blocks[i]
+        if isinstance(i, slice):
+            return [self._block(j) for j in range(*i.indices(len(self)))]
+        return self._block(i)
 
     def __len__(self):
         return len(self._blocks)
 
     def __iter__(self):
-        return iter(self._blocks)
+        for i in range(len(self._blocks)):
+            yield self._block(i)
 
     def __reversed__(self):
-        return reversed(self._blocks)
+        for i in reversed(range(len(self._blocks))):
+            yield self._block(i)
 
     def __iadd__(self, rhs):
-        if len(self._blocks) == 0:
-            rhs.antecedent = None
-        else:
-            rhs.antecedent = self._blocks[-1].hash
-        self._appendBlock(rhs)
+        with self._lock:
+            if len(self._blocks) == 0:
+                rhs.antecedent = None
+            else:
+                rhs.antecedent = self._hashAt(-1)
+            self._appendBlock(rhs)
         return self
 
     def serialize(self, update=False):
         """Returns the serialized BlockChain as a JSON string."""
-        return json.dumps([b.serialize(update=False) for b in self._blocks])
+        return json.dumps([self._serializationAt(i)
+                           for i in range(len(self._blocks))])
+
+    def dump(self, fp):
+        """Writes the serialized chain to the text file ``fp`` one block at a
+        time, in the same format as ``serialize``."""
+        fp.write("[")
+        for i in range(len(self._blocks)):
+            if i:
+                fp.write(", ")
+            fp.write(json.dumps(self._serializationAt(i)))
+        fp.write("]")
+
+    @classmethod
+    def iterload(ChainClass, fp, chain_type=None):
+        """Yields the blocks of a serialized chain read from the text file
+        ``fp``, one at a time. The blocks are not kept, nor added to a chain.
+
+        Args:
+            fp: The file to read, as written by ``dump``.
+            chain_type (callable): Called with the genesis block, it may return
+                the ``BlockChain`` subclass the blocks are decoded as.
+        """
+        chain = None
+        for serialized in _iterJsonArray(fp):
+            if chain is None:
+                # Only holds the genesis block, as context for decoding.
+                chain = ChainClass._fromGenesis(serialized, chain_type)
+                yield chain.genesis_block
+            else:
+                yield chain.BlockType._fromSerialization(serialized, chain)
 
     @classmethod
-    def deserialize(ChainClass, serialization, factory=None):
+    def _fromGenesis(ChainClass, serialized, chain_type=None):
+        """Returns a new chain containing the serialized genesis block. The
+        chain type is ``ChainClass`` unless ``chain_type`` (see ``iterload``)
+        returns another."""
+        chain = ChainClass(None, None)
+        block = ChainClass.GodBlockType._fromSerialization(serialized, chain)
+        ChainType = chain_type(block) if chain_type else None
+        if ChainType and ChainType is not ChainClass:
+            chain = ChainType(None, None)
+            block = ChainType.GodBlockType._fromSerialization(serialized,
+                                                              chain)
+        chain._appendBlock(block)
+        return chain
+
+    @classmethod
+    def fromSerializedBlocks(ChainClass, blocks, chain_type=None, lazy=True):
+        """Returns a chain of the serialized ``blocks``.
+
+        Args:
+            blocks: A sequence of serialized blocks, with lazy decoding this is
+                indexed when blocks are first accessed.
+            chain_type (callable): See ``iterload``.
+            lazy (bool): See ``deserialize``.
+        """
+        if len(blocks) == 0:
+            return ChainClass(None, None)
+
+        chain = ChainClass._fromGenesis(blocks[0], chain_type)
+        if lazy:
+            chain._raw = blocks
+            chain._blocks.extend([None] * (len(blocks) - 1))
+        else:
+            for i in range(1, len(blocks)):
+                chain._appendBlock(
+                        chain.BlockType._fromSerialization(blocks[i], chain))
+        return chain
+
+    @classmethod
+    def deserialize(ChainClass, serialization, factory=None, lazy=False,
+                    prefetch=False, context=None):
+        """Returns the chain decoded from the JSON string ``serialization``.
+
+        Args:
+            serialization (str): The chain, see ``serialize``.
+            factory (callable): Called with the genesis block and
+                ``serialization`` it may return a chain of a different type.
+                ``lazy=True`` is passed along when set.
+            lazy (bool): When ``True`` only the genesis block is decoded, the
+                others are decoded on first access.
+            prefetch (bool): When ``True`` the signing keys of all blocks are
+                resolved, concurrently by remote key stores, before decoding.
+                See ``KeyStoreABC.prefetch``.
+            context (CliqueContext): The stores to decode with, lazy chains
+                keep it to decode the other blocks.
+        """
+        if context is not None:
+            with context:
+                chain = ChainClass.deserialize(serialization, factory, lazy,
+                                               prefetch)
+            if lazy:
+                chain._context = context
+            return chain
+
         chain = ChainClass(None, None)
         chain_json = json.loads(serialization)
 
         if len(chain_json) == 0:
             return chain
+        if prefetch:
+            keystore().prefetch(_kids(chain_json))
 
         block = ChainClass.GodBlockType._fromSerialization(chain_json[0], chain)
 
         if factory:
-            factory_chain = factory(block, serialization)
+            factory_chain = factory(block, serialization,
+                                    **({"lazy": True} if lazy else {}))
             if factory_chain:
                 return factory_chain
 
         chain._appendBlock(block)
+        if lazy:
+            chain._raw = chain_json
+            chain._blocks.extend([None] * (len(chain_json) - 1))
+            return chain
+
         for serialized in chain_json[1:]:
             block = ChainClass.BlockType._fromSerialization(serialized, chain)
             chain._appendBlock(block)
 
         return chain
 
-    def validate(self, genesis_block_hash, ChainValidationClass=None):
+    def validate(self, genesis_block_hash, ChainValidationClass=None,
+                 workers=None, context=None):
+        """Validate the chain starting from the block ``genesis_block_hash``.
+
+        A successful validation is remembered as a checkpoint, subsequent
+        calls with the same genesis hash and the same key and chain stores
+        only validate the blocks appended since. Re-signing any block with
+        ``Block.serialize(update=True)`` drops the checkpoints, blocks changed
+        otherwise (e.g. assigning ``_serialization``) need
+        ``clearCheckpoint``.
+
+        Args:
+            genesis_block_hash (str): The trusted hash of the genesis block.
+            ChainValidationClass (type): Validation state type, defaults to
+                ``_ChainValidationState``.
+            workers (int): When set, the antecedent links and chain policy
+                are checked in sequence but the signature checks are run in
+                a pool of ``workers`` processes, shared by the validations
+                with as many workers. The first failing block raises the same
+                error the serial validation would.
+            context (CliqueContext): The stores to validate with.
+
+        Raises:
+            ChainValidationError: If the chain is not valid.
+        """
+        if context is not None:
+            with context:
+                return BlockChain.validate(self, genesis_block_hash,
+                                           ChainValidationClass, workers)
         ChainValidationClass = ChainValidationClass or _ChainValidationState
         if self[0].hash != genesis_block_hash:
             raise ChainValidationError(
                     "Genesis hash mismatch: {} (self) != {} (requested)"
                     .format(self.genesis_block.hash, genesis_block_hash))
 
-        cvs = ChainValidationClass(self)
-        for block in self:
-            block.validate(cvs)
+        # Blocks appended or re-signed while validating are left for the
+        # next call.
+        end = len(self)
+        generation = Block._generation
+        cvs, start = self._resumeValidation(genesis_block_hash,
+                                            ChainValidationClass)
+        if not workers:
+            for i in range(start, end):
+                block = self[i]
+                block.validate(cvs)
+                cvs.ratchet(block)
+            self._setCheckpoint(genesis_block_hash, cvs, end, generation)
+            return
+
+        cvs.verifier = _DeferredVerifier()
+        error = None
+        for i in range(start, end):
+            block = self[i]
+            cvs.verifier.index = i
+            try:
+                block.validate(cvs)
+            except Exception as ex:
+                error = ex
+                break
             cvs.ratchet(block)
 
+        # Only signatures of blocks up to the first sequential failure were
+        # deferred, so the earliest failing signature is the serial error.
+        jobs = cvs.verifier.jobs
+        if jobs:
+            chunksize = max(1, len(jobs) // (workers * 4))
+            try:
+                results = _processPool(workers).map(
+                        _verifySerialization, [job[1:4] for job in jobs],
+                        chunksize=chunksize)
+                for (i, *_, cache, verified), sig_error in zip(jobs, results):
+                    if sig_error is not None:
+                        log.debug("Signature check failed for block #{:d}"
+                                  .format(i))
+                        raise sig_error
+                    cache[verified] = True
+            except BrokenProcessPool:
+                # A worker died, the next validation starts a new pool.
+                with _process_pools_lock:
+                    _process_pools.pop(workers, None)
+                raise
+
+        if error is not None:
+            raise error
+
+        cvs.verifier = None
+        self._setCheckpoint(genesis_block_hash, cvs, end, generation)
+
+    def _appendValidated(self, blocks, genesis_block_hash):
+        """Appends ``blocks`` if they validate as the successors of the tip,
+        resuming from the checkpoint (the chain is validated up to the tip
+        first if needed). Nothing is appended if a block is not valid.
+
+        Raises:
+            ChainValidationError: If a block is not valid.
+        """
+        with self._lock:
+            self.validate(genesis_block_hash)
+            generation = self._checkpoint.generation
+            cvs = self._checkpoint.cvs.copy()
+            for block in blocks:
+                block.validate(cvs)
+                cvs.ratchet(block)
+
+            for block in blocks:
+                self._appendBlock(block)
+            self._setCheckpoint(genesis_block_hash, cvs, len(self),
+                                generation)
+
+    def prefetchKeys(self, workers=None):
+        """Resolves the signing keys of all blocks, e.g. before validating a
+        lazy chain. See ``KeyStoreABC.prefetch``.
+
+        Returns:
+            list: The thumbprints of the keys that were not found.
+        """
+        return keystore().prefetch(
+                _kids(self._serializationAt(i) for i in range(len(self))),
+                workers=workers)
+
+    def _resumeValidation(self, genesis_block_hash, ChainValidationClass):
+        """Returns a validation state and the index of the first block to
+        validate, resuming from the checkpoint when it still applies."""
+        cp = self._checkpoint
+        if (cp is not None and cp.genesis_hash == genesis_block_hash and
+                type(cp.cvs) is ChainValidationClass and
+                cp.generation == Block._generation and
+                _sameStores(cp.stores, _activeStores()) and
+                cp.length <= len(self) and
+                self._hashAt(cp.length - 1) == cp.tip_hash):
+            log.debug("Resuming validation at block #{:d}".format(cp.length))
+            cvs = cp.cvs.copy()
+            cvs.chain = self
+            return cvs, cp.length
+
+        return ChainValidationClass(self), 0
+
+    def _setCheckpoint(self, genesis_block_hash, cvs, length, generation):
+        self._checkpoint = _ValidationCheckpoint(genesis_block_hash, length,
+                                                 self._hashAt(length - 1),
+                                                 cvs, _activeStores(),
+                                                 generation)
+
+    def clearCheckpoint(self):
+        """Forget the validated prefix, the next ``validate`` checks every
+        block. Needed after changing a block other than by re-signing it."""
+        self._checkpoint = None
+
     def __str__(self):
         chain_str = ""
         for i, block in enumerate(self, 0):
@@ -254,6 +723,66 @@ class BlockChain(JsonType):
         return chain_str
 
 
+def _kids(serializations):
+    """Returns the distinct ``kid`` headers of serialized blocks, in order.
+    Only the protected headers are decoded."""
+    kids = OrderedDict()
+    for serialized in serializations:
+        header = json_decode(base64url_decode(serialized.split(".", 1)[0]))
+        if "kid" in header:
+            kids[header["kid"]] = None
+    return list(kids)
+
+
+def _iterJsonArray(fp, chunk_size=2 ** 16):
+    """Yields the values of the JSON array read from the text file ``fp``,
+    reading ``chunk_size`` characters at a time."""
+    decoder = json.JSONDecoder()
+    buf, pos = "", 0
+    state = "start"
+    while True:
+        while pos < len(buf) and buf[pos] in " \t\r\n":
+            pos += 1
+
+        if pos == len(buf) or state == "value_more":
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                raise ValueError("Unexpected end of JSON array")
+            buf, pos = buf[pos:] + chunk, 0
+            if state == "value_more":
+                state = "value"
+            continue
+
+        c = buf[pos]
+        if state == "start":
+            if c != "[":
+                raise ValueError("Expected a JSON array")
+            pos += 1
+            state = "first"
+        elif state in ("first", "sep") and c == "]":
+            return
+        elif state == "sep":
+            if c != ",":
+                raise ValueError("Expected ',' at offset {:d}".format(pos))
+            pos += 1
+            state = "value"
+        else:
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Assume the value is continued in the next chunk
+                state = "value_more"
+                continue
+            if end == len(buf):
+                # A value at the end of the buffer may not be complete
+                state = "value_more"
+                continue
+
+            yield value
+            pos = end
+            state = "sep"
+
+
 class ChainValidationError(Exception):
     def __bool__(self):
         return False
@@ -263,6 +792,79 @@ class _ChainValidationState(object):
     def __init__(self, chain):
         self.chain = chain
         self.antecedent = None
+        self.verifier = None
 
     def ratchet(self, block):
         self.antecedent = block
+
+    def copy(self):
+        """Returns a copy of the state that can be ratcheted independently."""
+        return copy.copy(self)
+
+    def verify(self, block, key=None):
+        """Verify the signature of ``block``, or defer the check when
+        validating with worker processes."""
+        if self.verifier is None:
+            block.verify(key)
+        else:
+            self.verifier.defer(block, key)
+
+
+_ValidationCheckpoint = namedtuple("_ValidationCheckpoint",
+                                   "genesis_hash, length, tip_hash, cvs, "
+                                   "stores, generation")
+
+
+def _activeStores():
+    """Returns the key and chain stores a validation resolves keys and chains
+    with, a checkpoint only holds for the same stores (e.g. another
+    ``CliqueContext`` may not trust the same keys)."""
+    from .chainstore import chainstore
+    return keystore(), chainstore()
+
+
+def _sameStores(stores, other):
+    return all(a is b for a, b in zip(stores, other))
+
+
+class _DeferredVerifier(object):
+    """Collects the signature checks of a chain validation so they can be run
+    in worker processes."""
+    def __init__(self):
+        self.index = None
+        self.jobs = []
+
+    def defer(self, block, key=None):
+        verified = (block.hash, thumbprint(key) if key else block.jws.kid)
+        if verified in block.verified_signatures:
+            return
+        if not key:
+            key = keystore()[block.jws.kid]
+        self.jobs.append((self.index, block.serialize(), key.export_public(),
+                          block.jws_backend, block.verified_signatures,
+                          verified))
+
+
+# Worker pools by number of processes, started on first use and kept for the
+# life of the process.
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+
+def _processPool(workers):
+    """Returns the shared pool of ``workers`` processes."""
+    with _process_pools_lock:
+        if workers not in _process_pools:
+            _process_pools[workers] = ProcessPoolExecutor(max_workers=workers)
+        return _process_pools[workers]
+
+
+def _verifySerialization(job):
+    """Process pool worker for ``_DeferredVerifier`` jobs. Returns ``None``
+    if the signature is valid, or the verification error."""
+    serialization, key_json, backend = job
+    try:
+        backend.verify(JWK(**json.loads(key_json)), CompactJws(serialization))
+    except Exception as ex:
+        return ex
+    return None
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""The blocks of diverging copies of chains, as a tree of blocks keyed by hash
+with ``ant`` parent links.
+
+Replicas of a chain that were appended to independently are reconciled with
+``BlockDag.merge``, the blocks past their common ancestor are what is compared.
+"""
+import threading
+
+from . import getLogger
+log = getLogger(__name__)
+
+
+def _invertLowestOne(n):
+    return n & (n - 1)
+
+
+def _skipHeight(height):
+    """Returns the height the skip pointer of a block at ``height`` links to.
+    Any height is then reached in O(log n) hops, as with Bitcoin's
+    ``CBlockIndex::pskip``."""
+    if height < 2:
+        return 0
+    # Odd heights link further back than the even ones, so that walks can
+    # alternate between long and short hops.
+    if height & 1:
+        return _invertLowestOne(_invertLowestOne(height - 1)) + 1
+    return _invertLowestOne(height)
+
+
+class _Node(object):
+    __slots__ = ("hash", "parent", "height", "skip", "chain", "index")
+
+    def __init__(self, block_hash, parent, chain, index):
+        self.hash = block_hash
+        self.parent = parent
+        if parent is None:
+            self.height, self.skip = 0, None
+        else:
+            self.height = parent.height + 1
+            self.skip = parent.ancestor(_skipHeight(self.height))
+        # The block is ``chain[index]``, chains are append only.
+        self.chain = chain
+        self.index = index
+
+    def ancestor(self, height):
+        """Returns the node at ``height`` on the path to the genesis block,
+        or ``None``."""
+        if height > self.height or height < 0:
+            return None
+
+        node = self
+        while node.height > height:
+            skip_height = _skipHeight(node.height)
+            prev_skip_height = _skipHeight(node.height - 1)
+            if node.skip is not None and (
+                    skip_height == height or
+                    (skip_height > height and
+                     not (prev_skip_height < skip_height - 2 and
+                          prev_skip_height >= height))):
+                node = node.skip
+            else:
+                node = node.parent
+        return node
+
+
+def longestChain(ours, theirs, height):
+    """The default ``BlockDag.merge`` policy, the chain with the most blocks
+    wins and ties keep ``ours``.
+
+    Args:
+        ours (BlockChain): Our replica.
+        theirs (BlockChain): Their replica.
+        height (int): The index of the last block the chains have in common.
+
+    Returns:
+        BlockChain: The chain to keep.
+    """
+    return theirs if len(theirs) > len(ours) else ours
+
+
+class BlockDag(object):
+    """The blocks of the chains added, keyed by block hash. Branch tips are
+    tracked, and each block has a skip pointer to an older ancestor for
+    O(log n) ancestor lookups.
+
+    Chains are expected to be validated, only the block hashes and their
+    order are used.
+    """
+    def __init__(self):
+        self._nodes = {}
+        self._tips = set()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, block_hash):
+        return block_hash in self._nodes
+
+    def __getitem__(self, block_hash):
+        """Returns the block with hash ``block_hash``.
+
+        Raises:
+            KeyError: If the block is not in the DAG.
+        """
+        node = self._nodes[block_hash]
+        return node.chain[node.index]
+
+    @property
+    def tips(self):
+        """list: The hashes of the blocks without descendants, one per
+        branch."""
+        return list(self._tips)
+
+    def height(self, block_hash):
+        """Returns the index of block ``block_hash`` in its chains.
+
+        Raises:
+            KeyError: If the block is not in the DAG.
+        """
+        return self._nodes[block_hash].height
+
+    def ancestor(self, block_hash, height):
+        """Returns the hash of the ancestor of ``block_hash`` at ``height``,
+        or ``None``.
+
+        Raises:
+            KeyError: If the block is not in the DAG.
+        """
+        node = self._nodes[block_hash].ancestor(height)
+        return node.hash if node else None
+
+    def addChain(self, chain):
+        """Adds the blocks of ``chain``, walking back from its tip only to
+        the first block already known. The blocks are not decoded.
+
+        Returns:
+            str: The hash of the tip of ``chain``, or ``None`` if it is
+            empty.
+        """
+        with self._lock:
+            i = len(chain) - 1
+            while i >= 0 and chain._hashAt(i) not in self._nodes:
+                i -= 1
+            if i >= 0 and self._nodes[chain._hashAt(i)].height != i:
+                raise ValueError("Block #{:d} is at height {:d} in the DAG"
+                                 .format(i, self.height(chain._hashAt(i))))
+
+            parent = self._nodes[chain._hashAt(i)] if i >= 0 else None
+            for j in range(i + 1, len(chain)):
+                node = _Node(chain._hashAt(j), parent, chain, j)
+                self._nodes[node.hash] = node
+                if parent is not None:
+                    self._tips.discard(parent.hash)
+                self._tips.add(node.hash)
+                parent = node
+            if i + 1 < len(chain):
+                log.debug("{:d} blocks added to the DAG"
+                          .format(len(chain) - i - 1))
+
+        return parent.hash if parent else None
+
+    def commonAncestor(self, hash1, hash2):
+        """Returns the hash of the last block both ``hash1`` and ``hash2``
+        descend from (or are), or ``None`` if they have different genesis
+        blocks.
+
+        Raises:
+            KeyError: If a block is not in the DAG.
+        """
+        node1, node2 = self._nodes[hash1], self._nodes[hash2]
+        height = min(node1.height, node2.height)
+        node1, node2 = node1.ancestor(height), node2.ancestor(height)
+
+        while node1 is not node2 and node1 is not None:
+            # Ancestors at the same height differ when their skips do.
+            if node1.skip is not node2.skip:
+                node1, node2 = node1.skip, node2.skip
+            else:
+                node1, node2 = node1.parent, node2.parent
+        return node1.hash if node1 else None
+
+    def merge(self, ours, theirs, policy=longestChain):
+        """Reconciles two replicas of a chain. In O(d + log n) for ``d``
+        blocks added since the replicas were last merged (or added).
+
+        When one chain is a prefix of the other the longer one is kept,
+        otherwise ``policy`` chooses, see ``longestChain``.
+
+        Returns:
+            BlockChain: A fork of the chain kept, see ``BlockChain.fork``.
+
+        Raises:
+            ValueError: If the chains do not have the same genesis block.
+        """
+        if len(ours) == 0 or len(theirs) == 0:
+            return (ours if len(theirs) == 0 else theirs).fork()
+
+        our_tip, their_tip = self.addChain(ours), self.addChain(theirs)
+        common = self.commonAncestor(our_tip, their_tip)
+        if common is None:
+            raise ValueError("The chains have different genesis blocks")
+
+        if common == their_tip:
+            merged = ours
+        elif common == our_tip:
+            merged = theirs
+        else:
+            height = self.height(common)
+            log.debug("Chains diverge after block #{:d}: {:d} (ours) and {:d} "
+                      "(theirs) blocks".format(height, len(ours) - height - 1,
+                                               len(theirs) - height - 1))
+            merged = policy(ours, theirs, height)
+        return merged.fork()
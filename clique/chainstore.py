@@ -1,10 +1,24 @@
 # -*- coding: utf-8 -*-
+import os
 import json
-import requests
+import fcntl
+import struct
+import sqlite3
+import threading
+from hashlib import sha256
+from pathlib import Path
+from collections import Counter
+from urllib.parse import urlencode
 from abc import ABCMeta, abstractmethod
 
+import requests
+
 from . import getLogger
-from .blockchain import BlockChain
+from .context import CliqueContext
+from .common import (CLIQUE_D, SqliteDb, httpSession, HTTP_TIMEOUT,
+                     LruCache, CacheInfo, FileCache)
+from .keystore import keystore
+from .blockchain import BlockChain, ChainValidationError, _hash, _kids
 
 log = getLogger(__name__)
 
@@ -44,18 +58,23 @@ class LocalChainStore(ChainStoreABC):
             raise ChainNotFoundError(subject)
 
     def clear(self):
-        self._chains = {}
+        self._chains.clear()
 
 
 _global_chainstore = LocalChainStore()
 
 
 def chainstore():
-    global _global_chainstore
+    """Returns the chain store of the active ``CliqueContext``, or the global
+    one."""
+    ctx = CliqueContext.current()
+    if ctx is not None and ctx.chainstore is not None:
+        return ctx.chainstore
     return _global_chainstore
 
 
 def setChainStore(chainstore):
+    """Sets the global chain store, returns the previous one."""
     global _global_chainstore
     curr = _global_chainstore
     _global_chainstore = chainstore
@@ -63,41 +82,663 @@ def setChainStore(chainstore):
 
 
 class RemoteChainStore(LocalChainStore):
-    def __init__(self, url):
+    def __init__(self, url, session=None, pool_size=10, timeout=None,
+                 capacity=None, negative_ttl=60, cache_dir=None):
+        """
+        Args:
+            url (str): The clique server URL.
+            session (requests.Session): The session requests are made with,
+                by default a new ``common.httpSession(pool_size)``.
+            pool_size (int): Connections kept alive for reuse.
+            timeout: The (connect, read) timeouts, ``common.HTTP_TIMEOUT`` by
+                default.
+            capacity (int): The most chains cached, the least recently used
+                are evicted. ``None`` for no limit.
+            negative_ttl (float): Seconds a chain that was not found is not
+                requested again, 0 to always request.
+            cache_dir (Path): A directory where fetched chains are kept across
+                processes, e.g. ``common.CLIQUE_CACHE_D``. Chains loaded from
+                it are brought up to date with ``refresh``.
+        """
         self._blocks_url = url + "/blocks"
         self._chains_url = url + "/chains"
+        self._session = session or httpSession(pool_size)
+        self._timeout = timeout or HTTP_TIMEOUT
+        self._batch_upload = True
         super().__init__()
+        self._chains = LruCache(capacity)
+        self._not_found = LruCache(capacity, ttl=negative_ttl)
+        self._counts = Counter()
+        self._counts_lock = threading.Lock()
+        self._disk = FileCache(cache_dir) if cache_dir else None
 
-    def _post(self, url, headers=None, json=None):  # pragma: no cover
-        resp = requests.post(url, headers=headers, json=json, timeout=5)
-        return resp
+    def add(self, blockchain):
+        super().add(blockchain)
+        self._not_found.pop(blockchain.subject)
 
-    def _get(self, url, headers=None):  # pragma: no cover
-        resp = requests.get(url, timeout=5)
-        return resp
+    @staticmethod
+    def _subjectFile(subject):
+        return "subjects/" + sha256(subject.encode("utf8")).hexdigest()
 
-    def __getitem__(self, subject):
-        from . import chainFactory
+    def _readIndex(self, subject):
+        """Returns the (genesis hash, tip hash, length, size) of the cached
+        chain ``subject``, or ``None``."""
+        index = self._disk.read(self._subjectFile(subject))
+        try:
+            genesis_hash, tip_hash, length, size = index.split()
+            return genesis_hash, tip_hash, int(length), int(size)
+        except (AttributeError, ValueError):
+            return None
+
+    def _loadCached(self, subject):
+        """Returns the chain ``subject`` from the disk cache, or ``None``.
+        The blocks must link to their antecedents, from the genesis to the tip
+        block in the index.
+
+        The cache holds ``chains/<genesis hash>`` files with a serialized
+        block per line, appended to as the chains grow, and a
+        ``subjects/<sha256 of subject>`` index of their genesis and tip
+        hashes, length and size.
+        """
+        from . import chainType
+
+        if not self._disk:
+            return None
+        index = self._readIndex(subject)
+        if index is None:
+            self._dropCached(subject)
+            return None
+
+        genesis_hash, tip_hash, length, size = index
+        data = self._disk.read("chains/" + genesis_hash, size)
+        blocks = data.splitlines() if data else []
+        chain = None
+        if (len(blocks) == length and _hash(blocks[0]) == genesis_hash and
+                _hash(blocks[-1]) == tip_hash):
+            keystore().prefetch(_kids(blocks))
+            chain = BlockChain.fromSerializedBlocks(blocks,
+                                                    chain_type=chainType,
+                                                    lazy=False)
+            if (getattr(chain, "subject", None) != subject or
+                    any(chain[i].antecedent != _hash(blocks[i - 1])
+                        for i in range(1, len(blocks)))):
+                chain = None
+
+        if chain is None:
+            log.warning("Removing corrupt cached chain " + subject)
+            self._dropCached(subject)
+        return chain
+
+    def _saveCached(self, chain):
+        """Appends the blocks of ``chain`` that are not cached yet, the whole
+        chain is only written when the cached one is not a prefix of it."""
+        if not self._disk:
+            return
 
+        genesis_hash, tip_hash = chain._hashAt(0), chain._hashAt(-1)
+        index = self._readIndex(chain.subject)
+        start, offset = 0, 0
+        if index is not None:
+            old_genesis, old_tip, old_length, old_size = index
+            if old_genesis != genesis_hash:
+                self._disk.remove("chains/" + old_genesis)
+            elif (old_length <= len(chain) and
+                    chain._hashAt(old_length - 1) == old_tip):
+                start, offset = old_length, old_size
+        if start == len(chain):
+            return
+
+        size = self._disk.append(
+                "chains/" + genesis_hash,
+                "".join(chain._serializationAt(i) + "\n"
+                        for i in range(start, len(chain))),
+                offset)
+        self._disk.write(self._subjectFile(chain.subject),
+                         "{} {} {:d} {:d}".format(genesis_hash, tip_hash,
+                                                  len(chain), size))
+
+    def _dropCached(self, subject):
+        if not self._disk:
+            return
+
+        index = self._readIndex(subject)
+        self._disk.remove(self._subjectFile(subject))
+        if index:
+            self._disk.remove("chains/" + index[0])
+
+    def _count(self, **counts):
+        with self._counts_lock:
+            self._counts.update(counts)
+
+    def cacheInfo(self):
+        """Returns the ``common.CacheInfo`` of the chain cache."""
+        return CacheInfo(self._counts["hits"], self._counts["misses"],
+                         self._counts["negative_hits"], len(self._chains),
+                         self._chains.capacity)
+
+    def _post(self, url, headers=None, json=None, data=None):
+        return self._session.post(url, headers=headers, json=json, data=data,
+                                  timeout=self._timeout)
+
+    def _get(self, url, headers=None):
+        return self._session.get(url, headers=headers, timeout=self._timeout)
+
+    def close(self):
+        self._session.close()
+
+    def __getitem__(self, subject):
         try:
-            return super().__getitem__(subject)
+            chain = super().__getitem__(subject)
+            self._count(hits=1)
+            return chain
         except ChainNotFoundError:
+            if subject in self._not_found:
+                self._count(negative_hits=1)
+                raise
+            self._count(misses=1)
+            chain = self._loadCached(subject)
+            if chain is not None:
+                self.add(chain)
+                return self.refresh(subject)
+
             resp = self._get(self._chains_url + "/" + subject)
             if resp.status_code != 200:
                 log.error(resp)
+                # Other errors could be transient, only a missing chain is
+                # remembered.
+                if resp.status_code == 404:
+                    self._not_found[subject] = True
                 raise
 
-            chain_data = json.dumps(resp.json())
-            chain = BlockChain.deserialize(chain_data, factory=chainFactory)
-            self.add(chain)
-            return chain
+            return self._addSerialized(resp.json())
 
-    def upload(self, chain):
-        headers = {"content-type": "application/jose"}
-        for block in chain:
-            resp = self._post(self._blocks_url, headers=headers,
-                              data=block.serialize())
-            if resp.status_code != 201:
+    def refresh(self, subject):
+        """Brings the stored chain ``subject`` up to date with the server and
+        returns it.
+
+        Only the blocks after the stored tip are requested, with
+        ``GET <chains>/<subject>?since=<tip hash>``, validated and appended;
+        the validated prefix is not validated again. The whole chain is
+        fetched if it is not stored, or the server does not know the tip. A
+        whole chain replaces the stored one only once it is validated, from
+        the stored genesis block.
+
+        Raises:
+            ChainNotFoundError: If the server does not have the chain (it is
+                removed from the store), or could not be fetched.
+            ChainValidationError: If the new blocks (or the replacement chain)
+                do not validate (or ``InvalidJWSSignature``), the stored chain
+                is unchanged.
+        """
+        chain = self._chains.get(subject)
+        if chain is None:
+            return self[subject]
+
+        tip_hash = chain._hashAt(-1)
+        resp = self._get("{}/{}?{}".format(self._chains_url, subject,
+                                           urlencode({"since": tip_hash})))
+        if resp.status_code != 200:
+            log.warning("Refetching {}, tip {} not found ({:d})"
+                        .format(subject, tip_hash, resp.status_code))
+            resp = self._get(self._chains_url + "/" + subject)
+            if resp.status_code == 404:
+                self._chains.pop(subject)
+                self._dropCached(subject)
+            if resp.status_code != 200:
                 log.error(resp)
-                raise requests.RequestException(response=resp)
+                raise ChainNotFoundError(subject)
+            return self._replace(chain, resp.json())
+
+        blocks = resp.json()
+        if blocks and _hash(blocks[0]) == chain._hashAt(0):
+            # The server sent the whole chain.
+            if (len(blocks) < len(chain) or
+                    _hash(blocks[len(chain) - 1]) != tip_hash):
+                log.warning("Replacing {}, the stored chain is not a prefix"
+                            .format(subject))
+                return self._replace(chain, blocks)
+            blocks = blocks[len(chain):]
+
+        if not blocks:
+            return chain
+
+        keystore().prefetch(_kids(blocks))
+        chain._appendValidated(
+                [chain.BlockType._fromSerialization(serialized, chain)
+                 for serialized in blocks],
+                chain._hashAt(0))
+        self._saveCached(chain)
+        return chain
+
+    def _replace(self, chain, blocks):
+        """Replaces the stored ``chain`` with the serialized ``blocks`` once
+        they validate from its genesis block."""
+        from . import chainFactory
+
+        if not blocks or _hash(blocks[0]) != chain._hashAt(0):
+            raise ChainValidationError("Genesis hash mismatch for " +
+                                       chain.subject)
+        replacement = BlockChain.deserialize(json.dumps(blocks),
+                                             factory=chainFactory,
+                                             prefetch=True)
+        replacement.validate(chain._hashAt(0))
+        self._chains.pop(chain.subject)
+        self.add(replacement)
+        self._saveCached(replacement)
+        return replacement
+
+    def _addSerialized(self, blocks):
+        from . import chainFactory
+
+        chain = BlockChain.deserialize(json.dumps(blocks),
+                                       factory=chainFactory, prefetch=True)
         self.add(chain)
+        self._saveCached(chain)
+        return chain
+
+    def upload(self, chain, batch_size=1):
+        """Uploads the blocks of ``chain`` and adds it to the store.
+
+        Args:
+            chain (BlockChain): The chain.
+            batch_size (int): The most blocks sent per request, as a JSON list.
+                Blocks are sent one at a time if the server does not accept
+                lists.
+
+        Raises:
+            BlockUploadError: For the blocks the server rejected, blocks after
+                them are not sent.
+        """
+        i = 0
+        while i < len(chain):
+            if batch_size > 1 and self._batch_upload:
+                end = min(i + batch_size, len(chain))
+                if self._uploadBatch(chain, i, end):
+                    i = end
+                    continue
+            self._uploadBlock(chain, i)
+            i += 1
+        self.add(chain)
+
+    def _uploadBlock(self, chain, i):
+        resp = self._post(self._blocks_url,
+                          headers={"content-type": "application/jose"},
+                          data=chain._serializationAt(i))
+        if resp.status_code != 201:
+            log.error(resp)
+            raise BlockUploadError([(i, resp.status_code, None)],
+                                   response=resp)
+
+    def _uploadBatch(self, chain, start, end):
+        """Uploads blocks ``start`` to ``end``, returns ``False`` if the server
+        does not support batches."""
+        resp = self._post(self._blocks_url,
+                          headers={"content-type": "application/json"},
+                          json=[chain._serializationAt(i)
+                                for i in range(start, end)])
+        if resp.status_code in (404, 405, 415):
+            log.info("Batch upload not supported by {}"
+                     .format(self._blocks_url))
+            self._batch_upload = False
+            return False
+        elif resp.status_code != 201:
+            log.error(resp)
+            try:
+                failures = [(start + i, r.get("status"), r.get("error"))
+                            for i, r in enumerate(resp.json())
+                            if r.get("status") != 201]
+            except (ValueError, TypeError, AttributeError):
+                failures = None
+            raise BlockUploadError(failures or [(i, resp.status_code, None)
+                                                for i in range(start, end)],
+                                   response=resp)
+        return True
+
+
+class BlockUploadError(requests.RequestException):
+    """Raised when the server rejects uploaded blocks.
+
+    Attributes:
+        failures: A list of ``(index, status_code, error)`` for each rejected
+            block, ``error`` is the server message or ``None``.
+    """
+    def __init__(self, failures, **kwargs):
+        self.failures = failures
+        super().__init__("{:d} block(s) rejected, first #{:d}"
+                         .format(len(failures), failures[0][0]), **kwargs)
+
+
+class _ChainLog(object):
+    """An append-only file of serialized blocks, one per line, and a sidecar
+    index with the offset, length and hash of each block.
+
+    This is the sequence of serialized blocks of a lazy chain, the index is
+    kept in memory so reading a block is a single seek into the log.
+    """
+    _RECORD = struct.Struct(">QI32s")
+
+    def __init__(self, log_path, index_path):
+        self._log_path = log_path
+        self._index_path = index_path
+        self._lock = threading.Lock()
+
+        self._writer = open(str(log_path), "ab")
+        self._reader = open(str(log_path), "rb")
+        self._index_writer = open(str(index_path), "ab")
+        # Not while another writer is between writing a block and its index
+        # record.
+        fcntl.flock(self._writer, fcntl.LOCK_EX)
+        try:
+            index = index_path.read_bytes()
+            self._index = bytearray(index[:len(index) -
+                                           len(index) % self._RECORD.size])
+            self._repair()
+        finally:
+            fcntl.flock(self._writer, fcntl.LOCK_UN)
+
+    def _repair(self):
+        """Drops index records and log data an interrupted append left. The
+        log file is locked."""
+        log_size = self._log_path.stat().st_size
+        index_size = len(self._index)
+        while len(self):
+            offset, length, _ = self._record(len(self) - 1)
+            if offset + length + 1 <= log_size:
+                break
+            del self._index[-self._RECORD.size:]
+
+        end = 0
+        if len(self):
+            offset, length, _ = self._record(len(self) - 1)
+            end = offset + length + 1
+        if log_size > end:
+            log.warning("Truncating {} to {:d} bytes"
+                        .format(self._log_path, end))
+            with open(str(self._log_path), "r+b") as fp:
+                fp.truncate(end)
+        if (self._index_path.stat().st_size != index_size or
+                len(self._index) != index_size):
+            # The records kept are a prefix of the file.
+            os.truncate(str(self._index_path), len(self._index))
+
+    def _record(self, i):
+        return self._RECORD.unpack_from(self._index, i * self._RECORD.size)
+
+    def __len__(self):
+        return len(self._index) // self._RECORD.size
+
+    def __getitem__(self, i):
+        i = range(len(self))[i]
+        offset, length, digest = self._record(i)
+        with self._lock:
+            self._reader.seek(offset)
+            data = self._reader.read(length)
+        if sha256(data).digest() != digest:
+            raise ValueError("Corrupt block #{:d} in {}"
+                             .format(i, self._log_path))
+        return data.decode("utf8")
+
+    def hashAt(self, i):
+        return self._record(range(len(self))[i])[2].hex()
+
+    def _syncIndex(self):
+        """Reads the index records appended by other writers."""
+        size = os.fstat(self._index_writer.fileno()).st_size
+        size -= size % self._RECORD.size
+        if size > len(self._index):
+            with open(str(self._index_path), "rb") as fp:
+                fp.seek(len(self._index))
+                self._index += fp.read(size - len(self._index))
+
+    def append(self, serialized, antecedent):
+        """Appends a serialized block, if the hash of the tip block is
+        ``antecedent`` (``None`` for an empty log). Writers, in this or other
+        processes, hold a lock on the log file while appending.
+
+        Raises:
+            ValueError: If the block does not follow the tip block.
+        """
+        data = serialized.encode("utf8")
+        with self._lock:
+            fcntl.flock(self._writer, fcntl.LOCK_EX)
+            try:
+                self._syncIndex()
+                tip_hash = self.hashAt(-1) if len(self) else None
+                if antecedent != tip_hash:
+                    raise ValueError("Block does not follow the tip of {}"
+                                     .format(self._log_path))
+                # Not tell(), the file may have grown since it was opened.
+                offset = os.fstat(self._writer.fileno()).st_size
+                self._writer.write(data + b"\n")
+                self._writer.flush()
+                record = self._RECORD.pack(offset, len(data),
+                                           sha256(data).digest())
+                self._index_writer.write(record)
+                self._index_writer.flush()
+                self._index += record
+            finally:
+                fcntl.flock(self._writer, fcntl.LOCK_UN)
+
+    def close(self):
+        for fp in (self._reader, self._writer, self._index_writer):
+            fp.close()
+
+
+class FileChainStore(ChainStoreABC):
+    """A chain store with an append-only log file (see ``_ChainLog``) per
+    chain under ``path``, ``CLIQUE_D/chains`` by default.
+
+    Chains are opened lazily, blocks are read from disk when first accessed.
+    """
+    def __init__(self, path=None):
+        self._path = Path(path) if path else CLIQUE_D / "chains"
+        self._path.mkdir(parents=True, exist_ok=True)
+        self._logs = {}
+        self._chains = {}
+
+    def _paths(self, subject):
+        name = sha256(subject.encode("utf8")).hexdigest()
+        return self._path / (name + ".log"), self._path / (name + ".idx")
+
+    def _log(self, subject, create=False):
+        if subject not in self._logs:
+            log_path, index_path = self._paths(subject)
+            if not create and not log_path.exists():
+                raise ChainNotFoundError(subject)
+            self._logs[subject] = _ChainLog(log_path, index_path)
+        return self._logs[subject]
+
+    def __contains__(self, subject):
+        return subject in self._logs or self._paths(subject)[0].exists()
+
+    def add(self, blockchain):
+        subject = blockchain.subject
+        if subject in self:
+            raise ValueError("Chain {} already set".format(subject))
+
+        chain_log = self._log(subject, create=True)
+        for i in range(len(blockchain)):
+            chain_log.append(blockchain._serializationAt(i),
+                             blockchain._hashAt(i - 1) if i else None)
+        self._chains[subject] = blockchain
+
+    def append(self, subject, block):
+        """Appends ``block`` to the stored chain ``subject``, and to the chain
+        object returned by the store if it is not already its tip.
+
+        Raises:
+            ChainNotFoundError: If there is no chain ``subject``.
+            ValueError: If ``block`` does not follow the stored tip block.
+        """
+        chain_log = self._log(subject)
+        # Checked under the log lock, another writer may have appended.
+        try:
+            chain_log.append(block.serialize(), block.antecedent)
+        except ValueError:
+            raise ValueError("Block does not follow the tip of {}"
+                             .format(subject))
+
+        chain = self._chains.get(subject)
+        if chain is not None and (not len(chain) or chain[-1] is not block):
+            chain._appendBlock(block)
+
+    def __getitem__(self, subject):
+        from . import chainType
+
+        if subject not in self._chains:
+            self._chains[subject] = BlockChain.fromSerializedBlocks(
+                    self._log(subject), chain_type=chainType)
+        return self._chains[subject]
+
+    def close(self):
+        for chain_log in self._logs.values():
+            chain_log.close()
+        self._logs = {}
+        self._chains = {}
+
+
+class _SqliteBlocks(object):
+    """The serialized blocks of a chain in a ``SqliteChainStore``, the
+    sequence a lazy chain decodes its blocks from."""
+    def __init__(self, db, subject, length):
+        self._db = db
+        self._subject = subject
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, i):
+        i = range(self._length)[i]
+        row = self._db.execute("SELECT serialization FROM blocks "
+                               "WHERE subject = ? AND height = ?",
+                               (self._subject, i)).fetchone()
+        if row is None:
+            raise IndexError("Block #{:d} of {} not found"
+                             .format(i, self._subject))
+        return row[0]
+
+
+class SqliteChainStore(ChainStoreABC):
+    """A chain store persisted in a SQLite database (see ``common.SqliteDb``)
+    that processes can share. Chains are looked up by subject, genesis block
+    hash or tip block hash, and opened lazily.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chains (
+            subject TEXT PRIMARY KEY,
+            genesis_hash TEXT NOT NULL UNIQUE,
+            tip_hash TEXT NOT NULL,
+            length INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS chains_tip_hash ON chains (tip_hash);
+        CREATE TABLE IF NOT EXISTS blocks (
+            subject TEXT NOT NULL,
+            height INTEGER NOT NULL,
+            serialization TEXT NOT NULL,
+            PRIMARY KEY (subject, height)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path (Path): The database file, ``common.CLIQUE_DB`` by default.
+        """
+        self._db = SqliteDb(path, self.SCHEMA)
+        self._chains = {}
+
+    def __contains__(self, subject):
+        return subject in self._chains or self._db.execute(
+                "SELECT 1 FROM chains WHERE subject = ?",
+                (subject,)).fetchone() is not None
+
+    def add(self, blockchain):
+        subject = blockchain.subject
+        if not len(blockchain):
+            raise ValueError("Chain {} has no blocks".format(subject))
+
+        conn = self._db.connection
+        try:
+            with conn:
+                conn.execute("INSERT INTO chains VALUES (?, ?, ?, ?)",
+                             (subject, blockchain._hashAt(0),
+                              blockchain._hashAt(-1), len(blockchain)))
+                conn.executemany("INSERT INTO blocks VALUES (?, ?, ?)",
+                                 ((subject, i, blockchain._serializationAt(i))
+                                  for i in range(len(blockchain))))
+        except sqlite3.IntegrityError:
+            raise ValueError("Chain {} already set".format(subject))
+        self._chains[subject] = blockchain
+
+    def append(self, subject, block):
+        """Appends ``block`` to the stored chain ``subject``, and to the chain
+        object returned by the store if it is not already its tip.
+
+        Raises:
+            ChainNotFoundError: If there is no chain ``subject``.
+            ValueError: If ``block`` does not follow the stored tip block.
+        """
+        conn = self._db.connection
+        with conn:
+            # The conditional update makes the check and append atomic with
+            # respect to other writers.
+            length = self._length(subject, conn)
+            updated = conn.execute("UPDATE chains SET tip_hash = ?, "
+                                   "length = length + 1 WHERE subject = ? "
+                                   "AND tip_hash = ? AND length = ?",
+                                   (block.hash, subject, block.antecedent,
+                                    length)).rowcount
+            if not updated:
+                raise ValueError("Block does not follow the tip of {}"
+                                 .format(subject))
+            conn.execute("INSERT INTO blocks VALUES (?, ?, ?)",
+                         (subject, length, block.serialize()))
+
+        chain = self._chains.get(subject)
+        if chain is not None and (not len(chain) or chain[-1] is not block):
+            chain._appendBlock(block)
+
+    def _length(self, subject, conn=None):
+        row = (conn or self._db.connection).execute(
+                "SELECT length FROM chains WHERE subject = ?",
+                (subject,)).fetchone()
+        if row is None:
+            raise ChainNotFoundError(subject)
+        return row[0]
+
+    def __getitem__(self, subject):
+        from . import chainType
+
+        if subject not in self._chains:
+            blocks = _SqliteBlocks(self._db, subject, self._length(subject))
+            self._chains[subject] = BlockChain.fromSerializedBlocks(
+                    blocks, chain_type=chainType)
+        return self._chains[subject]
+
+    def _getBy(self, column, block_hash):
+        row = self._db.execute("SELECT subject FROM chains WHERE {} = ?"
+                               .format(column), (block_hash,)).fetchone()
+        if row is None:
+            raise ChainNotFoundError(block_hash)
+        return self[row[0]]
+
+    def getByGenesis(self, genesis_hash):
+        """Returns the chain with genesis block hash ``genesis_hash``.
+
+        Raises:
+            ChainNotFoundError: If there is no such chain.
+        """
+        return self._getBy("genesis_hash", genesis_hash)
+
+    def getByTip(self, tip_hash):
+        """Returns the chain whose last block has the hash ``tip_hash``.
+
+        Raises:
+            ChainNotFoundError: If there is no such chain.
+        """
+        return self._getBy("tip_hash", tip_hash)
+
+    def close(self):
+        self._db.close()
+        self._chains = {}
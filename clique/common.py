@@ -1,16 +1,33 @@
 # -*- coding: utf-8 -*-
+import os
 import json
+import fcntl
+import time
+import sqlite3
+import weakref
+import threading
 import urllib.parse
 from pathlib import Path
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 
 from jwcrypto.jwk import JWK
-from jwcrypto.common import base64url_encode, json_encode, json_decode
+from jwcrypto.jwa import JWA
+from jwcrypto.jws import (InvalidJWSObject, InvalidJWSSignature,
+                          default_allowed_algs)
+from jwcrypto.common import (base64url_encode, base64url_decode, json_encode,
+                             json_decode)
+
+import requests
+from requests.adapters import HTTPAdapter
 
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.backends import default_backend
 
 CLIQUE_D = Path("~/.clique").expanduser()
+CLIQUE_DB = CLIQUE_D / "clique.db"
+CLIQUE_CACHE_D = CLIQUE_D / "cache"
+# (connect, read) timeouts, in seconds, for requests to a clique server.
+HTTP_TIMEOUT = (5, 5)
 
 
 class Uri(urllib.parse.ParseResult):
@@ -54,18 +71,99 @@ class JsonType(object):
         raise NotImplementedError()
 
 
+# Maps JWK objects to (key material, digest, base64 digest) tuples.
+_thumbprint_cache = weakref.WeakKeyDictionary()
+
+
+def _thumbprintMaterial(jwk):
+    """Returns the public key values a thumbprint is computed from, or ``None``
+    if they cannot be read without an export."""
+    try:
+        return (jwk._params["kty"], jwk._key["crv"], jwk._key["x"],
+                jwk._key["y"])
+    except (AttributeError, KeyError, TypeError):
+        return None
+
+
 def thumbprint(jwk, base64=True):
-    """Compute a digital thumbprint for the key ``jwk``."""
-    key_dict = json.loads(jwk.export_public())
-    d = OrderedDict()
-    for k in ["crv", "kty", "x", "y"]:
-        d[k] = key_dict[k]
+    """Compute a digital thumbprint for the key ``jwk``.
+
+    Thumbprints are cached per key object, the cached value is dropped when
+    the public key values change (e.g. ``JWK.import_key``).
+    """
+    material = _thumbprintMaterial(jwk)
+    cached = _thumbprint_cache.get(jwk) if material else None
+    if cached is None or cached[0] != material:
+        key_dict = json.loads(jwk.export_public())
+        d = OrderedDict()
+        for k in ["crv", "kty", "x", "y"]:
+            d[k] = key_dict[k]
 
-    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-    digest.update(json.dumps(d, separators=(',', ':')).encode("utf8"))
-    tp = digest.finalize()
+        digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
+        digest.update(json.dumps(d, separators=(',', ':')).encode("utf8"))
+        tp = digest.finalize()
+        cached = (material, tp, base64url_encode(tp))
+        if material:
+            _thumbprint_cache[jwk] = cached
 
-    return base64url_encode(tp) if base64 else tp
+    return cached[2] if base64 else cached[1]
+
+
+def thumbprints(keys, base64=True):
+    """Returns a list of the thumbprints of ``keys``, in order."""
+    return [thumbprint(k, base64=base64) for k in keys]
+
+
+class CompactJws(object):
+    """A compact serialized JWS, parsed once so that it can be verified any
+    number of times without decoding the base64 and JSON again."""
+
+    def __init__(self, serialization):
+        """
+        Args:
+            serialization (str): The compact JWS.
+
+        Raises:
+            InvalidJWSObject: If ``serialization`` is not a compact JWS.
+        """
+        try:
+            protected, payload, signature = serialization.split(".")
+            self.header = json_decode(base64url_decode(protected))
+            self.payload = base64url_decode(payload)
+            self.signature = base64url_decode(signature)
+        except Exception as ex:
+            raise InvalidJWSObject("Invalid compact JWS", ex)
+        if not isinstance(self.header, dict):
+            raise InvalidJWSObject("Invalid protected header")
+
+        self.serialization = serialization
+        self.signing_input = serialization.rsplit(".", 1)[0].encode("utf8")
+
+    @property
+    def kid(self):
+        return self.header.get("kid")
+
+    @property
+    def alg(self):
+        return self.header.get("alg")
+
+    def verify(self, key):
+        """Verify the signature with ``key``.
+
+        Raises:
+            InvalidJWSSignature: If the signature does not verify.
+        """
+        if self.alg not in default_allowed_algs:
+            raise InvalidJWSSignature("Algorithm not allowed: {}"
+                                      .format(self.alg))
+        if "crit" in self.header:
+            raise InvalidJWSSignature("Unsupported critical header")
+
+        try:
+            JWA.signing_alg(self.alg).verify(key, self.signing_input,
+                                             self.signature)
+        except Exception as ex:
+            raise InvalidJWSSignature("Verification failed", repr(ex))
 
 
 def newJwk(**key_args):
@@ -220,3 +318,197 @@ class Identity(JsonType):
                 else:
                     raise ValueError("Key set values require a private key")
         return ident
+
+
+class SqliteDb(object):
+    """A SQLite database shared by processes, in WAL mode so readers do not
+    block the writer. Each thread gets its own connection.
+    """
+    def __init__(self, path=None, schema=""):
+        """
+        Args:
+            path (Path): The database file, ``CLIQUE_DB`` by default.
+            schema (str): SQL script run on each new connection, it should
+                only create tables and indexes that do not exist.
+        """
+        self.path = Path(path) if path else CLIQUE_DB
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._schema = schema
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    @property
+    def connection(self):
+        conn = getattr(self._local, "connection", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=30,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                conn.executescript(self._schema)
+            self._local.connection = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def execute(self, sql, params=()):
+        """Runs ``sql`` in its own transaction and returns the cursor."""
+        conn = self.connection
+        with conn:
+            return conn.execute(sql, params)
+
+    def close(self):
+        """Closes the connections of all threads."""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+def httpSession(pool_size=10, max_retries=0):
+    """Returns a ``requests.Session`` that keeps up to ``pool_size``
+    connections per host alive for reuse.
+
+    Args:
+        pool_size (int): Connections kept per host, and the number of hosts
+            with pooled connections.
+        max_retries (int): Retries for failed connections (not requests).
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=max_retries)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class LruCache(object):
+    """A thread safe mapping of at most ``capacity`` items, the least recently
+    used are evicted. Items expire ``ttl`` seconds after they are set.
+    """
+    def __init__(self, capacity=None, ttl=None):
+        """
+        Args:
+            capacity (int): The most items, ``None`` for no limit.
+            ttl (float): Seconds items are kept, ``None`` for no limit.
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        with self._lock:
+            value, expires = self._items[key]
+            if expires is not None and expires <= time.monotonic():
+                del self._items[key]
+                raise KeyError(key)
+            self._items.move_to_end(key)
+            return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._items[key] = (value, expires)
+            self._items.move_to_end(key)
+            while (self.capacity is not None and
+                    len(self._items) > self.capacity):
+                self._items.popitem(last=False)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._items[key]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._items.pop(key, (default, None))[0]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        with self._lock:
+            keys = list(self._items)
+        return iter(keys)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+CacheInfo = namedtuple("CacheInfo",
+                       "hits, misses, negative_hits, size, capacity")
+CacheInfo.__doc__ = """Remote store cache statistics. ``misses`` are lookups
+that requested the server, ``negative_hits`` lookups of ids recently not found
+that did not."""
+
+
+class FileCache(object):
+    """Text files, by name, under a directory. Files are replaced atomically
+    so concurrent readers see either the old or the new content, or appended
+    to under a lock."""
+    def __init__(self, path=None):
+        """
+        Args:
+            path (Path): The directory, ``CLIQUE_CACHE_D`` by default.
+        """
+        self.path = Path(path) if path else CLIQUE_CACHE_D
+
+    def read(self, name, size=None):
+        """Returns the content of file ``name``, or its first ``size`` bytes,
+        or ``None``."""
+        try:
+            with open(str(self.path / name), "rb") as fp:
+                return fp.read(-1 if size is None else size).decode("utf8")
+        except FileNotFoundError:
+            return None
+
+    def write(self, name, data):
+        path = self.path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name("{}.{:d}.{:d}.tmp".format(
+                path.name, os.getpid(), threading.get_ident()))
+        tmp.write_text(data, "utf8")
+        os.replace(str(tmp), str(path))
+
+    def append(self, name, data, offset=0):
+        """Writes ``data`` to file ``name`` after its first ``offset`` bytes,
+        anything past them (e.g. a partial write) is dropped. The file is
+        locked, across processes, while written.
+
+        Returns:
+            int: The file size.
+        """
+        path = self.path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(path), "ab") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                fp.truncate(offset)
+                fp.write(data.encode("utf8"))
+                fp.flush()
+                return fp.tell()
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def remove(self, name):
+        try:
+            (self.path / name).unlink()
+        except FileNotFoundError:
+            pass
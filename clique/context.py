@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Context-local key and chain stores.
+
+``keystore()`` and ``chainstore()`` return the stores of the active
+``CliqueContext`` of the current thread or asyncio task, or the process-wide
+stores set with ``setKeyStore``/``setChainStore``. Threads and tasks can thus
+use separate stores without locking the globals.
+"""
+import contextvars
+
+_active = contextvars.ContextVar("clique_context", default=None)
+# The tokens to restore ``_active`` on exit, per thread/task.
+_tokens = contextvars.ContextVar("clique_context_tokens", default=())
+
+
+class CliqueContext(object):
+    """A key store and chain store, used while the context is active::
+
+        tenant = CliqueContext(keystore=ks, chainstore=cs)
+        with tenant:
+            chain.validate(genesis_hash)
+
+    The same context can be active in several threads or tasks at once.
+    Stores that are not given are those of the enclosing context, if any, when
+    entered.
+    """
+    def __init__(self, keystore=None, chainstore=None):
+        self.keystore = keystore
+        self.chainstore = chainstore
+
+    @classmethod
+    def forServer(Cls, url, **kwargs):
+        """Returns a context with remote stores for the clique server at
+        ``url``, see ``clique.useCliqueServer``."""
+        from . import remoteStores
+        return Cls(*remoteStores(url, **kwargs))
+
+    @staticmethod
+    def current():
+        """Returns the active ``CliqueContext``, or ``None``."""
+        return _active.get()
+
+    def __enter__(self):
+        ctx = self
+        outer = _active.get()
+        if outer is not None and (self.keystore is None or
+                                  self.chainstore is None):
+            ctx = CliqueContext(self.keystore or outer.keystore,
+                                self.chainstore or outer.chainstore)
+        _tokens.set(_tokens.get() + (_active.set(ctx),))
+        return self
+
+    def __exit__(self, *_):
+        tokens = _tokens.get()
+        _tokens.set(tokens[:-1])
+        _active.reset(tokens[-1])
+
+
+def bindContext(func):
+    """Returns ``func`` bound to a copy of the current context, to run in other
+    threads (e.g. an executor) with the same active ``CliqueContext``."""
+    ctx = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # A context can only be entered by one thread at a time.
+        return ctx.copy().run(func, *args, **kwargs)
+    return run
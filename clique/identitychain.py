@@ -1,6 +1,4 @@
 # -*- coding: utf-8 -*-
-from jwcrypto.jws import JWS
-
 from .common import thumbprint, Identity
 from .keystore import keystore
 from .blockchain import BlockChain
@@ -35,12 +33,10 @@ class Block(BaseBlock):
             # Special cased to bootstrap data structures
             cvs.ratchet(self)
 
-        jws = JWS()
-        jws.deserialize(self.serialize())
-        tprint = jws.jose_header["kid"]
+        tprint = self.jws.kid
         if (cvs.antecedent.pkt == tprint):
-            key = keystore()[tprint]
-            jws.verify(key)
+            # The key of tprint, unless the block is already verified.
+            cvs.verify(self)
         else:
             # XXX: This case is only revavent on the GodBlock
             # TODO: support cases where block isn't signed by preceding key
@@ -103,6 +99,13 @@ class Chain(BlockChain):
     def _newBlock(self, block):
         self._pkt_order[block.pkt] = len(self._pkt_order)
 
+    def _unshare(self):
+        super()._unshare()
+        pkt_order = {}
+        for i in range(self._hooked):
+            pkt_order[self._block(i).pkt] = len(pkt_order)
+        self._pkt_order = pkt_order
+
     @property
     def subject(self):
         return self.genesis_block.subject
@@ -113,10 +116,12 @@ class Chain(BlockChain):
 
     # FIXME: this method name
     def isSameOrSubsequent(self, tp1, tp2):
+        self._runHooks()
         return self._pkt_order[tp1] >= self._pkt_order[tp2]
 
     def addBlock(self, identity, *args, **kwargs):
-        block = super().addBlock(identity, *args, **kwargs)
-        assert(block.pkt)
-        self._pkt_order[block.pkt] = len(self._pkt_order)
+        with self._lock:
+            block = super().addBlock(identity, *args, **kwargs)
+            assert(block.pkt)
+            self._pkt_order[block.pkt] = len(self._pkt_order)
         return block
@@ -1,13 +1,27 @@
 # -*- coding: utf-8 -*-
+import re
 import json
+import threading
 import requests
 from abc import ABCMeta, abstractmethod
+from collections import OrderedDict, Counter
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+from jwcrypto.jwk import JWK
+from jwcrypto.common import JWException
 
 from . import getLogger
-from .common import thumbprint, newJwk
+from .context import CliqueContext, bindContext
+from .common import (thumbprint, newJwk, OrderedKeySet, SqliteDb,
+                     httpSession, HTTP_TIMEOUT, LruCache, CacheInfo,
+                     FileCache)
 
 log = getLogger(__name__)
 
+# A base64url SHA-256 key thumbprint, see ``common.thumbprint``.
+_THUMBPRINT_RE = re.compile(r"^[A-Za-z0-9_-]{43}$")
+
 
 class KeyNotFoundError(Exception):
     def __str__(self):
@@ -27,6 +41,36 @@ class KeyStoreABC(metaclass=ABCMeta):
     def upload(self, jwk):
         self.add(jwk)
 
+    def getMany(self, thumbprints, workers=None):
+        """Returns an ``OrderedKeySet`` of the keys ``thumbprints`` that are
+        found. Stores that fetch keys remotely do so in bulk or concurrently,
+        with up to ``workers`` threads.
+        """
+        keys = OrderedKeySet()
+        for tp in thumbprints:
+            try:
+                keys.add(self[tp])
+            except KeyNotFoundError:
+                pass
+        return keys
+
+    def uploadMany(self, jwks):
+        """Uploads ``jwks``, returns their thumbprints."""
+        for jwk in jwks:
+            self.upload(jwk)
+        return [thumbprint(jwk) for jwk in jwks]
+
+    def prefetch(self, thumbprints, workers=None):
+        """Resolves the keys ``thumbprints`` ahead of their use, see
+        ``getMany``.
+
+        Returns:
+            list: The thumbprints of the keys that were not found.
+        """
+        keys = self.getMany(thumbprints, workers=workers)
+        return [tp for tp in OrderedDict.fromkeys(thumbprints)
+                if tp not in keys]
+
 
 class LocalKeyStore(KeyStoreABC):
     def __init__(self):
@@ -45,16 +89,83 @@ class LocalKeyStore(KeyStoreABC):
     def __contains__(self, tp):
         return tp in self._keys
 
+    @staticmethod
+    def _jwk(key_args):
+        """Returns a JWK of ``key_args``, with its thumbprint as ``kid``. Unlike
+        ``newJwk`` it is not added to a key store."""
+        jwk = JWK(**key_args)
+        jwk._params["kid"] = thumbprint(jwk)
+        return jwk
+
+
+class SqliteKeyStore(LocalKeyStore):
+    """A key store persisted in a SQLite database (see ``common.SqliteDb``)
+    that processes can share, keys are looked up by thumbprint.
+
+    Only public keys are written to the database, private keys added to the
+    store are kept in memory.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS keys (
+            thumbprint TEXT PRIMARY KEY,
+            jwk TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path=None):
+        """
+        Args:
+            path (Path): The database file, ``common.CLIQUE_DB`` by default.
+        """
+        self._db = SqliteDb(path, self.SCHEMA)
+        super().__init__()
+
+    def add(self, jwk):
+        super().add(jwk)
+        self._db.execute("INSERT OR IGNORE INTO keys VALUES (?, ?)",
+                         (thumbprint(jwk), jwk.export_public()))
+
+    def __getitem__(self, tp):
+        try:
+            return super().__getitem__(tp)
+        except KeyNotFoundError:
+            row = self._db.execute("SELECT jwk FROM keys WHERE thumbprint = ?",
+                                   (tp,)).fetchone()
+            if row is None:
+                raise
+            try:
+                jwk = self._jwk(json.loads(row[0]))
+            except (ValueError, TypeError, JWException):
+                jwk = None
+            if jwk is None or thumbprint(jwk) != tp:
+                log.warning("Ignoring corrupt stored key " + tp)
+                raise
+            self._keys[tp] = jwk
+            return jwk
+
+    def __contains__(self, tp):
+        return super().__contains__(tp) or self._db.execute(
+                "SELECT 1 FROM keys WHERE thumbprint = ?",
+                (tp,)).fetchone() is not None
+
+    def close(self):
+        self._db.close()
+
 
 _global_keystore = LocalKeyStore()
 
 
 def keystore():
-    global _global_keystore
+    """Returns the key store of the active ``CliqueContext``, or the global
+    one."""
+    ctx = CliqueContext.current()
+    if ctx is not None and ctx.keystore is not None:
+        return ctx.keystore
     return _global_keystore
 
 
 def setKeyStore(keystore):
+    """Sets the global key store, returns the previous one."""
     global _global_keystore
     curr = _global_keystore
     _global_keystore = keystore
@@ -62,21 +173,204 @@ def setKeyStore(keystore):
 
 
 class RemoteKeyStore(LocalKeyStore):
-    def __init__(self, url):
+    # The most keys per bulk request.
+    BULK_SIZE = 100
+
+    def __init__(self, url, session=None, pool_size=10, timeout=None,
+                 capacity=None, negative_ttl=60, cache_dir=None):
+        """
+        Args:
+            url (str): The keys URL.
+            session (requests.Session): The session requests are made with,
+                by default a new ``common.httpSession(pool_size)``.
+            pool_size (int): Connections kept alive for reuse.
+            timeout: The (connect, read) timeouts, ``common.HTTP_TIMEOUT`` by
+                default.
+            capacity (int): The most keys cached, the least recently used are
+                evicted. ``None`` for no limit.
+            negative_ttl (float): Seconds a key that was not found is not
+                requested again, 0 to always request.
+            cache_dir (Path): A directory where fetched public keys are kept
+                across processes, e.g. ``common.CLIQUE_CACHE_D``.
+        """
         self._url = url
         self._headers = {"content-type": "application/json"}
+        self._session = session or httpSession(pool_size)
+        self._timeout = timeout or HTTP_TIMEOUT
+        self._pool_size = pool_size
+        # Cleared if the server does not support bulk requests.
+        self._bulk = True
         super().__init__()
+        self._keys = LruCache(capacity)
+        self._not_found = LruCache(capacity, ttl=negative_ttl)
+        self._counts = Counter()
+        self._counts_lock = threading.Lock()
+        self._disk = FileCache(cache_dir) if cache_dir else None
 
     def add(self, jwk):
+        self._not_found.pop(thumbprint(jwk))
         return super().add(jwk)
 
-    def _post(self, url, headers=None, json=None):  # pragma: no cover
-        resp = requests.post(url, headers=headers, json=json, timeout=5)
-        return resp
+    def _loadCached(self, tp):
+        """Returns the key ``tp`` from the disk cache if its thumbprint
+        matches, or ``None``. ``tp`` is a block ``kid``, it is only used as a
+        file name if it is a thumbprint."""
+        if not self._disk or not _THUMBPRINT_RE.match(tp):
+            return None
+        try:
+            data = self._disk.read("keys/" + tp)
+        except OSError as ex:
+            log.warning("Unreadable cached key {}: {}".format(tp, ex))
+            return None
+        if data is None:
+            return None
+
+        try:
+            jwk = self._jwk(json.loads(data))
+        except (ValueError, TypeError, JWException):
+            jwk = None
+        if jwk is None or thumbprint(jwk) != tp:
+            log.warning("Removing corrupt cached key " + tp)
+            self._disk.remove("keys/" + tp)
+            return None
+        self.add(jwk)
+        return jwk
+
+    def _saveCached(self, jwk):
+        if self._disk:
+            self._disk.write("keys/" + thumbprint(jwk), jwk.export_public())
+
+    def _count(self, **counts):
+        with self._counts_lock:
+            self._counts.update(counts)
 
-    def _get(self, url, headers=None):  # pragma: no cover
-        resp = requests.get(url, timeout=5)
-        return resp
+    def cacheInfo(self):
+        """Returns the ``common.CacheInfo`` of the key cache."""
+        return CacheInfo(self._counts["hits"], self._counts["misses"],
+                         self._counts["negative_hits"], len(self._keys),
+                         self._keys.capacity)
+
+    def getMany(self, thumbprints, workers=None):
+        """Fetches the keys that are not cached, in memory or on disk, with
+        ``GET <url>?kid=<tp>&..`` requests for up to ``BULK_SIZE`` keys each,
+        answered with a JWK set (see ``OrderedKeySet.export``).
+
+        If the server does not support it the keys are requested one at a time
+        by up to ``workers`` threads, the connection pool size by default.
+        """
+        thumbprints = list(OrderedDict.fromkeys(thumbprints))
+        keys = {tp: self._keys.get(tp) for tp in thumbprints}
+        fetch = [tp for tp in thumbprints
+                 if keys[tp] is None and tp not in self._not_found]
+        self._count(hits=sum(1 for k in keys.values() if k is not None),
+                    misses=len(fetch),
+                    negative_hits=sum(1 for k in keys.values()
+                                      if k is None) - len(fetch))
+        for tp in fetch:
+            keys[tp] = self._loadCached(tp)
+        fetch = [tp for tp in fetch if keys[tp] is None]
+
+        i = 0
+        while self._bulk and i < len(fetch):
+            found = self._fetchMany(fetch[i:i + self.BULK_SIZE])
+            if found is None:
+                break
+            keys.update(found)
+            i += self.BULK_SIZE
+        failed = set()
+        if fetch[i:]:
+            def fetchOne(tp):
+                try:
+                    return self._fetch(tp)
+                except requests.HTTPError:
+                    failed.add(tp)
+                    return None
+
+            workers = min(workers or self._pool_size, len(fetch) - i)
+            with ThreadPoolExecutor(workers) as pool:
+                keys.update(zip(fetch[i:], pool.map(bindContext(fetchOne),
+                                                    fetch[i:])))
+
+        for tp in fetch:
+            if keys[tp] is None and tp not in failed:
+                self._not_found[tp] = True
+        return OrderedKeySet(keys[tp] for tp in thumbprints
+                             if keys[tp] is not None)
+
+    def _fetchMany(self, thumbprints):
+        """Fetches the keys ``thumbprints`` with one request, returns a dict of
+        the keys found or ``None`` if it failed."""
+        resp = self._get("{}?{}".format(self._url, urlencode(
+                [("kid", tp) for tp in thumbprints])))
+        if resp.status_code != 200:
+            if resp.status_code in (404, 405, 501):
+                log.info("Bulk key requests not supported by " + self._url)
+                self._bulk = False
+            else:
+                log.error(resp)
+            return None
+
+        requested = set(thumbprints)
+        found = {}
+        for key_args in resp.json()["keys"]:
+            jwk = self._jwk(key_args)
+            tp = thumbprint(jwk)
+            if tp not in requested:
+                log.warning("Ignoring key not requested: " + tp)
+                continue
+            self.add(jwk)
+            self._saveCached(jwk)
+            found[tp] = jwk
+        return found
+
+    def uploadMany(self, jwks):
+        """Uploads the public keys of ``jwks`` as JWK sets (see
+        ``OrderedKeySet.export``), up to ``BULK_SIZE`` keys per request, or one
+        at a time if the server does not support it.
+
+        Returns:
+            list: The thumbprints of ``jwks``.
+        """
+        i = 0
+        while self._bulk and i < len(jwks):
+            if not self._uploadMany(jwks[i:i + self.BULK_SIZE]):
+                break
+            i += self.BULK_SIZE
+        for jwk in jwks[i:]:
+            self.upload(jwk)
+        return [thumbprint(jwk) for jwk in jwks]
+
+    def _uploadMany(self, jwks):
+        """Uploads ``jwks`` with one request, returns ``False`` if the server
+        does not support it."""
+        keyset = OrderedKeySet(JWK(**json.loads(jwk.export_public()))
+                               for jwk in jwks)
+        resp = self._post(self._url,
+                          headers={"content-type": "application/jwk-set+json"},
+                          data=keyset.export())
+        if resp.status_code in (404, 405, 415):
+            log.info("Bulk key uploads not supported by " + self._url)
+            self._bulk = False
+            return False
+        elif resp.status_code != 201:
+            log.error(resp)
+            raise requests.RequestException(response=resp)
+        elif resp.json()["kids"] != [thumbprint(jwk) for jwk in keyset]:
+            raise ValueError("'kid' changed on upload")
+
+        for jwk in jwks:
+            self.add(jwk)
+        return True
+
+    def _post(self, url, headers=None, json=None, data=None):
+        return self._session.post(url, headers=headers, json=json, data=data,
+                                  timeout=self._timeout)
+
+    def _get(self, url, headers=None):
+        return self._session.get(url, headers=headers, timeout=self._timeout)
+
+    def close(self):
+        self._session.close()
 
     def upload(self, jwk):
         tprint = thumbprint(jwk)
@@ -95,12 +389,49 @@ class RemoteKeyStore(LocalKeyStore):
 
     def __getitem__(self, tp):
         try:
-            return super().__getitem__(tp)
-        except KeyNotFoundError:
-            resp = self._get("/".join([self._url, tp]))
-            if resp.status_code != 200:
-                log.error(resp)
+            jwk = super().__getitem__(tp)
+            self._count(hits=1)
+            return jwk
+        except KeyNotFoundError as not_found:
+            if tp in self._not_found:
+                self._count(negative_hits=1)
                 raise
-            jwk = newJwk(**resp.json())
-            self.add(jwk)
+            self._count(misses=1)
+            try:
+                jwk = self._fetch(tp)
+            except requests.HTTPError:
+                # Not remembered, the server may answer the next time.
+                raise not_found
+            if jwk is None:
+                self._not_found[tp] = True
+                raise
+            return jwk
+
+    def _fetch(self, tp):
+        """Returns the key ``tp`` fetched from the server, or ``None`` if the
+        server does not have it.
+
+        Raises:
+            requests.HTTPError: If the request failed otherwise.
+        """
+        if not _THUMBPRINT_RE.match(tp):
+            log.warning("Invalid key thumbprint: {!r}".format(tp))
+            return None
+        jwk = self._loadCached(tp)
+        if jwk is not None:
             return jwk
+
+        resp = self._get("/".join([self._url, tp]))
+        if resp.status_code == 404:
+            return None
+        elif resp.status_code != 200:
+            log.error(resp)
+            raise requests.HTTPError(response=resp)
+        jwk = self._jwk(resp.json())
+        if thumbprint(jwk) != tp:
+            raise requests.HTTPError("Server key for {} has thumbprint {}"
+                                     .format(tp, thumbprint(jwk)),
+                                     response=resp)
+        self.add(jwk)
+        self._saveCached(jwk)
+        return jwk
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""Merkle trees over block hashes, with inclusion proofs, as specified by RFC
+6962 (Certificate Transparency) section 2.1.
+
+Hashes are hex strings, the leaves are the (binary) block hashes.
+"""
+import threading
+from hashlib import sha256
+from collections import namedtuple
+
+_LEAF_PREFIX = b"\x00"
+_NODE_PREFIX = b"\x01"
+
+EMPTY_ROOT = sha256(b"").hexdigest()
+
+InclusionProof = namedtuple("InclusionProof", "index, size, leaf, path")
+InclusionProof.__doc__ = """The audit path of leaf ``index`` in a tree of
+``size`` leaves. ``leaf`` is the block hash and ``path`` the hashes of the
+sibling subtrees, from the leaf up."""
+
+
+def _leafHash(leaf):
+    return sha256(_LEAF_PREFIX + bytes.fromhex(leaf)).digest()
+
+
+def _nodeHash(left, right):
+    return sha256(_NODE_PREFIX + left + right).digest()
+
+
+def _split(n):
+    """Returns the largest power of 2 less than ``n``."""
+    return 1 << ((n - 1).bit_length() - 1)
+
+
+class MerkleTree(object):
+    """A Merkle tree extended one leaf at a time in O(log n).
+
+    The roots of the perfect subtrees are kept per level, the root and audit
+    paths of any tree size are computed from them.
+    """
+    def __init__(self, leaves=()):
+        self._leaves = []
+        # _levels[l][i] is the root of leaves [i * 2**l, (i + 1) * 2**l)
+        self._levels = [[]]
+        self._lock = threading.Lock()
+        for leaf in leaves:
+            self.append(leaf)
+
+    def __len__(self):
+        return len(self._leaves)
+
+    def append(self, leaf, index=None):
+        """Adds the block hash ``leaf``.
+
+        Args:
+            index (int): The leaf index, if given the leaf is not added when
+                the tree is already larger, e.g. a tree shared with forks.
+        """
+        with self._lock:
+            if index is not None and index < len(self._leaves):
+                return
+            node = _leafHash(leaf)
+            level = 0
+            while True:
+                nodes = self._levels[level]
+                nodes.append(node)
+                if len(nodes) % 2:
+                    break
+                node = _nodeHash(nodes[-2], nodes[-1])
+                level += 1
+                if level == len(self._levels):
+                    self._levels.append([])
+            # Last, readers see the leaf once its subtrees are complete.
+            self._leaves.append(leaf)
+
+    def copy(self):
+        """Returns a tree of the same leaves that is extended independently."""
+        with self._lock:
+            tree = MerkleTree()
+            tree._leaves = list(self._leaves)
+            tree._levels = [list(nodes) for nodes in self._levels]
+        return tree
+
+    def _subtreeHash(self, start, end):
+        """Returns the root of the tree of leaves [start, end)."""
+        size = end - start
+        level = size.bit_length() - 1
+        if size == 1 << level and start % size == 0:
+            return self._levels[level][start >> level]
+        k = _split(size)
+        return _nodeHash(self._subtreeHash(start, start + k),
+                         self._subtreeHash(start + k, end))
+
+    def _checkSize(self, size):
+        if size is None:
+            return len(self)
+        if not 0 <= size <= len(self):
+            raise ValueError("Invalid tree size: {:d}".format(size))
+        return size
+
+    def root(self, size=None):
+        """Returns the root hash of the tree, or of its first ``size``
+        leaves."""
+        size = self._checkSize(size)
+        if size == 0:
+            return EMPTY_ROOT
+        return self._subtreeHash(0, size).hex()
+
+    def proveInclusion(self, index, size=None):
+        """Returns the ``InclusionProof`` of leaf ``index`` in the tree, or in
+        its first ``size`` leaves.
+
+        Raises:
+            IndexError: If there is no leaf ``index``.
+        """
+        size = self._checkSize(size)
+        if not 0 <= index < size:
+            raise IndexError("Leaf index out of range: {:d}".format(index))
+
+        path = []
+        start, end = 0, size
+        # Top down, RFC 6962 PATH(m, D[n])
+        while end - start > 1:
+            k = _split(end - start)
+            if index < start + k:
+                path.append(self._subtreeHash(start + k, end))
+                end = start + k
+            else:
+                path.append(self._subtreeHash(start, start + k))
+                start += k
+        return InclusionProof(index, size, self._leaves[index],
+                              [h.hex() for h in reversed(path)])
+
+
+def verifyInclusion(proof, root):
+    """Returns ``True`` if ``proof`` shows its leaf is in the tree with root
+    hash ``root``, in O(log n). See RFC 9162 section 2.1.3.2."""
+    index, size, leaf, path = proof
+    if not 0 <= index < size:
+        return False
+
+    try:
+        node = _leafHash(leaf)
+        path = [bytes.fromhex(sibling) for sibling in path]
+    except (TypeError, ValueError):
+        return False
+
+    fn, sn = index, size - 1
+    for sibling in path:
+        if sn == 0:
+            return False
+        if fn & 1 or fn == sn:
+            node = _nodeHash(sibling, node)
+            if not fn & 1:
+                while not fn & 1 and fn != 0:
+                    fn >>= 1
+                    sn >>= 1
+        else:
+            node = _nodeHash(node, sibling)
+        fn >>= 1
+        sn >>= 1
+    return sn == 0 and node.hex() == root
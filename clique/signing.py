@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Backends for signing and verifying the compact JWS of blocks."""
+import weakref
+
+from jwcrypto.jwt import JWT
+from jwcrypto.jws import InvalidJWSSignature
+from jwcrypto.common import base64url_encode, json_encode
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import (
+        decode_dss_signature, encode_dss_signature)
+
+from .common import thumbprint, LruCache
+
+ES256_CURVE = "P-256"
+ES256_SIZE = 32
+PUBLIC_KEY_CACHE_SIZE = 2 ** 12
+
+
+class JwsBackend(object):
+    """Interface and base class for JWS signer/verifier backends."""
+
+    def sign(self, key, header, claims):
+        """Returns the compact JWS of ``claims`` signed with ``key``.
+
+        Args:
+            key (JWK): The private signing key.
+            header (dict): The JWS protected header.
+            claims (dict): The JWS payload.
+        """
+        raise NotImplementedError()
+
+    def verify(self, key, jws):
+        """Verify the signature of ``jws`` with ``key``.
+
+        Args:
+            key (JWK): The verification key.
+            jws (common.CompactJws): The parsed JWS.
+
+        Raises:
+            InvalidJWSSignature: If the signature does not verify.
+        """
+        raise NotImplementedError()
+
+
+class JwcryptoBackend(JwsBackend):
+    """The reference backend, using jwcrypto objects."""
+
+    def sign(self, key, header, claims):
+        jwt = JWT(header=header, claims=claims)
+        jwt.make_signed_token(key)
+        return jwt.serialize()
+
+    def verify(self, key, jws):
+        jws.verify(key)
+
+
+class Es256Backend(JwsBackend):
+    """ES256 using ``cryptography`` directly.
+
+    The output is byte-identical to ``JwcryptoBackend`` up to the (random)
+    ECDSA signature. The loaded public EC key objects are cached per
+    thumbprint, the most recently used ``PUBLIC_KEY_CACHE_SIZE``. Private key
+    objects are only kept as long as their ``JWK``. Other algorithms and key
+    types are handed to ``JwcryptoBackend``.
+    """
+    def __init__(self):
+        self._reference = JwcryptoBackend()
+        self._public_keys = LruCache(capacity=PUBLIC_KEY_CACHE_SIZE)
+        # JWK -> (thumbprint, private key)
+        self._private_keys = weakref.WeakKeyDictionary()
+
+    def __getstate__(self):
+        # Key objects do not pickle (e.g. to worker processes), nor should
+        # private keys travel.
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    @staticmethod
+    def _isEs256Key(key):
+        return (key._params.get("kty") == "EC" and
+                key._key.get("crv") == ES256_CURVE)
+
+    def _privateKey(self, key):
+        tprint = thumbprint(key)
+        cached = self._private_keys.get(key)
+        # The JWK could have been given other key values since.
+        if cached is None or cached[0] != tprint:
+            cached = (tprint, key.get_op_key("sign", ES256_CURVE))
+            self._private_keys[key] = cached
+        return cached[1]
+
+    def _publicKey(self, key):
+        tprint = thumbprint(key)
+        public_key = self._public_keys.get(tprint)
+        if public_key is None:
+            public_key = key.get_op_key("verify", ES256_CURVE)
+            self._public_keys[tprint] = public_key
+        return public_key
+
+    def sign(self, key, header, claims):
+        if header.get("alg") != "ES256" or not self._isEs256Key(key):
+            return self._reference.sign(key, header, claims)
+
+        signing_input = "{}.{}".format(base64url_encode(json_encode(header)),
+                                       base64url_encode(json_encode(claims)))
+        der = self._privateKey(key).sign(signing_input.encode("utf8"),
+                                         ec.ECDSA(hashes.SHA256()))
+        r, s = decode_dss_signature(der)
+        signature = (r.to_bytes(ES256_SIZE, "big") +
+                     s.to_bytes(ES256_SIZE, "big"))
+        return signing_input + "." + base64url_encode(signature)
+
+    def verify(self, key, jws):
+        if jws.alg != "ES256" or not self._isEs256Key(key):
+            return self._reference.verify(key, jws)
+        if "crit" in jws.header:
+            raise InvalidJWSSignature("Unsupported critical header")
+        if len(jws.signature) != ES256_SIZE * 2:
+            raise InvalidJWSSignature("Invalid ES256 signature length")
+
+        r = int.from_bytes(jws.signature[:ES256_SIZE], "big")
+        s = int.from_bytes(jws.signature[ES256_SIZE:], "big")
+        try:
+            self._publicKey(key).verify(encode_dss_signature(r, s),
+                                        jws.signing_input,
+                                        ec.ECDSA(hashes.SHA256()))
+        except InvalidSignature as ex:
+            raise InvalidJWSSignature("Verification failed", repr(ex))
@@ -13,8 +13,8 @@ classifiers = [
     "Natural Language :: English",
     "License :: OSI Approved :: GNU Lesser General Public License v3 (LGPLv3)",
     "Programming Language :: Python",
-    "Programming Language :: Python :: 3.5",
-    "Programming Language :: Python :: 3.6",
+    "Programming Language :: Python :: 3.7",
+    "Programming Language :: Python :: 3.8",
 ]
 
 
@@ -110,6 +110,7 @@ else:
                                      exclude=["tests", "tests.*"]),
               zip_safe=False,
               platforms=["Any"],
+              python_requires=">=3.7",
               keywords=["clique"],
               install_requires=requirements("default.txt"),
               tests_require=requirements("test.txt"),
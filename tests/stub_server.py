@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""A minimal in-memory clique server, on a local port, for testing the remote
+stores over real HTTP connections."""
+import json
+import time
+import threading
+from hashlib import sha256
+from urllib.parse import urlparse, parse_qs
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from jwcrypto.jwk import JWK
+from clique.common import CompactJws, thumbprint
+
+
+def _hash(serialized):
+    return sha256(serialized.encode("utf8")).hexdigest()
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    stub = None
+
+    def log_message(self, *_):
+        pass
+
+    def _reply(self, status, body=None):
+        data = json.dumps(body).encode("utf8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length).decode("utf8")
+
+    def do_POST(self):
+        self.stub._record(self)
+        body = self._body()
+        content_type = self.headers.get("Content-Type", "")
+        if self.path == "/keys":
+            if content_type.startswith("application/jwk-set+json"):
+                if not self.stub.bulk:
+                    return self._reply(415)
+                jwks = [JWK(**k) for k in json.loads(body)["keys"]]
+            else:
+                jwks = [JWK(**json.loads(body))]
+            for jwk in jwks:
+                self.stub.keys[thumbprint(jwk)] = jwk
+            if len(jwks) == 1 and "set" not in content_type:
+                return self._reply(201, {"kid": thumbprint(jwks[0])})
+            return self._reply(201, {"kids": [thumbprint(k) for k in jwks]})
+        elif self.path != "/blocks":
+            return self._reply(404)
+
+        if content_type.startswith("application/jose"):
+            status, error = self.stub.addBlock(body)
+            return self._reply(status, {"error": error} if error else None)
+        elif not self.stub.batch:
+            return self._reply(415)
+
+        results = []
+        for serialized in json.loads(body):
+            status, error = self.stub.addBlock(serialized)
+            results.append({"status": status, "error": error})
+        self._reply(201 if all(r["status"] == 201 for r in results) else 400,
+                    results)
+
+    def do_GET(self):
+        self.stub._record(self)
+        url = urlparse(self.path)
+        if url.path == "/keys" and self.stub.bulk:
+            kids = parse_qs(url.query).get("kid", [])
+            jwks = [self.stub._getKey(kid) for kid in kids]
+            return self._reply(200, {"keys": [json.loads(k.export_public())
+                                              for k in jwks if k]})
+        elif url.path.startswith("/keys/"):
+            jwk = self.stub._getKey(url.path[len("/keys/"):])
+            if jwk is None:
+                return self._reply(404)
+            return self._reply(200, json.loads(jwk.export_public()))
+        elif url.path.startswith("/chains/"):
+            subject = url.path[len("/chains/"):]
+            blocks = self.stub.chains.get(subject)
+            if blocks is None:
+                return self._reply(404)
+
+            since = parse_qs(url.query).get("since")
+            if since and self.stub.delta:
+                hashes = [_hash(b) for b in blocks]
+                if since[0] not in hashes:
+                    return self._reply(404)
+                blocks = blocks[hashes.index(since[0]) + 1:]
+            return self._reply(200, blocks)
+        self._reply(404)
+
+
+class StubCliqueServer(object):
+    """Serves ``POST /blocks`` (one ``application/jose`` block, or a JSON list
+    of blocks when ``batch`` is set) and ``GET /chains/<subject>``, with only
+    the blocks after ``?since=<block hash>`` when ``delta`` is set. Keys are
+    served at ``POST /keys`` and ``GET /keys/<thumbprint>``, the latter taking
+    ``key_delay`` seconds, and in JWK sets when ``bulk`` is set.
+
+    Blocks are checked for a known antecedent only, not validated.
+    """
+    def __init__(self, batch=True, delta=True, bulk=True):
+        self.batch = batch
+        self.delta = delta
+        self.bulk = bulk
+        self.chains = {}
+        self.keys = {}
+        self.key_delay = 0
+        # The most concurrent key requests.
+        self.max_key_requests = 0
+        self.requests = []
+        self.client_ports = set()
+        # Block hashes to reject.
+        self.reject = set()
+
+        self._tips = {}
+        self._key_requests = 0
+        self._lock = threading.Lock()
+        handler = type("Handler", (_Handler,), {"stub": self})
+        self._httpd = _Server(("127.0.0.1", 0), handler)
+        self.url = "http://127.0.0.1:{:d}".format(
+                self._httpd.server_address[1])
+        self._thread = threading.Thread(target=self._httpd.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+
+    def _record(self, handler):
+        with self._lock:
+            self.requests.append((handler.command, handler.path))
+            self.client_ports.add(handler.client_address[1])
+
+    def _getKey(self, tprint):
+        with self._lock:
+            self._key_requests += 1
+            self.max_key_requests = max(self.max_key_requests,
+                                        self._key_requests)
+        time.sleep(self.key_delay)
+        with self._lock:
+            self._key_requests -= 1
+        return self.keys.get(tprint)
+
+    def addBlock(self, serialized):
+        """Returns the (status, error) of adding the serialized block."""
+        block_hash = _hash(serialized)
+        if block_hash in self.reject:
+            return 400, "Rejected"
+        payload = json.loads(CompactJws(serialized).payload.decode("utf8"))
+
+        with self._lock:
+            if payload.get("ant") is None:
+                subject = payload["sub"]
+                if subject in self.chains:
+                    return 409, "Chain exists"
+                self.chains[subject] = []
+            elif payload["ant"] in self._tips:
+                subject = self._tips.pop(payload["ant"])
+            else:
+                return 409, "Unknown antecedent"
+            self.chains[subject].append(serialized)
+            self._tips[block_hash] = subject
+        return 201, None
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
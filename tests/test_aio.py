@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import unittest
+from nose.tools import *  # noqa
+
+from clique import *  # noqa
+from clique.aio import *  # noqa
+from clique.common import newJwk, thumbprint, thumbprints
+from clique.authchain import Grant
+from clique.keystore import RemoteKeyStore, setKeyStore, LocalKeyStore
+from clique.chainstore import setChainStore, LocalChainStore
+
+from .stub_server import StubCliqueServer
+
+
+def _run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class TestAsyncStores(unittest.TestCase):
+    def setUp(self):
+        self.server = StubCliqueServer(bulk=False)
+        self.server.key_delay = 0.05
+        self.keys = [Identity.generateKey() for _ in range(6)]
+        for key in self.keys:
+            self.server.keys[thumbprint(key)] = key
+
+        self.ks = RemoteKeyStore(self.server.url + "/keys")
+        self.ks._bulk = False
+        self.prev_keystore = setKeyStore(self.ks)
+
+    def tearDown(self):
+        setKeyStore(self.prev_keystore)
+        self.ks.close()
+        self.server.close()
+
+    def test_keyStore(self):
+        async def main():
+            aks = AsyncKeyStore()
+            assert_is(aks.keystore, self.ks)
+            key = await aks[thumbprint(self.keys[0])]
+            with assert_raises(KeyNotFoundError):
+                await aks["nope"]
+            missing = await aks.prefetch(thumbprints(self.keys) + ["nope"])
+            return key, missing
+
+        key, missing = _run(main())
+        assert_equals(thumbprint(key), thumbprint(self.keys[0]))
+        assert_equals(missing, ["nope"])
+        assert_greater(self.server.max_key_requests, 1)
+
+    def test_deserialize(self):
+        ident = Identity("acct:kember@spacemen3.com", self.keys[0])
+        chain = BlockChain()
+        for key in self.keys:
+            ident.rotateKey(key)
+            chain.addBlock(ident, song="Walkin' with Jesus")
+
+        async def main():
+            # The event loop is not blocked meanwhile
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0.01)
+
+            ticker = asyncio.ensure_future(tick())
+            chain2 = await deserialize(chain.serialize())
+            await validate(chain2, chain[0].hash)
+            ticker.cancel()
+            return chain2, ticks
+
+        chain2, ticks = _run(main())
+        assert_equals(chain2.serialize(), chain.serialize())
+        assert_greater(self.server.max_key_requests, 1)
+        assert_equals(len(self.server.requests), len(self.keys))
+        assert_greater(ticks, 1)
+
+
+class TestAsyncValidate(unittest.TestCase):
+    def setUp(self):
+        self.prev_chainstore = setChainStore(LocalChainStore())
+        self.prev_keystore = setKeyStore(LocalKeyStore())
+
+    def tearDown(self):
+        setChainStore(self.prev_chainstore)
+        setKeyStore(self.prev_keystore)
+
+    def test_authChain(self):
+        alice = Identity("acct:alice@example.com", newJwk())
+        bob = Identity("acct:bob@example.com", newJwk())
+        for ident in (alice, bob):
+            chainstore().add(IdentityChain(ident, ident.acct))
+
+        chain = AuthChain(alice, "xmpp:room@conference.example.com")
+        chain[0].addGrant(Grant(Grant.Type.VIRAL_GRANT, "participant",
+                                alice.acct, alice.thumbprint))
+        chain[0].addGrant(Grant(Grant.Type.VIRAL_GRANT, "participant",
+                                bob.acct, bob.thumbprint))
+        block = chain.addBlock(bob)
+        block.addGrant(Grant(Grant.Type.GRANT, "participant", bob.acct,
+                             bob.thumbprint))
+
+        looked_up = []
+
+        class Chains(AsyncChainStore):
+            async def __getitem__(self, subject):
+                looked_up.append(subject)
+                return await super().__getitem__(subject)
+
+        async def main():
+            chain2 = await deserialize(chain.serialize(), lazy=True)
+            await validate(chain2, chain[0].hash, chainstore=Chains())
+            return chain2
+
+        chain2 = _run(main())
+        assert_is_instance(chain2, AuthChain)
+        assert_equals(looked_up, [alice.acct, bob.acct])
+        assert_true(chain2.hasPrivilege(bob.acct, "participant"))
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import unittest
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import *  # noqa
 from nose.tools import *  # noqa
 
@@ -145,6 +147,256 @@ class TestAuthChain(unittest.TestCase):
         # Liz grant a priv she does not have.
         assert_raises(ChainValidationError, chain.validate, chain[0].hash)
 
+    def testPrivilegeIndex(self):
+        jus, liz, tas = self.jus, self.liz, self.tas
+        chain = AuthChain(jus, "RESOURCE")
+        assert_false(chain.hasPrivilege(liz.acct, "participant"))
+
+        # Grants added after the block is appended are indexed
+        chain[0].addGrant(Grant(Grant.Type.VIRAL_GRANT, "participant",
+                                jus.acct, jus.thumbprint))
+        chain[0].addGrant(Grant(Grant.Type.GRANT, "participant",
+                                liz.acct, liz.thumbprint))
+        assert_true(chain.hasPrivilege(liz.acct, "participant"))
+        assert_false(chain.hasPrivilege(liz.acct, "moderator"))
+
+        block1 = chain.addBlock(jus)
+        block1.addGrant(Grant(Grant.Type.REVOKE, "participant",
+                              liz.acct, liz.thumbprint))
+        block1.addGrant(Grant(Grant.Type.GRANT, "participant",
+                              tas.acct, tas.thumbprint))
+        assert_false(chain.hasPrivilege(liz.acct, "participant"))
+        assert_true(chain.hasPrivilege(tas.acct, "participant"))
+
+        # A grant added to an older block does not override a newer one
+        chain[0].addGrant(Grant(Grant.Type.GRANT, "participant",
+                                tas.acct, tas.thumbprint))
+        chain[0].addGrant(Grant(Grant.Type.REVOKE, "participant",
+                                tas.acct, tas.thumbprint))
+        assert_true(chain.hasPrivilege(tas.acct, "participant"))
+
+        # Deserialized chains are indexed, lazy ones when first queried
+        chain2 = AuthChain.deserialize(chain.serialize())
+        lazy = BlockChain.deserialize(chain.serialize(), factory=chainFactory,
+                                      lazy=True)
+        assert_is_instance(lazy, AuthChain)
+        assert_equals(lazy._hooked, 1)
+        for acct in (jus.acct, liz.acct, tas.acct):
+            assert_equals(lazy.hasPrivilege(acct, "participant"),
+                          chain2.hasPrivilege(acct, "participant"))
+            assert_equals(lazy.hasPrivilegeAt(acct, "participant", 0),
+                          chain2.hasPrivilegeAt(acct, "participant", 0))
+        for acct in (jus.acct, liz.acct, tas.acct):
+            assert_equals(chain2.hasPrivilege(acct, "participant"),
+                          chain2.hasPrivilege(acct, "participant", scan=True))
+            assert_equals(chain2.getGrantIdentity(acct).key.key_id,
+                          chain2.getGrantIdentity(acct, scan=True).key.key_id)
+
+        # Removed blocks are detected
+        chain._blocks.pop()
+        assert_true(chain.hasPrivilege(liz.acct, "participant"))
+        assert_equals(chain.hasPrivilege(tas.acct, "participant"),
+                      chain.hasPrivilege(tas.acct, "participant", scan=True))
+        assert_equals(chain.getGrantIdentity(liz.acct).acct, liz.acct)
+
+    def testGrantOrder(self):
+        jus, liz, tas = self.jus, self.liz, self.tas
+        chain = AuthChain(jus, "RESOURCE")
+        chain[0].addGrant(Grant(Grant.Type.VIRAL_GRANT, "participant",
+                                jus.acct, jus.thumbprint))
+
+        # Within a block the last grant wins, as when validating
+        block1 = chain.addBlock(jus)
+        block1.addGrant(Grant(Grant.Type.GRANT, "participant",
+                              liz.acct, liz.thumbprint))
+        block1.addGrant(Grant(Grant.Type.REVOKE, "participant",
+                              liz.acct, tas.thumbprint))
+        chain.validate(chain[0].hash)
+        grant = chain._checkpoint.cvs._current_grants[liz.acct]["participant"]
+        assert_equals(grant.type, Grant.Type.REVOKE)
+
+        for chain in (chain, AuthChain.deserialize(chain.serialize())):
+            assert_false(chain.hasPrivilege(liz.acct, "participant"))
+            assert_false(chain.hasPrivilege(liz.acct, "participant",
+                                            scan=True))
+            assert_false(chain.hasPrivilegeAt(liz.acct, "participant", 1))
+            for scan in (False, True):
+                assert_equals(chain.getGrantIdentity(liz.acct,
+                                                     scan=scan).key.key_id,
+                              tas.thumbprint)
+
+    def testPrivilegeAt(self):
+        jus, liz, tas = self.jus, self.liz, self.tas
+        chain = AuthChain(jus, "RESOURCE")
+        chain[0].addGrant(Grant(Grant.Type.VIRAL_GRANT, "participant",
+                                jus.acct, jus.thumbprint))
+        chain.addBlock(jus).addGrant(Grant(Grant.Type.GRANT, "participant",
+                                           liz.acct, liz.thumbprint))
+        chain.addBlock(jus)
+        assert_true(chain.hasPrivilegeAt(liz.acct, "participant", 2))
+
+        # Grants added to the tip after a query are replayed
+        chain[2].addGrant(Grant(Grant.Type.REVOKE, "participant",
+                                liz.acct, liz.thumbprint))
+        chain.addBlock(jus).addGrant(Grant(Grant.Type.GRANT, "participant",
+                                           tas.acct, tas.thumbprint))
+
+        expected = [(True, False, False), (True, True, False),
+                    (True, False, False), (True, False, True)]
+        for height, privs in enumerate(expected):
+            for ident, has in zip((jus, liz, tas), privs):
+                assert_equals(chain.hasPrivilegeAt(ident.acct, "participant",
+                                                   height), has)
+            assert_false(chain.hasPrivilegeAt(jus.acct, "moderator", height))
+        # Past the tip is the current state
+        assert_true(chain.hasPrivilegeAt(tas.acct, "participant", 100))
+
+        grants = chain.grantsAt(1)
+        assert_equals(set(grants), {jus.acct, liz.acct})
+        assert_equals(grants[liz.acct]["participant"].type, Grant.Type.GRANT)
+        assert_equals(chain.grantsAt(2)[liz.acct]["participant"].type,
+                      Grant.Type.REVOKE)
+        assert_equals(set(chain.grantsAt(3)), {jus.acct, liz.acct, tas.acct})
+
+        # Same answers as truncating the chain and replaying it.
+        for height in range(len(chain)):
+            truncated = AuthChain(None, None)
+            for block in chain[:height + 1]:
+                truncated._blocks.append(block)
+            cvs = authchain._ChainValidationState(truncated)
+            for block in truncated:
+                cvs.ratchet(block)
+            at = chain.grantsAt(height)
+            assert_equals(set(at), set(cvs._current_grants))
+            for grantee, privs in cvs._current_grants.items():
+                assert_equals(privs, at[grantee])
+
+        # Changing a replayed block rebuilds the history
+        history = chain.grantHistory()
+        chain[1].addGrant(Grant(Grant.Type.GRANT, "participant",
+                                tas.acct, tas.thumbprint))
+        assert_is_not(chain.grantHistory(), history)
+        assert_true(chain.hasPrivilegeAt(tas.acct, "participant", 1))
+        assert_false(chain.hasPrivilegeAt(tas.acct, "participant", 0))
+
+    def testConcurrentReaders(self):
+        jus, liz = self.jus, self.liz
+        chain = AuthChain(jus, "RESOURCE")
+        chain[0].addGrant(Grant(Grant.Type.VIRAL_GRANT, "participant",
+                                jus.acct, jus.thumbprint))
+        n_blocks = 200
+        done = threading.Event()
+
+        def write():
+            try:
+                for i in range(n_blocks):
+                    type_ = Grant.Type.REVOKE if i % 2 else Grant.Type.GRANT
+                    chain.addBlock(jus).addGrant(
+                            Grant(type_, "participant", liz.acct,
+                                  liz.thumbprint))
+            finally:
+                done.set()
+
+        def read():
+            hashes = {}
+            while not done.is_set():
+                chain.hasPrivilege(liz.acct, "participant")
+                chain.getGrantIdentity(liz.acct)
+                height = len(chain) - 1
+                chain.hasPrivilegeAt(liz.acct, "participant", height)
+                chain.grantsAt(height)
+                # Blocks are signed once, whoever serializes first
+                hashes.setdefault(height, chain[height].hash)
+                assert_equals(chain[height].hash, hashes[height])
+            return hashes
+
+        with ThreadPoolExecutor(5) as pool:
+            readers = [pool.submit(read) for _ in range(4)]
+            pool.submit(write).result()
+            for reader in readers:
+                for height, block_hash in reader.result().items():
+                    assert_equals(chain[height].hash, block_hash)
+
+        assert_equals(len(chain), n_blocks + 1)
+        assert_false(chain.hasPrivilege(liz.acct, "participant"))
+        assert_true(chain.hasPrivilegeAt(liz.acct, "participant",
+                                         n_blocks - 1))
+        for i in range(1, len(chain)):
+            assert_equals(chain[i].antecedent, chain[i - 1].hash)
+        AuthChain.deserialize(chain.serialize()).validate(chain[0].hash)
+
+    def testFork(self):
+        jus, liz, tas = self.jus, self.liz, self.tas
+        chain = AuthChain(jus, "RESOURCE")
+        chain[0].addGrant(Grant(Grant.Type.VIRAL_GRANT, "participant",
+                                jus.acct, jus.thumbprint))
+        chain.addBlock(jus).addGrant(Grant(Grant.Type.GRANT, "participant",
+                                           liz.acct, liz.thumbprint))
+        assert_true(chain.hasPrivilegeAt(liz.acct, "participant", 1))
+
+        fork = chain.fork()
+        assert_is(fork._grant_index, chain._grant_index)
+        fork.addBlock(jus).addGrant(Grant(Grant.Type.REVOKE, "participant",
+                                          liz.acct, liz.thumbprint))
+        chain.addBlock(jus).addGrant(Grant(Grant.Type.GRANT, "participant",
+                                           tas.acct, tas.thumbprint))
+
+        assert_false(fork.hasPrivilege(liz.acct, "participant"))
+        assert_false(fork.hasPrivilege(tas.acct, "participant"))
+        assert_true(chain.hasPrivilege(liz.acct, "participant"))
+        assert_true(chain.hasPrivilege(tas.acct, "participant"))
+        assert_false(fork.hasPrivilegeAt(liz.acct, "participant", 2))
+        assert_true(chain.hasPrivilegeAt(liz.acct, "participant", 2))
+        for c in (chain, fork):
+            for ident in (jus, liz, tas):
+                assert_equals(c.hasPrivilege(ident.acct, "participant"),
+                              c.hasPrivilege(ident.acct, "participant",
+                                             scan=True))
+            c.validate(chain[0].hash)
+
+        # Grants added to a shared block are indexed by both chains
+        assert_is(chain[1], fork[1])
+        chain[1].addGrant(Grant(Grant.Type.GRANT, "moderator",
+                                tas.acct, tas.thumbprint))
+        for c in (chain, fork):
+            assert_true(c.hasPrivilege(tas.acct, "moderator"))
+            assert_true(c.hasPrivilege(tas.acct, "moderator", scan=True))
+            assert_true(c.hasPrivilegeAt(tas.acct, "moderator", 1))
+            assert_false(c.hasPrivilegeAt(tas.acct, "moderator", 0))
+
+        # Appending to the chain forked from copies nothing, the fork
+        # rebuilds its index once it is used.
+        fork = chain.fork()
+        with patch.object(AuthChain, "_buildIndex", autospec=True,
+                          side_effect=AuthChain._buildIndex) as build:
+            chain.addBlock(jus).addGrant(Grant(Grant.Type.REVOKE, "moderator",
+                                               tas.acct, tas.thumbprint))
+            assert_equals(build.call_count, 0)
+            assert_false(chain.hasPrivilege(tas.acct, "moderator"))
+            assert_true(fork.hasPrivilege(tas.acct, "moderator"))
+            assert_equals(build.call_count, 1)
+            assert_is(build.call_args[0][0], fork)
+
+    def testVerifiedSignatures(self):
+        jus, liz = self.jus, self.liz
+        chain = AuthChain(jus, "RESOURCE")
+        chain[0].addGrant(Grant(Grant.Type.VIRAL_GRANT, "participant",
+                                jus.acct, jus.thumbprint))
+        chain.addBlock(jus).addGrant(Grant(Grant.Type.GRANT, "participant",
+                                           liz.acct, liz.thumbprint))
+        chain.validate(chain[0].hash)
+        idchain = chainstore()[jus.acct]
+        idchain.validate(idchain[0].hash)
+
+        # Copies of the chains are validated without signature checks
+        copies = [(AuthChain.deserialize(chain.serialize()), chain[0].hash),
+                  (IdentityChain.deserialize(idchain.serialize()),
+                   idchain[0].hash)]
+        with patch.object(Block.jws_backend, "verify") as backend_verify:
+            for copy, genesis_hash in copies:
+                copy.validate(genesis_hash)
+        assert_equals(backend_verify.call_count, 0)
+
     def testEmptyGrantCheck(self):
         chain = AuthChain(self.tas, "RESOURCE")
         chain._blocks.pop()
@@ -176,6 +428,7 @@ class TestAuthChain(unittest.TestCase):
                                                 self.jus.acct,
                                                 self.jus.thumbprint))
         chain.validate(chain[0].hash)
+        chain.validate(chain[0].hash, workers=2)
         # Using an old key
         self.tas.rotateKey(key1)
         chain.addBlock(self.tas).addGrant(Grant(Grant.Type.GRANT,
@@ -183,6 +436,17 @@ class TestAuthChain(unittest.TestCase):
                                                 self.liz.acct,
                                                 self.liz.thumbprint))
         assert_raises(ChainValidationError, chain.validate, chain[0].hash)
+        assert_raises(ChainValidationError, chain.validate, chain[0].hash,
+                      workers=2)
+
+        # The checkpoint is not advanced by a failed validation
+        assert_equals(chain._checkpoint.length, 4)
+        grants = chain._checkpoint.cvs._current_grants
+        assert_equals(len(grants[self.jus.acct]), 1)
+        assert_equals(grants[self.jus.acct]["participant"].type,
+                      Grant.Type.REVOKE)
+        chain._blocks.pop()
+        chain.validate(chain[0].hash)
 
 
 def test_DistributedAppExample():
@@ -282,6 +546,12 @@ def test_DistributedAppExample():
     assert_true(final_chain.hasPrivilege(steve.acct, "participant"))
     assert_false(final_chain.hasPrivilege(steve.acct, "moderator"))
 
+    # The index and the scan agree
+    for acct in [i.acct for i in identities] + ["acct:nobody@example.com"]:
+        for priv in ("participant", "moderator", "owner"):
+            assert_equals(final_chain.hasPrivilege(acct, priv),
+                          final_chain.hasPrivilege(acct, priv, scan=True))
+
     for ident in identities:
         gident = final_chain.getGrantIdentity(ident.acct)
         assert_equal(ident.acct, gident.acct)
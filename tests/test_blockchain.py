@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
+import io
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import *  # noqa
 from nose.tools import *  # noqa
 import jwcrypto.jws
 
 from clique.blockchain import *  # noqa
 from clique.keystore import *  # noqa
+from clique import blockchain, merkle
 
 
 class TestBlockChain(unittest.TestCase):
@@ -36,8 +39,14 @@ class TestBlockChain(unittest.TestCase):
             assert_equals(c1b.hash, c2b.hash)
             assert_dict_equal(dict(c1b.payload), dict(c2b.payload))
 
+            # The deserialized JWS is kept, not parsed again
+            parsed = c2b._jws
+            assert_is_not_none(parsed)
+            assert_equals(parsed.serialization, c2b.serialize())
+
             c1b.verify()
             c2b.verify()
+            assert_is(c2b.jws, parsed)
 
             new_key = Identity.generateKey()
             assert_raises(jwcrypto.jws.InvalidJWSSignature, c2b.verify, new_key)
@@ -207,6 +216,288 @@ class TestBlockChain(unittest.TestCase):
 
         assert_equals(str(c1), str(c2))
 
+    def test_validateWorkers(self):
+        chain = BlockChain()
+        for i in range(20):
+            chain.addBlock(self.ident, n=i)
+        chain.validate(chain[0].hash, workers=2)
+        # The worker processes are started once
+        pool = blockchain._processPool(2)
+        assert_is(blockchain._process_pools[2], pool)
+        Block.verified_signatures.clear()
+        chain.clearCheckpoint()
+        with patch("clique.blockchain.ProcessPoolExecutor") as new_pool:
+            chain.validate(chain[0].hash, workers=2)
+        new_pool.assert_not_called()
+        assert_is(blockchain._processPool(2), pool)
+
+        # Re-sign block 5 with a key other than its 'kid', which also breaks
+        # the antecedent link of block 6. The signature error comes first.
+        forged = chain[5].serialize().rsplit(".", 1)[0] + "." + \
+                 Block(Identity("forger", Identity.generateKey()),
+                       None).serialize().rsplit(".", 1)[1]
+        chain[5]._serialization = forged
+        chain.clearCheckpoint()
+        assert_raises(jwcrypto.jws.InvalidJWSSignature, chain.validate,
+                      chain[0].hash)
+        assert_raises(jwcrypto.jws.InvalidJWSSignature, chain.validate,
+                      chain[0].hash, workers=2)
+
+        chain = BlockChain()
+        for i in range(10):
+            chain.addBlock(self.ident, n=i)
+        chain[7].antecedent = chain[5].hash
+        chain[7].serialize(update=True)
+        assert_raises(ChainValidationError, chain.validate, chain[0].hash,
+                      workers=2)
+
+    def test_verifiedSignatures(self):
+        chain = BlockChain()
+        for i in range(10):
+            chain.addBlock(self.ident, n=i)
+        verified = Block.verified_signatures
+        verified.clear()
+        chain.validate(chain[0].hash)
+        assert_equals(len(verified), len(chain))
+        assert_in((chain[3].hash, self.ident.thumbprint), verified)
+
+        # Other copies of the blocks are not verified again, nor their keys
+        # looked up.
+        copy = BlockChain.deserialize(chain.serialize())
+        with patch.object(Block.jws_backend, "verify") as backend_verify, \
+                patch("clique.blockchain.keystore") as ks:
+            copy.validate(chain[0].hash)
+            chain[2].verify(self.ident.key)
+        assert_equals(backend_verify.call_count, 0)
+        assert_equals(ks.return_value.__getitem__.call_count, 0)
+
+        # Nor by worker processes
+        verified.clear()
+        copy.clearCheckpoint()
+        copy.validate(copy[0].hash, workers=2)
+        assert_equals(len(verified), len(chain))
+        with patch.object(Block.jws_backend, "verify") as backend_verify:
+            chain.clearCheckpoint()
+            chain.validate(chain[0].hash, workers=2)
+        assert_equals(backend_verify.call_count, 0)
+
+        # With another key the signature is checked
+        other = Identity.generateKey()
+        assert_raises(jwcrypto.jws.InvalidJWSSignature, chain[2].verify,
+                      other)
+        assert_not_in((chain[2].hash, thumbprint(other)), verified)
+
+    def test_validateCheckpoint(self):
+        chain = BlockChain()
+        for i in range(5):
+            chain.addBlock(self.ident, n=i)
+        chain.validate(chain[0].hash)
+        assert_equals(chain._checkpoint.length, 5)
+        assert_equals(chain._checkpoint.tip_hash, chain[-1].hash)
+
+        # Only the new blocks are validated
+        for i in range(5, 8):
+            chain.addBlock(self.ident, n=i)
+        with patch.object(Block, "validate", autospec=True,
+                          side_effect=Block.validate) as block_validate:
+            chain.validate(chain[0].hash)
+        assert_equals([c[0][0] for c in block_validate.call_args_list],
+                      chain[5:])
+        assert_equals(chain._checkpoint.length, 8)
+
+        # A failed validation keeps the last checkpoint
+        bad = chain.addBlock(self.ident, n=8)
+        bad.antecedent = chain[6].hash
+        assert_raises(ChainValidationError, chain.validate, chain[0].hash)
+        assert_equals(chain._checkpoint.length, 8)
+
+        # A different chain with the same length does not resume
+        chain._blocks.pop()
+        chain._blocks[-1] = Block(self.ident, chain[-2].hash, n=-1)
+        with patch.object(Block, "validate", autospec=True,
+                          side_effect=Block.validate) as block_validate:
+            chain.validate(chain[0].hash)
+        assert_equals(len(block_validate.call_args_list), len(chain))
+
+        # Nor after a block of the validated prefix is re-signed
+        chain[4].payload["n"] = -4
+        chain[4].serialize(update=True)
+        assert_raises(ChainValidationError, chain.validate, chain[0].hash)
+
+        chain.clearCheckpoint()
+        assert_is_none(chain._checkpoint)
+
+    def test_lazyDeserialize(self):
+        chain = BlockChain()
+        for i in range(50):
+            chain.addBlock(self.ident, n=i)
+        serialized = chain.serialize()
+
+        with patch.object(Block, "_fromSerialization",
+                          wraps=Block._fromSerialization) as decode:
+            lazy = BlockChain.deserialize(serialized, lazy=True)
+            assert_equals(decode.call_count, 1)
+            assert_equals(len(lazy), 50)
+            assert_equals(lazy.genesis_block.payload["n"], 0)
+            assert_equals(lazy[-1].payload["n"], 49)
+            assert_equals(decode.call_count, 2)
+            assert_is(lazy[-1], lazy[49])
+
+            # No decoding to serialize or append
+            assert_equals(lazy.serialize(), serialized)
+            block = lazy.addBlock(self.ident, n=50)
+            assert_equals(block.antecedent, chain[-1].hash)
+            assert_equals(decode.call_count, 2)
+
+        assert_equals([b.payload["n"] for b in lazy[10:13]], [10, 11, 12])
+        assert_equals([b.payload["n"] for b in reversed(lazy)],
+                      list(reversed(range(51))))
+        lazy.validate(chain[0].hash)
+        for b1, b2 in zip(chain, lazy):
+            assert_equals(b1.hash, b2.hash)
+
+        emptychain = BlockChain.deserialize("[]", lazy=True)
+        assert_equal(len(emptychain), 0)
+
+    def test_concurrentReaders(self):
+        chain = BlockChain()
+        for i in range(50):
+            chain.addBlock(self.ident, n=i)
+        lazy = BlockChain.deserialize(chain.serialize(), lazy=True)
+
+        # Blocks are decoded once, and appends are not torn
+        def read(_):
+            return [lazy[i] for i in range(50)], lazy[-1].hash
+
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(read, range(8)))
+            for i in range(20):
+                lazy.addBlock(self.ident, n=50 + i)
+        for blocks, _ in results:
+            assert_equals(blocks, lazy[:50])
+        lazy.validate(chain[0].hash)
+
+        # An unsigned block is signed once
+        block = Block(self.ident, None, n=0)
+        with ThreadPoolExecutor(8) as pool:
+            hashes = set(pool.map(lambda _: block.hash, range(8)))
+        assert_equals(hashes, {block.hash})
+
+    def test_fork(self):
+        chain = BlockChain()
+        for i in range(10):
+            chain.addBlock(self.ident, n=i)
+        chain.validate(chain[0].hash)
+
+        # Nothing is copied until the fork is appended to, the chain it was
+        # forked from is appended to in place.
+        fork = chain.fork()
+        blocks = chain._blocks
+        assert_is(fork._blocks.base, blocks)
+        assert_equals(fork.serialize(), chain.serialize())
+        root = chain.root()
+
+        chain.addBlock(self.ident, n="chain")
+        assert_is(chain._blocks, blocks)
+        assert_false(chain._shared)
+        assert_equals(len(fork), 10)
+        assert_equals(fork.root(), root)
+        fork.addBlock(self.ident, n="fork")
+        assert_is_not(fork._blocks, chain._blocks)
+        assert_equals(len(fork), len(chain))
+        assert_equals(fork[-1].payload["n"], "fork")
+        assert_equals(chain[-1].payload["n"], "chain")
+        for b1, b2 in zip(chain[:10], fork[:10]):
+            assert_is(b1, b2)
+        fork.validate(chain[0].hash)
+        chain.validate(chain[0].hash)
+
+        # Lazy chains share their decoded blocks
+        lazy = BlockChain.deserialize(chain.serialize(), lazy=True)
+        lazy_fork = lazy.fork()
+        assert_is(lazy_fork[5], lazy[5])
+        lazy_fork += Block(self.ident, None, n="fork")
+        assert_equals(len(lazy), len(chain))
+        assert_equals(lazy_fork[-1].antecedent, chain[-1].hash)
+        lazy_fork.validate(chain[0].hash)
+
+    def test_merkleRoot(self):
+        chain = BlockChain()
+        assert_equals(chain.root(), merkle.EMPTY_ROOT)
+        for i in range(20):
+            chain.addBlock(self.ident, n=i)
+        root = chain.root()
+        assert_equals(root, merkle.MerkleTree(b.hash for b in chain).root())
+
+        for i in range(len(chain)):
+            proof = chain.proveInclusion(i)
+            assert_equals(proof.leaf, chain[i].hash)
+            assert_true(BlockChain.verifyInclusion(proof, root))
+        assert_equals(chain.proveInclusion(-1).index, len(chain) - 1)
+        assert_raises(IndexError, chain.proveInclusion, len(chain))
+
+        # Extended with the appended blocks only, without decoding
+        lazy = BlockChain.deserialize(chain.serialize(), lazy=True)
+        assert_equals(lazy.root(), root)
+        lazy.addBlock(self.ident, n=20)
+        with patch.object(lazy, "_hashAt", wraps=lazy._hashAt) as hashAt:
+            new_root = lazy.root()
+            assert_equals(hashAt.call_count, 1)
+        assert_not_equal(new_root, root)
+        assert_equals(lazy._blocks[1:20], [None] * 19)
+        proof = lazy.proveInclusion(3)
+        assert_true(BlockChain.verifyInclusion(proof, new_root))
+        assert_false(BlockChain.verifyInclusion(proof, root))
+
+        # Forks extend their own tree
+        fork = chain.fork()
+        fork.addBlock(self.ident, n="fork")
+        chain.addBlock(self.ident, n="chain")
+        assert_not_equal(fork.root(), chain.root())
+        assert_equals(chain.root(),
+                      merkle.MerkleTree(b.hash for b in chain).root())
+        assert_equals(fork.root(),
+                      merkle.MerkleTree(b.hash for b in fork).root())
+
+    def test_dumpIterload(self):
+        chain = BlockChain()
+        for i in range(20):
+            chain.addBlock(self.ident, n=i, text="x" * i)
+
+        fp = io.StringIO()
+        chain.dump(fp)
+        assert_equals(fp.getvalue(), chain.serialize())
+
+        fp.seek(0)
+        blocks = BlockChain.iterload(fp)
+        assert_false(isinstance(blocks, list))
+        for b1, b2 in zip(chain, blocks):
+            assert_equals(b1.hash, b2.hash)
+            assert_dict_equal(dict(b1.payload), dict(b2.payload))
+        assert_equals(list(blocks), [])
+
+        fp = io.StringIO()
+        BlockChain().dump(fp)
+        assert_equals(fp.getvalue(), "[]")
+        fp.seek(0)
+        assert_equals(list(BlockChain.iterload(fp)), [])
+
+    def test_iterJsonArray(self):
+        from clique.blockchain import _iterJsonArray
+
+        values = ["a.b.c", "", "\"quoted\"", "x" * 100, "\u00fc"]
+        for text in (json.dumps(values), json.dumps(values, indent=3),
+                     " [ " + " ,\n".join(json.dumps(v) for v in values) + "]"):
+            for chunk_size in (1, 2, 7, 1000):
+                assert_equals(list(_iterJsonArray(io.StringIO(text),
+                                                  chunk_size=chunk_size)),
+                              values)
+
+        for bad in ("", "{}", "[", '["a"', '["a" "b"]', '["a",'):
+            assert_raises(ValueError, list, _iterJsonArray(io.StringIO(bad),
+                                                           chunk_size=2))
+
+
 def testChainValidateErrorFalseness():
     cve = ChainValidationError("Wicked World")
     assert_false(cve)
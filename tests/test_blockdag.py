@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import *  # noqa
+from nose.tools import *  # noqa
+
+from clique import *  # noqa
+from clique.blockdag import *  # noqa
+from clique.blockdag import _skipHeight
+
+
+def testSkipHeight():
+    for height in range(1, 1000):
+        assert_less(_skipHeight(height), height)
+    assert_equals([_skipHeight(h) for h in range(9)],
+                  [0, 0, 0, 1, 0, 1, 4, 1, 0])
+
+
+class TestBlockDag(unittest.TestCase):
+    def setUp(self):
+        self.ident = Identity("acct:dale@melvins.com", Identity.generateKey())
+        self.chain = BlockChain()
+        for i in range(300):
+            self.chain.addBlock(self.ident, n=i)
+        self.dag = BlockDag()
+
+    def _branch(self, chain, n, **payload):
+        branch = chain.fork()
+        for i in range(n):
+            branch.addBlock(self.ident, i=i, **payload)
+        return branch
+
+    def test_ancestor(self):
+        chain, dag = self.chain, self.dag
+        assert_equals(dag.addChain(chain), chain[-1].hash)
+        assert_equals(len(dag), len(chain))
+        assert_equals(dag.tips, [chain[-1].hash])
+        assert_is(dag[chain[10].hash], chain[10])
+
+        tip = chain[-1].hash
+        for height in range(len(chain)):
+            assert_equals(dag.ancestor(tip, height), chain[height].hash)
+            assert_equals(dag.height(chain[height].hash), height)
+        assert_is_none(dag.ancestor(chain[5].hash, 6))
+        assert_raises(KeyError, dag.ancestor, "nope", 0)
+
+    def test_commonAncestor(self):
+        chain, dag = self.chain, self.dag
+        branches = []
+        for height in (0, 1, 100, 255, 256, 299):
+            trunk = BlockChain()
+            for block in chain[:height + 1]:
+                trunk._blocks.append(block)
+            branches.append(self._branch(trunk, 1 + height % 7,
+                                         at=height))
+
+        dag.addChain(chain)
+        for branch in branches:
+            dag.addChain(branch)
+        # The branch at the tip extends the chain
+        assert_equals(len(dag.tips), len(branches))
+
+        for b1 in branches:
+            h1 = b1[-1].hash
+            assert_equals(dag.commonAncestor(h1, h1), h1)
+            assert_equals(dag.commonAncestor(h1, chain[-1].hash),
+                          chain[b1[-1].payload["at"]].hash)
+            for b2 in branches:
+                if b2 is not b1:
+                    at = min(b1[-1].payload["at"], b2[-1].payload["at"])
+                    assert_equals(dag.commonAncestor(h1, b2[-1].hash),
+                                  chain[at].hash)
+
+        other = BlockChain()
+        other.addBlock(self.ident, n=0)
+        dag.addChain(other)
+        assert_is_none(dag.commonAncestor(other[0].hash, chain[-1].hash))
+
+    def test_addChain(self):
+        chain, dag = self.chain, self.dag
+        dag.addChain(chain)
+        branch = self._branch(chain, 3)
+        with patch.object(branch, "_hashAt", wraps=branch._hashAt) as hashAt:
+            assert_equals(dag.addChain(branch), branch[-1].hash)
+            # Only back to the known tip
+            assert_less(hashAt.call_count, 10)
+        assert_equals(dag.tips, [branch[-1].hash])
+        assert_equals(dag.addChain(chain), chain[-1].hash)
+        assert_is_none(dag.addChain(BlockChain()))
+
+    def test_merge(self):
+        chain, dag = self.chain, self.dag
+        ours = self._branch(chain, 2, side="ours")
+        theirs = self._branch(chain, 3, side="theirs")
+
+        # Prefixes fast forward
+        for merged in (dag.merge(chain, ours), dag.merge(ours, chain)):
+            assert_equals(merged.serialize(), ours.serialize())
+        assert_is_not(merged, ours)
+
+        merged = dag.merge(ours, theirs)
+        assert_equals(merged[-1].hash, theirs[-1].hash)
+        merged.addBlock(self.ident, side="merged")
+        assert_equals(len(theirs), len(chain) + 3)
+
+        def keepOurs(ours_, theirs_, height):
+            assert_equals(height, len(chain) - 1)
+            return ours_
+        merged = dag.merge(ours, theirs, policy=keepOurs)
+        assert_equals(merged[-1].hash, ours[-1].hash)
+        merged.validate(chain[0].hash)
+
+        other = BlockChain()
+        other.addBlock(self.ident, n=0)
+        assert_raises(ValueError, dag.merge, ours, other)
+        assert_equals(dag.merge(BlockChain(), ours).serialize(),
+                      ours.serialize())
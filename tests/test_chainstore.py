@@ -1,10 +1,20 @@
 # -*- coding: utf-8 -*-
+import time
+import fcntl
+import tempfile
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 from unittest.mock import *  # noqa
 from nose.tools import *  # noqa
 
 from clique import *  # noqa
 from clique.chainstore import *  # noqa
+from clique.chainstore import _ChainLog
+from clique.common import thumbprint, HTTP_TIMEOUT, CacheInfo, FileCache
+from jwcrypto.jws import InvalidJWSSignature
+
+from .stub_server import StubCliqueServer
 
 
 def test_ChainStore():
@@ -90,7 +100,25 @@ class TestRemoteChainStore(unittest.TestCase):
         cs = RemoteChainStore(url)
         assert_equals(cs._blocks_url, url + "/blocks")
         assert_equals(cs._chains_url, url + "/chains")
+        assert_equals(cs._timeout, HTTP_TIMEOUT)
 
+    def test_session(self):
+        session = MagicMock()
+        session.post.return_value = Response(201, None)
+        cs = RemoteChainStore(self.url, session=session, timeout=(1, 30))
+        chain = self.chains[0]
+        cs.upload(chain)
+        # Every block is posted on the one session
+        session.post.assert_has_calls(
+                [call(cs._blocks_url, headers=self.headers, json=None,
+                      data=block.serialize(), timeout=(1, 30))
+                 for block in chain])
+
+        cs._get(cs._chains_url)
+        session.get.assert_called_with(cs._chains_url, headers=None,
+                                       timeout=(1, 30))
+        cs.close()
+        session.close.assert_called_with()
 
     def test_NoGetForCachedValues(self):
         cs = RemoteChainStore(self.url)
@@ -139,3 +167,535 @@ class TestRemoteChainStore(unittest.TestCase):
         self.cs._get = MagicMock(return_value=Response(500, err_chain))
         assert_raises(ChainNotFoundError,
                       self.cs.__getitem__, err_chain.subject)
+
+        # Server errors are not remembered, unlike missing chains
+        self.cs._get = MagicMock(return_value=Response(200, err_chain))
+        assert_equals(self.cs[err_chain.subject].serialize(),
+                      err_chain.serialize())
+        self.cs._get = MagicMock(return_value=Response(404, None))
+        for _ in range(2):
+            assert_raises(ChainNotFoundError, self.cs.__getitem__,
+                          "acct:nobody")
+        self.cs._get.assert_called_once_with(self.url +
+                                             "/chains/acct:nobody")
+
+
+class TestFileChainStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name)
+        self.ident = Identity("acct:jesus@lizard.com", Identity.generateKey())
+        for _ in range(5):
+            self.ident.rotateKey()
+        self.chain = IdentityChain.fromIdentity(self.ident, self.ident.acct)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_addGet(self):
+        cs = FileChainStore(self.path)
+        assert_not_in(self.chain.subject, cs)
+        assert_raises(ChainNotFoundError, cs.__getitem__, self.chain.subject)
+
+        cs.add(self.chain)
+        assert_in(self.chain.subject, cs)
+        assert_is(cs[self.chain.subject], self.chain)
+        assert_raises(ValueError, cs.add, self.chain)
+        cs.close()
+
+        # Reopened, the chain is read lazily from disk
+        cs = FileChainStore(self.path)
+        assert_in(self.chain.subject, cs)
+        chain = cs[self.chain.subject]
+        assert_is_instance(chain, IdentityChain)
+        assert_equals(len(chain), len(self.chain))
+        assert_equals(chain._blocks[1:], [None] * (len(chain) - 1))
+        assert_equals(chain[3].hash, self.chain[3].hash)
+        assert_equals(chain.serialize(), self.chain.serialize())
+        chain.validate(self.chain[0].hash)
+        cs.close()
+
+    def test_append(self):
+        cs = FileChainStore(self.path)
+        cs.add(self.chain)
+        block = self.chain.addBlock(self.ident, pkt=thumbprint(self.ident.key))
+        cs.append(self.chain.subject, block)
+        assert_equals(len(cs[self.chain.subject]), len(self.chain))
+        assert_raises(ValueError, cs.append, self.chain.subject, block)
+        assert_raises(ChainNotFoundError, cs.append, "acct:nobody", block)
+        cs.close()
+
+        cs = FileChainStore(self.path)
+        chain = cs[self.chain.subject]
+        assert_equals(chain.serialize(), self.chain.serialize())
+
+        # Appending updates the stored chain object
+        block = chain.addBlock(self.ident, pkt=thumbprint(self.ident.key))
+        cs.append(chain.subject, block)
+        block2 = chain.BlockType(self.ident, block.hash,
+                                 pkt=thumbprint(self.ident.key))
+        cs.append(chain.subject, block2)
+        assert_is(chain[-1], block2)
+        cs.close()
+
+        cs = FileChainStore(self.path)
+        assert_equals(cs[chain.subject].serialize(), chain.serialize())
+        cs.close()
+
+    def test_writers(self):
+        log_path, index_path = FileChainStore(self.path)._paths("acct:x")
+        logs = [_ChainLog(log_path, index_path)
+                for _ in range(2)]
+        blocks = json.loads(self.chain.serialize())
+        for i, serialized in enumerate(blocks):
+            logs[i % 2].append(serialized,
+                               self.chain._hashAt(i - 1) if i else None)
+        for chain_log in logs:
+            chain_log._syncIndex()
+            assert_equals(list(chain_log), blocks)
+            chain_log.close()
+
+        chain_log = _ChainLog(log_path, index_path)
+        assert_equals(list(chain_log), blocks)
+        chain_log.close()
+
+        # Stores that have not seen each other's blocks cannot fork the log
+        subject = self.chain.subject
+        stores = [FileChainStore(self.path / "forked") for _ in range(2)]
+        stores[0].add(self.chain)
+        for cs in stores:
+            cs[subject]
+        length, tip = len(self.chain), self.chain[-1].hash
+        pkt = thumbprint(self.ident.key)
+        stores[0].append(subject, self.chain.BlockType(self.ident, tip,
+                                                       pkt=pkt))
+        assert_raises(ValueError, stores[1].append, subject,
+                      self.chain.BlockType(self.ident, tip, pkt=pkt))
+        for cs in stores:
+            cs.close()
+        chain = FileChainStore(self.path / "forked")[subject]
+        assert_equals(len(chain), length + 1)
+        for i in range(1, len(chain)):
+            assert_equals(chain[i].antecedent, chain._hashAt(i - 1))
+
+    def test_repair(self):
+        cs = FileChainStore(self.path)
+        cs.add(self.chain)
+        cs.close()
+
+        log_path, index_path = cs._paths(self.chain.subject)
+        # An append interrupted before the index was written.
+        with log_path.open("ab") as fp:
+            fp.write(b"eyJhbGciOi")
+        cs = FileChainStore(self.path)
+        assert_equals(cs[self.chain.subject].serialize(),
+                      self.chain.serialize())
+        cs.close()
+
+        # Index records past the end of the log
+        size = log_path.stat().st_size
+        with log_path.open("r+b") as fp:
+            fp.truncate(size - 10)
+        cs = FileChainStore(self.path)
+        chain = cs[self.chain.subject]
+        assert_equals(len(chain), len(self.chain) - 1)
+        assert_equals(chain.serialize(),
+                      json.dumps([b.serialize() for b in self.chain[:-1]]))
+        cs.close()
+
+        # Not while another writer holds the log lock
+        size = log_path.stat().st_size
+        with log_path.open("ab") as writer, ThreadPoolExecutor(1) as pool:
+            fcntl.flock(writer, fcntl.LOCK_EX)
+            writer.write(b"eyJhbGciOi")
+            writer.flush()
+            opening = pool.submit(_ChainLog, log_path, index_path)
+            time.sleep(0.1)
+            assert_false(opening.done())
+            writer.truncate(size)
+            fcntl.flock(writer, fcntl.LOCK_UN)
+            chain_log = opening.result()
+        assert_equals(len(chain_log), len(self.chain) - 1)
+        assert_equals(log_path.stat().st_size, size)
+        chain_log.close()
+
+    def test_corruption(self):
+        cs = FileChainStore(self.path)
+        cs.add(self.chain)
+        cs.close()
+
+        log_path, _ = cs._paths(self.chain.subject)
+        data = bytearray(log_path.read_bytes())
+        data[-20] = ord("A") if data[-20] != ord("A") else ord("B")
+        log_path.write_bytes(bytes(data))
+
+        cs = FileChainStore(self.path)
+        chain = cs[self.chain.subject]
+        assert_raises(ValueError, chain.__getitem__, -1)
+        cs.close()
+
+
+class TestSqliteChainStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name) / "clique.db"
+        self.ident = Identity("acct:jesus@lizard.com", Identity.generateKey())
+        for _ in range(5):
+            self.ident.rotateKey()
+        self.chain = IdentityChain.fromIdentity(self.ident, self.ident.acct)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_addGet(self):
+        cs = SqliteChainStore(self.path)
+        assert_not_in(self.chain.subject, cs)
+        assert_raises(ChainNotFoundError, cs.__getitem__, self.chain.subject)
+
+        cs.add(self.chain)
+        assert_in(self.chain.subject, cs)
+        assert_is(cs[self.chain.subject], self.chain)
+        assert_raises(ValueError, cs.add, self.chain)
+
+        # Another store (or process) on the same database, chains are lazy
+        cs2 = SqliteChainStore(self.path)
+        chain = cs2[self.chain.subject]
+        assert_is_instance(chain, IdentityChain)
+        assert_equals(chain._blocks[1:], [None] * (len(chain) - 1))
+        assert_equals(chain[3].hash, self.chain[3].hash)
+        assert_equals(chain.serialize(), self.chain.serialize())
+        chain.validate(self.chain[0].hash)
+
+        assert_is(cs2.getByGenesis(self.chain[0].hash), chain)
+        assert_is(cs2.getByTip(self.chain[-1].hash), chain)
+        assert_raises(ChainNotFoundError, cs2.getByTip, self.chain[0].hash)
+        assert_raises(ChainNotFoundError, cs2.getByGenesis, "deadbeef")
+        cs.close()
+        cs2.close()
+
+    def test_append(self):
+        cs = SqliteChainStore(self.path)
+        cs.add(self.chain)
+        block = self.chain.addBlock(self.ident, pkt=thumbprint(self.ident.key))
+        cs.append(self.chain.subject, block)
+        assert_equals(len(cs[self.chain.subject]), len(self.chain))
+        assert_raises(ValueError, cs.append, self.chain.subject, block)
+        assert_raises(ChainNotFoundError, cs.append, "acct:nobody", block)
+        assert_is(cs.getByTip(block.hash), self.chain)
+
+        cs2 = SqliteChainStore(self.path)
+        chain = cs2[self.chain.subject]
+        assert_equals(chain.serialize(), self.chain.serialize())
+
+        # Appending updates the stored chain object
+        block = chain.addBlock(self.ident, pkt=thumbprint(self.ident.key))
+        cs2.append(chain.subject, block)
+        block2 = chain.BlockType(self.ident, block.hash,
+                                 pkt=thumbprint(self.ident.key))
+        cs2.append(chain.subject, block2)
+        assert_is(chain[-1], block2)
+
+        # The other store's tip is stale
+        stale = self.chain.BlockType(self.ident, self.chain[-1].hash,
+                                     pkt=thumbprint(self.ident.key))
+        assert_raises(ValueError, cs.append, self.chain.subject, stale)
+        cs.close()
+        cs2.close()
+
+        cs = SqliteChainStore(self.path)
+        assert_equals(cs[chain.subject].serialize(), chain.serialize())
+        cs.close()
+
+
+class TestBatchUpload(unittest.TestCase):
+    def setUp(self):
+        self.server = StubCliqueServer()
+        self.ident = Identity("acct:jim@jesus.com", Identity.generateKey())
+        self.chain = IdentityChain.fromIdentity(self.ident, self.ident.acct)
+        for _ in range(24):
+            self.chain.addBlock(self.ident, pkt=thumbprint(self.ident.key))
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_batches(self):
+        cs = RemoteChainStore(self.server.url)
+        cs.upload(self.chain, batch_size=10)
+        assert_equals(self.server.requests, [("POST", "/blocks")] * 3)
+        assert_equals(self.server.chains[self.chain.subject],
+                      [b.serialize() for b in self.chain])
+        # One kept-alive connection
+        assert_equals(len(self.server.client_ports), 1)
+        assert_is(cs[self.chain.subject], self.chain)
+        cs.close()
+
+    def test_fallback(self):
+        self.server.batch = False
+        cs = RemoteChainStore(self.server.url)
+        cs.upload(self.chain, batch_size=10)
+        # The rejected batch, then one block per request
+        assert_equals(len(self.server.requests), 1 + len(self.chain))
+        assert_equals(self.server.chains[self.chain.subject],
+                      [b.serialize() for b in self.chain])
+        cs.close()
+
+    def test_failures(self):
+        self.server.reject.add(self.chain[13].hash)
+        cs = RemoteChainStore(self.server.url)
+        with assert_raises(BlockUploadError) as ctx:
+            cs.upload(self.chain, batch_size=10)
+        # The following blocks can not be added either
+        assert_equals([f[:2] for f in ctx.exception.failures],
+                      [(i, 400 if i == 13 else 409) for i in range(13, 20)])
+        assert_equals(len(self.server.chains[self.chain.subject]), 13)
+        assert_raises(ChainNotFoundError, cs.__getitem__, "acct:nobody")
+
+        self.server.batch = False
+        cs = RemoteChainStore(self.server.url)
+        with assert_raises(BlockUploadError) as ctx:
+            cs.upload(self.chain, batch_size=10)
+        assert_equals(ctx.exception.failures, [(0, 409, None)])
+        cs.close()
+
+
+class TestRefresh(unittest.TestCase):
+    def setUp(self):
+        self.server = StubCliqueServer()
+        self.ident = Identity("acct:william@jesus.com", Identity.generateKey())
+        self.chain = IdentityChain.fromIdentity(self.ident, self.ident.acct)
+        self.chain.addBlock(self.ident, pkt=thumbprint(self.ident.key))
+        for serialized in json.loads(self.chain.serialize()):
+            self.server.addBlock(serialized)
+        self.cs = RemoteChainStore(self.server.url)
+
+    def tearDown(self):
+        self.cs.close()
+        self.server.close()
+
+    def _addBlocks(self, n):
+        for _ in range(n):
+            block = self.chain.addBlock(self.ident,
+                                        pkt=thumbprint(self.ident.key))
+            assert_equals(self.server.addBlock(block.serialize()),
+                          (201, None))
+
+    def test_refresh(self):
+        subject = self.chain.subject
+        chain = self.cs.refresh(subject)
+        assert_equals(chain.serialize(), self.chain.serialize())
+        assert_is(self.cs.refresh(subject), chain)
+        assert_equals(len(chain), 2)
+
+        chain.validate(chain[0].hash)
+        self._addBlocks(3)
+        BlockType = chain.BlockType
+        with patch.object(BlockType, "validate", autospec=True,
+                          side_effect=BlockType.validate) as validate:
+            assert_is(self.cs.refresh(subject), chain)
+            # Only the new blocks were validated, before they were appended
+            assert_equals(validate.call_count, 3)
+        assert_equals(chain.serialize(), self.chain.serialize())
+        assert_equals(chain._checkpoint.length, len(chain))
+        # Nor was the block list copied
+        assert_false(chain._shared)
+        assert_equals(self.server.requests[-1],
+                      ("GET", "/chains/{}?since={}".format(subject,
+                                                           chain[-4].hash)))
+
+    def test_fallbacks(self):
+        subject = self.chain.subject
+        chain = self.cs[subject]
+
+        # A server without deltas sends the whole chain
+        self.server.delta = False
+        self._addBlocks(2)
+        assert_is(self.cs.refresh(subject), chain)
+        assert_equals(chain.serialize(), self.chain.serialize())
+
+        # An unknown tip refetches the chain
+        self.server.delta = True
+        chain._appendBlock(chain.BlockType(self.ident, chain[-1].hash,
+                                           pkt=thumbprint(self.ident.key)))
+        refreshed = self.cs.refresh(subject)
+        assert_is_not(refreshed, chain)
+        assert_equals(refreshed.serialize(), self.chain.serialize())
+
+    def test_invalid(self):
+        subject = self.chain.subject
+        chain = self.cs[subject]
+        chain.validate(chain[0].hash)
+        serialized = chain.serialize()
+
+        # Rotating to an attacker's key, with the signature of another block
+        attacker_tp = thumbprint(Identity.generateKey())
+        block = self.chain.addBlock(self.ident, pkt=attacker_tp)
+        forged = "{}.{}".format(block.serialize().rsplit(".", 1)[0],
+                                chain[1].serialize().rsplit(".", 1)[1])
+        assert_equals(self.server.addBlock(forged), (201, None))
+
+        assert_raises(InvalidJWSSignature, self.cs.refresh, subject)
+        assert_is(self.cs[subject], chain)
+        assert_equals(chain.serialize(), serialized)
+        assert_not_in(attacker_tp, chain._pkt_order)
+        assert_equals(chain._checkpoint.length, len(chain))
+        chain.validate(chain[0].hash)
+
+    def test_invalidReplacement(self):
+        subject = self.chain.subject
+        chain = self.cs[subject]
+        # A tip the server does not know, the whole chain is fetched
+        chain._appendBlock(chain.BlockType(self.ident, chain[-1].hash,
+                                           pkt=thumbprint(self.ident.key)))
+        chain.validate(chain[0].hash)
+        serialized = chain.serialize()
+
+        attacker_tp = thumbprint(Identity.generateKey())
+        block = self.chain.addBlock(self.ident, pkt=attacker_tp)
+        forged = "{}.{}".format(block.serialize().rsplit(".", 1)[0],
+                                chain[1].serialize().rsplit(".", 1)[1])
+        assert_equals(self.server.addBlock(forged), (201, None))
+
+        # Unknown tip, then a server sending whole chains the stored one is
+        # not a prefix of.
+        for delta in (True, False):
+            self.server.delta = delta
+            assert_raises(InvalidJWSSignature, self.cs.refresh, subject)
+            assert_is(self.cs[subject], chain)
+            assert_equals(chain.serialize(), serialized)
+            assert_not_in(attacker_tp, chain._pkt_order)
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.server = StubCliqueServer()
+        self.chains = []
+        for i in range(3):
+            ident = Identity("acct:psycho{:d}@jesus.com".format(i),
+                             Identity.generateKey())
+            chain = IdentityChain.fromIdentity(ident, ident.acct)
+            for serialized in json.loads(chain.serialize()):
+                self.server.addBlock(serialized)
+            self.chains.append(chain)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_cache(self):
+        cs = RemoteChainStore(self.server.url, capacity=2, negative_ttl=60)
+        for chain in self.chains:
+            cs[chain.subject]
+        assert_equals(list(cs._chains),
+                      [c.subject for c in self.chains[1:]])
+        cs[self.chains[2].subject]
+
+        for _ in range(2):
+            assert_raises(ChainNotFoundError, cs.__getitem__, "acct:nobody")
+        assert_equals(len(self.server.requests), 4)
+        assert_equals(cs.cacheInfo(), CacheInfo(1, 4, 1, 2, 2))
+
+        cs.clear()
+        assert_equals(len(cs._chains), 0)
+        cs.close()
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name)
+        self.server = StubCliqueServer()
+        self.ident = Identity("acct:reid@jesus.com", Identity.generateKey())
+        self.chain = IdentityChain.fromIdentity(self.ident, self.ident.acct)
+        self._serve(json.loads(self.chain.serialize()))
+
+    def tearDown(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def _serve(self, blocks):
+        for serialized in blocks:
+            assert_equals(self.server.addBlock(serialized), (201, None))
+
+    def _addBlock(self):
+        block = self.chain.addBlock(self.ident, pkt=thumbprint(self.ident.key))
+        self._serve([block.serialize()])
+
+    def test_warm(self):
+        subject = self.chain.subject
+        cs = RemoteChainStore(self.server.url, cache_dir=self.path)
+        assert_equals(cs[subject].serialize(), self.chain.serialize())
+        cs.close()
+        chain_file = self.path / "chains" / self.chain[0].hash
+        assert_equals(chain_file.read_text().splitlines(),
+                      json.loads(self.chain.serialize()))
+
+        # Started from the cache only the new blocks are fetched, and
+        # appended to the cached chain.
+        self._addBlock()
+        cs = RemoteChainStore(self.server.url, cache_dir=self.path)
+        with patch.object(FileCache, "append", autospec=True,
+                          side_effect=FileCache.append) as append:
+            chain = cs[subject]
+            assert_equals(append.call_args[0][1:],
+                          ("chains/" + chain[0].hash,
+                           chain[-1].serialize() + "\n",
+                           len(chain_file.read_bytes()) -
+                           len(chain[-1].serialize()) - 1))
+        assert_equals(chain.serialize(), self.chain.serialize())
+        assert_equals(self.server.requests[-1],
+                      ("GET", "/chains/{}?since={}".format(subject,
+                                                           chain[-2].hash)))
+        cs.close()
+        assert_equals(chain_file.read_text().splitlines(),
+                      json.loads(self.chain.serialize()))
+        assert_equals(len(list((self.path / "chains").iterdir())), 1)
+
+        # A write that did not complete is dropped
+        with chain_file.open("a") as fp:
+            fp.write("partial")
+        cs = RemoteChainStore(self.server.url, cache_dir=self.path)
+        assert_equals(cs[subject].serialize(), self.chain.serialize())
+        self._addBlock()
+        cs.refresh(subject)
+        cs.close()
+        assert_equals(chain_file.read_text().splitlines(),
+                      json.loads(self.chain.serialize()))
+
+    def test_corrupt(self):
+        subject = self.chain.subject
+        cs = RemoteChainStore(self.server.url, cache_dir=self.path)
+        cs[subject]
+        cs.close()
+
+        chain_file = self.path / "chains" / self.chain[0].hash
+        blocks = chain_file.read_text().splitlines()
+        chain_file.write_text("\n".join(blocks[:-1]) + "\n")
+        cs = RemoteChainStore(self.server.url, cache_dir=self.path)
+        assert_equals(cs[subject].serialize(), self.chain.serialize())
+        assert_equals(self.server.requests[-1],
+                      ("GET", "/chains/" + subject))
+        cs.close()
+
+        # A middle block replaced, with a consistent index
+        for _ in range(2):
+            self._addBlock()
+        blocks = json.loads(self.chain.serialize())
+        other = IdentityChain(self.ident, "acct:other@jesus.com")
+        blocks[1] = other.addBlock(self.ident,
+                                   pkt=thumbprint(self.ident.key)).serialize()
+        data = "".join(b + "\n" for b in blocks)
+        chain_file.write_text(data)
+        (self.path / RemoteChainStore._subjectFile(subject)).write_text(
+                "{} {} {:d} {:d}".format(self.chain[0].hash,
+                                         self.chain[-1].hash, len(blocks),
+                                         len(data)))
+        cs = RemoteChainStore(self.server.url, cache_dir=self.path)
+        assert_is_none(cs._loadCached(subject))
+        assert_equals(cs[subject].serialize(), self.chain.serialize())
+        cs.close()
+
+        # A server that no longer has the chain
+        self.server.chains.clear()
+        cs = RemoteChainStore(self.server.url, cache_dir=self.path)
+        assert_raises(ChainNotFoundError, cs.__getitem__, subject)
+        assert_equals(list((self.path / "subjects").iterdir()), [])
+        cs.close()
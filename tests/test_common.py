@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import json
+import time
+import tempfile
 import unittest
 from unittest.mock import MagicMock
 from nose.tools import *  # noqa
@@ -31,7 +33,8 @@ def test_Uri():
 
 class TestThumbprint(unittest.TestCase):
     def setUp(self):
-        k = Identity.generateKey()
+        # Not via newJwk, which caches the thumbprint
+        k = JWK(generate="EC", size=256)
         k.export = MagicMock(return_value=k.export())
         k.export_public = MagicMock(return_value=k.export_public())
         self.mocked_exports = k
@@ -53,6 +56,29 @@ class TestThumbprint(unittest.TestCase):
         self.mocked_exports.export.assert_not_called()
         assert_is_not(tp, None)
 
+    def test_cache(self):
+        tp = thumbprint(self.mocked_exports)
+        tp_raw = thumbprint(self.mocked_exports, base64=False)
+        assert_equal(thumbprint(self.mocked_exports), tp)
+        self.mocked_exports.export_public.assert_called_once_with()
+        assert_equal(base64url_encode(tp_raw), tp)
+
+        # New key values invalidate the cached thumbprint
+        other = Identity.generateKey()
+        self.mocked_exports.import_key(**json.loads(other.export()))
+        self.mocked_exports.export_public = MagicMock(
+                return_value=other.export_public())
+        assert_equal(thumbprint(self.mocked_exports), thumbprint(other))
+        self.mocked_exports.export_public.assert_called_once_with()
+
+    def test_thumbprints(self):
+        keys = [self.key, self.public_key, Identity.generateKey()]
+        assert_list_equal(thumbprints(keys), [thumbprint(k) for k in keys])
+        assert_list_equal(thumbprints(keys, base64=False),
+                          [thumbprint(k, base64=False) for k in keys])
+        assert_equal(thumbprints(keys)[0], thumbprints(keys)[1])
+        assert_list_equal(thumbprints([]), [])
+
     def test_base64(self):
         tp1 = thumbprint(self.key)
         tp2 = thumbprint(self.key, base64=True)
@@ -65,6 +91,30 @@ class TestThumbprint(unittest.TestCase):
         pass
 
 
+def test_CompactJws():
+    from jwcrypto.jwt import JWT
+    from jwcrypto.jws import InvalidJWSObject, InvalidJWSSignature
+
+    key = Identity.generateKey()
+    jwt = JWT(header={"alg": "ES256", "kid": key.key_id},
+              claims={"iss": "Spacemen 3"})
+    jwt.make_signed_token(key)
+    token = jwt.serialize()
+
+    jws = CompactJws(token)
+    assert_equal(jws.serialization, token)
+    assert_equal(jws.kid, key.key_id)
+    assert_equal(jws.alg, "ES256")
+    assert_equal(json.loads(jws.payload.decode("utf8")), {"iss": "Spacemen 3"})
+    assert_equal(jws.signing_input, token.rsplit(".", 1)[0].encode("utf8"))
+    jws.verify(key)
+    jws.verify(JWK(**json.loads(key.export_public())))
+    assert_raises(InvalidJWSSignature, jws.verify, Identity.generateKey())
+
+    assert_raises(InvalidJWSObject, CompactJws, "Sonic.Boom")
+    assert_raises(InvalidJWSObject, CompactJws, "!!.!!.!!")
+
+
 class TestIdentity(unittest.TestCase):
     def setUp(self):
         self.key = Identity.generateKey()
@@ -157,6 +207,60 @@ class TestOrderedKeySet(unittest.TestCase):
         for i, kjson in enumerate(exported_json["keys"]):
             assert_dict_equal(kjson, json.loads(self.keys[i].export()))
 
+
+def test_httpSession():
+    session = httpSession(pool_size=4)
+    for prefix in ("http://", "https://"):
+        adapter = session.get_adapter(prefix + "clique.net")
+        assert_equals(adapter._pool_maxsize, 4)
+        assert_equals(adapter.poolmanager.connection_pool_kw["maxsize"], 4)
+    session.close()
+
+
+def test_LruCache():
+    cache = LruCache(capacity=2)
+    cache["a"] = 1
+    cache["b"] = 2
+    assert_equals(cache["a"], 1)
+    cache["c"] = 3
+    # "b" was the least recently used
+    assert_equals(list(cache), ["a", "c"])
+    assert_not_in("b", cache)
+    assert_raises(KeyError, cache.__getitem__, "b")
+    assert_is_none(cache.get("b"))
+    assert_equals(cache.pop("a"), 1)
+    assert_is_none(cache.pop("a"))
+    assert_equals(len(cache), 1)
+    cache.clear()
+    assert_equals(len(cache), 0)
+
+    cache = LruCache(ttl=0.01)
+    cache["a"] = 1
+    assert_in("a", cache)
+    time.sleep(0.02)
+    assert_not_in("a", cache)
+    assert_equals(len(cache), 0)
+
+
+def test_FileCache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = FileCache(tmpdir)
+        assert_is_none(cache.read("a/b"))
+        cache.write("a/b", "ü")
+        assert_equals(cache.read("a/b"), "ü")
+
+        assert_equals(cache.append("log", "one\n"), 4)
+        assert_equals(cache.append("log", "two\n", 4), 8)
+        # Past the offset is replaced
+        assert_equals(cache.append("log", "three\n", 4), 10)
+        assert_equals(cache.read("log"), "one\nthree\n")
+        assert_equals(cache.read("log", 4), "one\n")
+
+        cache.remove("log")
+        cache.remove("log")
+        assert_is_none(cache.read("log"))
+
+
 if __name__ == '__main__':
     import sys
     sys.exit(unittest.main())
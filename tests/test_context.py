@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from nose.tools import *  # noqa
+
+from clique import *  # noqa
+from clique.blockchain import Block
+from clique.context import bindContext
+from clique.keystore import LocalKeyStore
+from clique.chainstore import LocalChainStore
+
+
+class TestCliqueContext(unittest.TestCase):
+    def setUp(self):
+        self.tenants = [CliqueContext(LocalKeyStore(), LocalChainStore())
+                        for _ in range(4)]
+
+    def test_stores(self):
+        global_ks, global_cs = keystore(), chainstore()
+        assert_is_none(CliqueContext.current())
+
+        ctx = self.tenants[0]
+        with ctx as entered:
+            assert_is(entered, ctx)
+            assert_is(keystore(), ctx.keystore)
+            assert_is(chainstore(), ctx.chainstore)
+
+            # Stores not given are those of the enclosing context
+            inner = CliqueContext(keystore=LocalKeyStore())
+            with inner:
+                assert_is(keystore(), inner.keystore)
+                assert_is(chainstore(), ctx.chainstore)
+            assert_is(keystore(), ctx.keystore)
+        assert_is(keystore(), global_ks)
+        assert_is(chainstore(), global_cs)
+
+        with CliqueContext(chainstore=LocalChainStore()):
+            assert_is(keystore(), global_ks)
+
+    def _tenantWork(self, ctx, n):
+        with ctx:
+            ident = Identity("acct:tenant{:d}@example.com".format(n),
+                             Identity.generateKey())
+            for _ in range(3):
+                ident.rotateKey()
+            chain = IdentityChain.fromIdentity(ident, ident.acct)
+            chainstore().add(chain)
+            chain2 = BlockChain.deserialize(chain.serialize(),
+                                            factory=chainFactory)
+            chain2.validate(chain[0].hash)
+            return ident
+
+    def test_threads(self):
+        with ThreadPoolExecutor(len(self.tenants)) as pool:
+            idents = list(pool.map(self._tenantWork, self.tenants,
+                                   range(len(self.tenants))))
+
+        for ctx, ident in zip(self.tenants, idents):
+            assert_equals(list(ctx.chainstore._chains), [ident.acct])
+            assert_equals(sorted(ctx.keystore._keys),
+                          sorted(k.thumbprint for k in
+                                 [Identity("x", k) for k in ident.keys]))
+            assert_not_in(ident.thumbprint, keystore())
+
+    def test_explicit(self):
+        idents = [self._tenantWork(ctx, i)
+                  for i, ctx in enumerate(self.tenants[:2])]
+        with self.tenants[0]:
+            serialized = chainstore()[idents[0].acct].serialize()
+
+        # Lazy chains decode their blocks in the context they were given
+        chain = BlockChain.deserialize(serialized, factory=chainFactory,
+                                       lazy=True, context=self.tenants[0])
+        assert_is(chain._context, self.tenants[0])
+        assert_raises(KeyNotFoundError, BlockChain.deserialize, serialized,
+                      context=self.tenants[1])
+        chain.validate(chain[0].hash, context=self.tenants[0])
+        assert_equals(chain.serialize(), serialized)
+
+    def test_checkpoint(self):
+        ident = self._tenantWork(self.tenants[0], 0)
+        with self.tenants[0]:
+            chain = chainstore()[ident.acct]
+            chain.validate(chain[0].hash)
+            assert_equals(chain._checkpoint.length, len(chain))
+
+        # The checkpoint of another tenant's stores does not skip validation,
+        # (verified signatures do, they do not depend on the key store).
+        Block.verified_signatures.clear()
+        with self.tenants[1]:
+            assert_raises(KeyNotFoundError, chain.validate, chain[0].hash)
+        assert_raises(KeyNotFoundError, chain.validate, chain[0].hash)
+        assert_is(chain._checkpoint.stores[0], self.tenants[0].keystore)
+
+        chain.validate(chain[0].hash, context=self.tenants[0])
+        assert_equals(chain._checkpoint.length, len(chain))
+
+    def test_bindContext(self):
+        with self.tenants[0], ThreadPoolExecutor(2) as pool:
+            stores = list(pool.map(bindContext(lambda _: keystore()),
+                                   range(4)))
+            unbound = pool.submit(keystore).result()
+        assert_equals(stores, [self.tenants[0].keystore] * 4)
+        assert_is_not(unbound, self.tenants[0].keystore)
+
+    def test_tasks(self):
+        async def task(ctx):
+            with ctx:
+                await asyncio.sleep(0.01)
+                stores = [keystore()]
+                await asyncio.sleep(0.01)
+                stores.append(keystore())
+                return stores
+
+        async def main():
+            return await asyncio.gather(*[task(ctx) for ctx in self.tenants])
+
+        for ctx, stores in zip(self.tenants, asyncio.run(main())):
+            assert_equals(stores, [ctx.keystore] * 2)
@@ -135,6 +135,42 @@ class TestIdentityChain(unittest.TestCase):
 
         idchain.validate(idchain[0].hash)
 
+        lazy = IdentityChain.deserialize(idchain.serialize(), lazy=True)
+        assert_equals(len(lazy._pkt_order), 1)
+        for i, k in enumerate(keys):
+            tp = thumbprint(k)
+            for j in range(len(keys)):
+                assert_equals(lazy.isSameOrSubsequent(tp, thumbprint(keys[j])),
+                              j <= i)
+        lazy.validate(idchain[0].hash)
+
+    def test_fork(self):
+        ident = self.ident
+        ident.rotateKey()
+        idchain = IdentityChain.fromIdentity(ident, "Geezer")
+        old_tp = idchain[-1].pkt
+
+        fork = idchain.fork()
+        new_key = ident.rotateKey()
+        ident.rotateKey(keystore()[old_tp])
+        fork.addBlock(ident, pkt=thumbprint(new_key))
+        assert_true(fork.isSameOrSubsequent(thumbprint(new_key), old_tp))
+        assert_not_in(thumbprint(new_key), idchain._pkt_order)
+        assert_equals(len(idchain), len(fork) - 1)
+        fork.validate(idchain[0].hash)
+
+        # Keys the chain rotates to are not in forks made before
+        fork = idchain.fork()
+        ident.rotateKey(keystore()[old_tp])
+        parent_key = ident.rotateKey()
+        ident.rotateKey(keystore()[old_tp])
+        idchain.addBlock(ident, pkt=thumbprint(parent_key))
+        assert_true(idchain.isSameOrSubsequent(thumbprint(parent_key),
+                                               old_tp))
+        assert_raises(KeyError, fork.isSameOrSubsequent,
+                      thumbprint(parent_key), old_tp)
+        assert_equals(len(fork), len(idchain) - 1)
+
 
 if __name__ == '__main__':
     import sys
@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
+import time
+import tempfile
 import unittest
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import *  # noqa
 from nose.tools import *  # noqa
 import jwcrypto.jws
 
 from clique.blockchain import *  # noqa
 from clique.keystore import *  # noqa
+from clique.common import (jwkIsPrivate, thumbprints, OrderedKeySet,
+                           HTTP_TIMEOUT, CacheInfo)
+
+from .stub_server import StubCliqueServer
 
 
 def test_global_KeyStore():
@@ -78,6 +86,23 @@ class TestRemoteKeyStore(unittest.TestCase):
         ks = RemoteKeyStore(url)
         assert_equals(ks._url, url)
         assert_dict_equal(ks._headers, h)
+        assert_equals(ks._timeout, HTTP_TIMEOUT)
+
+    def test_session(self):
+        key = self.keys[0]
+        session = MagicMock()
+        session.post.return_value = Response(201, key)
+        session.get.return_value = Response(200, key)
+        ks = RemoteKeyStore(self.url, session=session, timeout=(1, 30))
+
+        ks.upload(key)
+        session.post.assert_called_with(self.url, headers=self.headers,
+                                        json=json.loads(key.export_public()),
+                                        data=None, timeout=(1, 30))
+        ks = RemoteKeyStore(self.url, session=session, timeout=(1, 30))
+        ks[thumbprint(key)]
+        session.get.assert_called_with(self.url + "/" + thumbprint(key),
+                                       headers=None, timeout=(1, 30))
 
     def test_NoGetForCachedValues(self):
         ks = RemoteKeyStore(self.url)
@@ -133,4 +158,320 @@ class TestRemoteKeyStore(unittest.TestCase):
         self.ks._get = MagicMock(return_value=Response(500, new_key))
         assert_raises(KeyNotFoundError,
                         self.ks.__getitem__, thumbprint(new_key))
+        assert_equals(len(self.ks.getMany([thumbprint(new_key)])), 0)
+
+        # Server errors are not remembered, unlike missing keys
+        self.ks._get = MagicMock(return_value=Response(200, new_key))
+        assert_equals(thumbprint(self.ks[thumbprint(new_key)]),
+                      thumbprint(new_key))
+        missing = newJwk()
+        self.ks._get = MagicMock(return_value=Response(404, None))
+        for _ in range(2):
+            assert_raises(KeyNotFoundError,
+                          self.ks.__getitem__, thumbprint(missing))
+        self.ks._get.assert_called_once_with(self.url + "/" +
+                                             thumbprint(missing))
+
+
+class TestSqliteKeyStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name) / "clique.db"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_addGet(self):
+        ks = SqliteKeyStore(self.path)
+        k1 = Identity.generateKey()
+        assert_not_in(thumbprint(k1), ks)
+        assert_raises(KeyNotFoundError, ks.__getitem__, thumbprint(k1))
+        ks.add(k1)
+        ks.add(k1)
+        assert_is(ks[thumbprint(k1)], k1)
+
+        # Another store (or process) on the same database
+        ks2 = SqliteKeyStore(self.path)
+        assert_in(thumbprint(k1), ks2)
+        # Loaded keys are not added to the active key store
+        with patch.object(keystore(), "add") as add:
+            k2 = ks2[thumbprint(k1)]
+        add.assert_not_called()
+        assert_equals(k2.export_public(), k1.export_public())
+        # Private keys are not persisted
+        assert_false(jwkIsPrivate(k2))
+        assert_true(jwkIsPrivate(ks[thumbprint(k1)]))
+        ks.close()
+        ks2.close()
+
+    def test_corrupt(self):
+        ks = SqliteKeyStore(self.path)
+        k1, k2 = Identity.generateKey(), Identity.generateKey()
+        ks._db.execute("INSERT INTO keys VALUES (?, ?)",
+                       (thumbprint(k1), k2.export_public()))
+        ks._db.execute("INSERT INTO keys VALUES (?, ?)",
+                       (thumbprint(k2), "{"))
+        assert_raises(KeyNotFoundError, ks.__getitem__, thumbprint(k1))
+        assert_raises(KeyNotFoundError, ks.__getitem__, thumbprint(k2))
+        assert_not_in(thumbprint(k1), ks._keys)
+        ks.close()
+
+    def test_threads(self):
+        ks = SqliteKeyStore(self.path)
+        keys = [Identity.generateKey() for _ in range(20)]
+        with ThreadPoolExecutor(4) as pool:
+            list(pool.map(ks.add, keys))
+
+        ks2 = SqliteKeyStore(self.path)
+        with ThreadPoolExecutor(4) as pool:
+            tprints = list(pool.map(lambda k: thumbprint(ks2[thumbprint(k)]),
+                                    keys))
+        assert_equals(tprints, thumbprints(keys))
+        ks.close()
+        ks2.close()
+
+
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.server = StubCliqueServer(bulk=False)
+        self.server.key_delay = 0.05
+        self.ks = RemoteKeyStore(self.server.url + "/keys")
+        # Without bulk requests keys are fetched concurrently
+        self.ks._bulk = False
+        self.keys = [Identity.generateKey() for _ in range(8)]
+        for key in self.keys:
+            self.server.keys[thumbprint(key)] = key
+
+    def tearDown(self):
+        self.ks.close()
+        self.server.close()
+
+    def test_prefetch(self):
+        missing = newJwk()
+        tprints = thumbprints(self.keys) + [thumbprint(missing)]
+        assert_equals(self.ks.prefetch(tprints + tprints[:2]),
+                      [thumbprint(missing)])
+        assert_greater(self.server.max_key_requests, 1)
+        assert_equals(len(self.server.requests), len(tprints))
+        for key in self.keys:
+            assert_in(thumbprint(key), self.ks)
+
+        # Cached keys are not fetched again
+        assert_equals(self.ks.prefetch(tprints[:-1]), [])
+        assert_equals(len(self.server.requests), len(tprints))
+
+        # Local stores only look them up
+        ks = LocalKeyStore()
+        ks.add(self.keys[0])
+        assert_equals(ks.prefetch(tprints[:2]), tprints[1:2])
+
+    def test_deserialize(self):
+        ident = Identity("acct:pete@spacemen3.com", self.keys[0])
+        chain = BlockChain()
+        for key in self.keys:
+            ident.rotateKey(key)
+            chain.addBlock(ident, song="Revolution")
+
+        curr = setKeyStore(self.ks)
+        try:
+            chain2 = BlockChain.deserialize(chain.serialize(), prefetch=True)
+            chain2.validate(chain[0].hash)
+        finally:
+            setKeyStore(curr)
+        assert_equals(chain2.serialize(), chain.serialize())
+        assert_greater(self.server.max_key_requests, 1)
+        assert_equals(len(self.server.requests), len(self.keys))
+
+    def test_prefetchKeys(self):
+        ident = Identity("acct:sonic@spacemen3.com", self.keys[0])
+        chain = BlockChain()
+        for key in self.keys[:3]:
+            ident.rotateKey(key)
+            chain.addBlock(ident)
+
+        curr = setKeyStore(self.ks)
+        try:
+            assert_equals(chain.prefetchKeys(), [])
+        finally:
+            setKeyStore(curr)
+        assert_equals(sorted(r[1] for r in self.server.requests),
+                      sorted("/keys/" + tp
+                             for tp in thumbprints(self.keys[:3])))
+
+
+class TestBulk(unittest.TestCase):
+    def setUp(self):
+        self.server = StubCliqueServer()
+        self.ks = RemoteKeyStore(self.server.url + "/keys")
+        self.ks.BULK_SIZE = 4
+        self.keys = [Identity.generateKey() for _ in range(10)]
+
+    def tearDown(self):
+        self.ks.close()
+        self.server.close()
+
+    def test_uploadMany(self):
+        assert_equals(self.ks.uploadMany(self.keys), thumbprints(self.keys))
+        assert_equals(self.server.requests, [("POST", "/keys")] * 3)
+        assert_equals(sorted(self.server.keys), sorted(thumbprints(self.keys)))
+        # Only public keys are uploaded
+        for key in self.server.keys.values():
+            assert_false(jwkIsPrivate(key))
+        assert_is(self.ks[thumbprint(self.keys[0])], self.keys[0])
+
+        # Per key fallback
+        self.server.bulk = False
+        self.server.keys = {}
+        ks = RemoteKeyStore(self.server.url + "/keys")
+        assert_equals(ks.uploadMany(self.keys), thumbprints(self.keys))
+        assert_equals(sorted(self.server.keys), sorted(thumbprints(self.keys)))
+        assert_false(ks._bulk)
+        ks.close()
+
+    def test_getMany(self):
+        for key in self.keys:
+            self.server.keys[thumbprint(key)] = key
+        missing = thumbprint(newJwk())
+        tprints = thumbprints(self.keys)
+
+        keys = self.ks.getMany(tprints[:6] + [missing] + tprints[6:])
+        assert_is_instance(keys, OrderedKeySet)
+        assert_equals(thumbprints(keys), tprints)
+        assert_not_in(missing, keys)
+        assert_equals(len(self.server.requests), 3)
+        # Cached
+        assert_equals(thumbprints(self.ks.getMany(tprints[:3])), tprints[:3])
+        assert_equals(len(self.server.requests), 3)
+        # Missing keys are not requested again for a while
+        assert_equals(self.ks.prefetch(tprints + [missing]), [missing])
+        assert_equals(len(self.server.requests), 3)
+
+        # Per key fallback
+        self.server.bulk = False
+        ks = RemoteKeyStore(self.server.url + "/keys")
+        assert_equals(thumbprints(ks.getMany(tprints)), tprints)
+        assert_equals(len(self.server.requests), 3 + 1 + len(tprints))
+        ks.close()
+
+        # Keys the server was not asked for are ignored, nor added to any
+        # key store.
+        injected = JWK(generate="EC", size=256)
+        for bulk in (True, False):
+            self.server.bulk = bulk
+            ks = RemoteKeyStore(self.server.url + "/keys")
+            with patch.object(self.server, "_getKey", return_value=injected):
+                assert_equals(len(ks.getMany(tprints[1:2])), 0)
+            assert_not_in(thumbprint(injected), ks._keys)
+            assert_not_in(thumbprint(injected), keystore())
+            ks.close()
+        ks.close()
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.server = StubCliqueServer(bulk=False)
+        self.keys = [Identity.generateKey() for _ in range(4)]
+        for key in self.keys:
+            self.server.keys[thumbprint(key)] = key
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_capacity(self):
+        ks = RemoteKeyStore(self.server.url + "/keys", capacity=2)
+        for key in self.keys:
+            ks[thumbprint(key)]
+        assert_equals(list(ks._keys), thumbprints(self.keys[2:]))
+        ks[thumbprint(self.keys[3])]
+        ks[thumbprint(self.keys[0])]
+        assert_equals(ks.cacheInfo(), CacheInfo(1, 5, 0, 2, 2))
+        assert_equals(len(self.server.requests), 5)
+        ks.close()
+
+    def test_negative(self):
+        ks = RemoteKeyStore(self.server.url + "/keys", negative_ttl=0.05)
+        missing = newJwk()
+        for _ in range(3):
+            assert_raises(KeyNotFoundError, ks.__getitem__,
+                          thumbprint(missing))
+        assert_equals(ks.getMany([thumbprint(missing)]).export(),
+                      OrderedKeySet().export())
+        assert_equals(len(self.server.requests), 1)
+        assert_equals(ks.cacheInfo(), CacheInfo(0, 1, 3, 0, None))
+
+        time.sleep(0.06)
+        assert_raises(KeyNotFoundError, ks.__getitem__, thumbprint(missing))
+        assert_equals(len(self.server.requests), 2)
+
+        # Known once added
+        ks.add(missing)
+        assert_is(ks[thumbprint(missing)], missing)
+        assert_equals(ks.cacheInfo(), CacheInfo(1, 2, 3, 1, None))
+        ks.close()
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmpdir.name)
+        self.server = StubCliqueServer()
+        self.keys = [Identity.generateKey() for _ in range(3)]
+        for key in self.keys:
+            self.server.keys[thumbprint(key)] = key
+
+    def tearDown(self):
+        self.server.close()
+        self.tmpdir.cleanup()
+
+    def test_warm(self):
+        tprints = thumbprints(self.keys)
+        ks = RemoteKeyStore(self.server.url + "/keys", cache_dir=self.path)
+        ks[tprints[0]]
+        ks.getMany(tprints)
+        assert_equals(len(self.server.requests), 2)
+        assert_equals(sorted(p.name for p in (self.path / "keys").iterdir()),
+                      sorted(tprints))
+        ks.close()
+
+        # A new store (or process) starts warm
+        ks = RemoteKeyStore(self.server.url + "/keys", cache_dir=self.path)
+        assert_equals(ks[tprints[0]].export_public(),
+                      self.keys[0].export_public())
+        assert_equals(thumbprints(ks.getMany(tprints)), tprints)
+        assert_equals(len(self.server.requests), 2)
+        ks.close()
+
+    def test_corrupt(self):
+        tp = thumbprint(self.keys[0])
+        other = Identity.generateKey()
+        (self.path / "keys").mkdir()
+        (self.path / "keys" / tp).write_text(other.export_public())
+
+        ks = RemoteKeyStore(self.server.url + "/keys", cache_dir=self.path)
+        assert_equals(ks[tp].export_public(), self.keys[0].export_public())
+        assert_equals(len(self.server.requests), 1)
+        assert_equals((self.path / "keys" / tp).read_text(),
+                      self.keys[0].export_public())
+        ks.close()
+
+        # Unparseable files are a cache miss
+        tp = thumbprint(self.keys[1])
+        (self.path / "keys" / tp).write_text("not a key")
+        assert_equals(ks[tp].export_public(), self.keys[1].export_public())
+        ks.close()
+
+    def test_traversal(self):
+        cache = self.path / "cache"
+        (cache / "keys").mkdir(parents=True)
+        victim = self.path / "victim.jwk"
+        victim.write_text(Identity.generateKey().export_public())
+        (self.path / "victim.txt").write_text("not a key")
 
+        ks = RemoteKeyStore(self.server.url + "/keys", cache_dir=cache)
+        for kid in ("../../victim.jwk", "../../victim.txt"):
+            assert_raises(KeyNotFoundError, ks.__getitem__, kid)
+            assert_equals(len(ks.getMany([kid])), 0)
+        assert_true(victim.exists())
+        # Not requested either
+        assert_equals(len(self.server.requests), 0)
+        ks.close()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import unittest
+from hashlib import sha256
+from nose.tools import *  # noqa
+
+from clique.merkle import *  # noqa
+
+
+def _mth(leaves):
+    """The RFC 6962 definition of the tree hash, recursively."""
+    if not leaves:
+        return sha256(b"").digest()
+    if len(leaves) == 1:
+        return sha256(b"\x00" + bytes.fromhex(leaves[0])).digest()
+    k = 1
+    while k * 2 < len(leaves):
+        k *= 2
+    return sha256(b"\x01" + _mth(leaves[:k]) + _mth(leaves[k:])).digest()
+
+
+class TestMerkleTree(unittest.TestCase):
+    def setUp(self):
+        self.leaves = [sha256(str(i).encode()).hexdigest() for i in range(70)]
+
+    def test_root(self):
+        tree = MerkleTree()
+        assert_equals(tree.root(), EMPTY_ROOT)
+        for n, leaf in enumerate(self.leaves, 1):
+            tree.append(leaf)
+            assert_equals(len(tree), n)
+            assert_equals(tree.root(), _mth(self.leaves[:n]).hex())
+
+        # Of the older tree sizes too
+        for n in range(len(self.leaves) + 1):
+            assert_equals(tree.root(n), _mth(self.leaves[:n]).hex())
+        assert_raises(ValueError, tree.root, len(self.leaves) + 1)
+
+        # Leaves already in the tree are not added again
+        tree.append(self.leaves[0], 0)
+        assert_equals(len(tree), len(self.leaves))
+
+    def test_inclusion(self):
+        tree = MerkleTree(self.leaves)
+        for size in (1, 2, 3, 7, 8, 9, 64, 70):
+            root = tree.root(size)
+            for i in range(size):
+                proof = tree.proveInclusion(i, size)
+                assert_equals(proof.leaf, self.leaves[i])
+                assert_less_equal(len(proof.path), size.bit_length())
+                assert_true(verifyInclusion(proof, root))
+
+                assert_false(verifyInclusion(proof, tree.root(size - 1)))
+                if size > 1:
+                    assert_false(verifyInclusion(
+                            proof._replace(index=(i + 1) % size), root))
+                assert_false(verifyInclusion(
+                        proof._replace(leaf=self.leaves[-1 - i]), root))
+                if proof.path:
+                    assert_false(verifyInclusion(
+                            proof._replace(path=proof.path[:-1]), root))
+                    assert_false(verifyInclusion(
+                            proof._replace(path=proof.path + [root]), root))
+
+        assert_raises(IndexError, tree.proveInclusion, 70)
+        assert_raises(IndexError, tree.proveInclusion, 3, 3)
+        proof = tree.proveInclusion(3)
+        assert_false(verifyInclusion(proof._replace(leaf="xyz"), tree.root()))
+        assert_false(verifyInclusion(proof._replace(index=70), tree.root()))
+
+    def test_copy(self):
+        tree = MerkleTree(self.leaves[:10])
+        copy = tree.copy()
+        copy.append(self.leaves[10])
+        assert_equals(len(tree), 10)
+        assert_equals(tree.root(), _mth(self.leaves[:10]).hex())
+        assert_equals(copy.root(), _mth(self.leaves[:11]).hex())
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import gc
+import json
+import pickle
+import unittest
+from nose.tools import *  # noqa
+from jwcrypto.jwk import JWK
+from jwcrypto.jws import InvalidJWSSignature
+
+from clique import *  # noqa
+from clique.common import *  # noqa
+from clique.signing import *  # noqa
+
+
+class TestBackends(unittest.TestCase):
+    def setUp(self):
+        self.key = Identity.generateKey()
+        self.public_key = JWK(**json.loads(self.key.export_public()))
+        self.header = {"alg": "ES256", "kid": thumbprint(self.key)}
+        self.claims = {"iss": "acct:kevin@mbv.com", "song": "Soon", "n": 1,
+                       "ü": ["Loveless", 1991]}
+
+    def test_byteIdentical(self):
+        native = Es256Backend().sign(self.key, self.header, self.claims)
+        reference = JwcryptoBackend().sign(self.key, self.header, self.claims)
+        assert_equal(native.rsplit(".", 1)[0], reference.rsplit(".", 1)[0])
+
+    def test_crossVerify(self):
+        backends = [JwcryptoBackend(), Es256Backend()]
+        for signer in backends:
+            token = signer.sign(self.key, self.header, self.claims)
+            for verifier in backends:
+                verifier.verify(self.key, CompactJws(token))
+                verifier.verify(self.public_key, CompactJws(token))
+                assert_raises(InvalidJWSSignature, verifier.verify,
+                              Identity.generateKey(), CompactJws(token))
+
+    def test_badSignature(self):
+        backend = Es256Backend()
+        token = backend.sign(self.key, self.header, self.claims)
+        jws = CompactJws(token)
+        jws.signature = jws.signature[:-1]
+        assert_raises(InvalidJWSSignature, backend.verify, self.key, jws)
+
+        jws = CompactJws(token)
+        jws.signature = bytes(reversed(jws.signature))
+        assert_raises(InvalidJWSSignature, backend.verify, self.key, jws)
+
+    def test_keyCache(self):
+        backend = Es256Backend()
+        token = backend.sign(self.key, self.header, self.claims)
+        backend.verify(self.public_key, CompactJws(token))
+        tprint = thumbprint(self.key)
+        assert_equal(list(backend._private_keys), [self.key])
+        assert_equal(list(backend._public_keys), [tprint])
+
+        private_key = backend._privateKey(self.key)
+        backend.sign(self.key, self.header, self.claims)
+        assert_is(backend._privateKey(self.key), private_key)
+
+        # Public keys are bounded, private keys go with their JWK
+        backend._public_keys.capacity = 1
+        other = JWK.generate(kty="EC", crv="P-256")
+        backend.sign(other, self.header, self.claims)
+        backend._publicKey(other)
+        assert_equal(list(backend._public_keys), [thumbprint(other)])
+        assert_equal(len(backend._private_keys), 2)
+        del other
+        gc.collect()
+        assert_equal(list(backend._private_keys), [self.key])
+
+        # Caches are not pickled
+        copy = pickle.loads(pickle.dumps(backend))
+        assert_equal(len(copy._private_keys), 0)
+        assert_equal(len(copy._public_keys), 0)
+        copy.verify(self.key, CompactJws(token))
+
+    def test_blockBackend(self):
+        ident = Identity("acct:bilinda@mbv.com", self.key)
+        chain = BlockChain()
+        chain.addBlock(ident)
+        chain.addBlock(ident, song="Only Shallow")
+        assert_is_instance(chain[0].jws_backend, Es256Backend)
+
+        class ReferenceBlock(blockchain.Block):
+            jws_backend = JwcryptoBackend()
+
+        block = ReferenceBlock(ident, chain[-1].hash, song="Sometimes")
+        block.verify()
+        chain += block
+        chain.validate(chain[0].hash)
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(unittest.main())